@@ -9,53 +9,341 @@
     :license: BSD, see LICENSE for more details
 """
 
-__version__ = '0.1.2'
+__version__ = '0.2.0'
 
-from typing import Optional
+import asyncio
+import os
+import time
+from queue import Empty, Full, LifoQueue
+from random import randint
+from threading import Lock
+from typing import Any, Dict, List, Optional, Sequence
 import zmq
+import zmq.asyncio
 from zmq import Context, Socket
+from zmq.utils import jsonapi
 
 from flask import Flask, current_app, _app_ctx_stack
 
 # TODO: Package this and submit it to PyPi
 
+SOCKOPTS = ("LINGER", "SNDHWM", "RCVHWM", "HEARTBEAT_IVL", "HEARTBEAT_TIMEOUT", "HEARTBEAT_TTL")
+# Each of these may be set in the config as {prefix}_{name}, e.g. ZMQ_LINGER
+
+
+class JSONRPCClient(object):
+    """Speaks JSON-RPC 2.0 over a REQ or DEALER socket.
+
+    Over a DEALER socket, any number of requests can be outstanding at once; replies are matched to requests by their
+    ``id``, and replies to requests that were already given up on are dropped.  A REQ socket can only have one request
+    in flight, so requests over one are made one at a time.
+    """
+
+    def __init__(self, socket: Socket):
+        self.socket = socket
+        self.pipelined = socket.type == zmq.DEALER
+
+    @staticmethod
+    def request(method: str, params: Any=None) -> Dict:
+        """Build a JSON-RPC request with a random id."""
+        request = {
+            "jsonrpc": "2.0",
+            "id": randint(-((2**53) - 1), (2**53) - 1),
+            "method": method,
+        }
+
+        if params is not None:
+            request["params"] = params
+
+        return request
+
+    def _send(self, request: Dict):
+        if self.pipelined:
+            # REP and ROUTER peers expect the empty delimiter frame that a REQ socket would have added for us
+            self.socket.send_multipart([b"", jsonapi.dumps(request)])
+        else:
+            self.socket.send_json(request)
+
+    def _recv(self) -> Dict:
+        if self.pipelined:
+            return jsonapi.loads(self.socket.recv_multipart()[-1])
+        else:
+            return self.socket.recv_json()
+
+    def call_many(self, requests: Sequence[Dict], timeout: int) -> List[Dict]:
+        """Send all of these requests and return their responses, in the same order.
+
+        :param timeout: How long to wait for all responses, in milliseconds.
+        :raises TimeoutError: if any response doesn't arrive in time.
+        """
+        deadline = time.monotonic() + (timeout / 1000)
+        responses = [None] * len(requests)  # type: List[Optional[Dict]]
+        pending = {}  # type: Dict[Any, int]
+
+        def _wait():
+            remaining = deadline - time.monotonic()
+            if remaining <= 0 or self.socket.poll(remaining * 1000) == 0:
+                raise TimeoutError(
+                    f"{len(pending)} of {len(requests)} requests went unanswered within {timeout}ms"
+                )
+
+        for index, request in enumerate(requests):
+            pending[request["id"]] = index
+            self._send(request)
+
+            if not self.pipelined:
+                _wait()
+                responses[index] = self._recv()
+                del pending[request["id"]]
+
+        while len(pending) > 0:
+            _wait()
+            response = self._recv()
+            index = pending.pop(response.get("id"), None)
+            if index is not None:
+                responses[index] = response
+            # Otherwise it's a late reply to a request we already gave up on
+
+        return responses
+
+    def call(self, method: str, params: Any=None, timeout: int=5000) -> Dict:
+        """Make one request and return its response.
+
+        :param timeout: How long to wait for the response, in milliseconds.
+        :raises TimeoutError: if the response doesn't arrive in time.
+        """
+        return self.call_many([self.request(method, params)], timeout)[0]
+
+
+class AsyncJSONRPCClient(object):
+    """Speaks JSON-RPC 2.0 over one ``zmq.asyncio`` DEALER socket, shared by every coroutine on an event loop.
+
+    Each request gets a future that a single reader task resolves when the reply with the matching ``id`` arrives, so
+    any number of coroutines can have requests in flight over the same socket at once.  Replies to requests that were
+    already given up on are dropped.
+    """
+
+    def __init__(self, socket: zmq.asyncio.Socket):
+        if socket.type != zmq.DEALER:
+            raise ValueError("AsyncJSONRPCClient needs a DEALER socket")
+
+        self.socket = socket
+        self._pending = {}  # type: Dict[Any, asyncio.Future]
+        self._reader = None  # type: Optional[asyncio.Future]
+
+    async def _read(self):
+        while True:
+            frames = await self.socket.recv_multipart()
+            response = jsonapi.loads(frames[-1])  # type: Dict
+            future = self._pending.pop(response.get("id"), None)
+            if future is not None and not future.done():
+                future.set_result(response)
+            # Otherwise it's a late reply to a request we already gave up on
+
+    async def call_many(self, requests: Sequence[Dict], timeout: int) -> List[Dict]:
+        """Send all of these requests and return their responses, in the same order.
+
+        :param timeout: How long to wait for all responses, in milliseconds.
+        :raises TimeoutError: if any response doesn't arrive in time.
+        """
+        if self._reader is None or self._reader.done():
+            self._reader = asyncio.ensure_future(self._read())
+
+        loop = asyncio.get_event_loop()
+        futures = []  # type: List[asyncio.Future]
+        try:
+            for request in requests:
+                future = loop.create_future()
+                self._pending[request["id"]] = future
+                futures.append(future)
+                # REP and ROUTER peers expect the empty delimiter frame that a REQ socket would have added for us
+                await self.socket.send_multipart([b"", jsonapi.dumps(request)])
+
+            done, pending = await asyncio.wait(futures, timeout=timeout / 1000)
+            if len(pending) > 0:
+                raise TimeoutError(
+                    f"{len(pending)} of {len(requests)} requests went unanswered within {timeout}ms"
+                )
+
+            return [f.result() for f in futures]
+        finally:
+            for request in requests:
+                self._pending.pop(request["id"], None)
+
+    async def call(self, method: str, params: Any=None, timeout: int=5000) -> Dict:
+        """Make one request and return its response.
+
+        :param timeout: How long to wait for the response, in milliseconds.
+        :raises TimeoutError: if the response doesn't arrive in time.
+        """
+        return (await self.call_many([JSONRPCClient.request(method, params)], timeout))[0]
+
+    def close(self):
+        """Stop reading replies and close the socket."""
+        if self._reader is not None:
+            self._reader.cancel()
+
+        self.socket.close(linger=0)
+
 
 class ZMQSocket(object):
+    """Keeps a per-process pool of long-lived, connected sockets for each app.
+
+    Each app context checks out a socket the first time it asks for one, and returns it to its app's pool on teardown,
+    so no connection is set up or torn down on the request path.  Each app keeps its pool in its extensions, since
+    apps may connect to different addresses.  Pools are never shared across a fork; a process that finds a pool
+    created by its parent starts a new one.
+    """
+
     def __init__(self, app: Optional[Flask]=None, context: Optional[Context]=None, prefix: str="ZMQ"):
         self.prefix = prefix
         self.app = app
-        self.context = context or Context.instance()
+        self._context = context
+        self._pool_lock = Lock()
         if app is not None:
             self.init_app(app)
 
+    @property
+    def context(self) -> Context:
+        # Context.instance() makes a new context after a fork, which is what we want
+        return self._context or Context.instance()
+
     def init_app(self, app: Flask):
+        size = app.config.get(f'{self.prefix}_POOL_SIZE', 1)
+        if size < 1:
+            # A LifoQueue with no maxsize is never full, so the pool would grow (and be warmed) without end
+            raise ValueError(f"{self.prefix}_POOL_SIZE must be at least 1, not {size}")
+
         # register extension with app
         app.extensions = getattr(app, 'extensions', {})
-        app.extensions["zmq_socket"] = self.socket
+        app.extensions["zmq_socket"] = self
+        app.extensions["zmq_socket_pool"] = (None, None)
         # TODO: Make the name in extensions configurable
-        # TODO: How is app.extensions supposed to be used?
         app.teardown_appcontext(self.teardown)
 
-    def _init_socket(self, app: Flask) -> Socket:
-        socket = self.context.socket(getattr(zmq, app.config[f'{self.prefix}_SOCKET_TYPE']))
+        if app.config.get(f'{self.prefix}_POOL_PREWARM', False):
+            try:
+                import uwsgi
+                from uwsgidecorators import postfork
+            except ImportError:
+                # Not a uWSGI worker, so maybe a CLI command or an app that never uses the pool; don't hold it up
+                pass
+            else:
+                if uwsgi.worker_id() > 0:
+                    # With lazy-apps, each worker loads the app after it's forked, when post-fork hooks have already run
+                    self.warm(app)
+                else:
+                    # Otherwise the master loads the app before forking its workers, and sockets can't survive a fork
+                    postfork(lambda: self.warm(app))
+
+    def _init_socket(self, app: Flask, context: Optional[Context]=None, socket_type: Optional[int]=None) -> Socket:
+        if socket_type is None:
+            socket_type = getattr(zmq, app.config[f'{self.prefix}_SOCKET_TYPE'])
+
+        socket = (context or self.context).socket(socket_type)
         # TODO: Allow either an int or a string here
 
+        for name in SOCKOPTS:
+            value = app.config.get(f'{self.prefix}_{name}')
+            if value is not None:
+                socket.setsockopt(getattr(zmq, name), value)
+
         socket.connect(app.config[f'{self.prefix}_CONNECT_ADDR'])
         # TODO: Raise an exception if I don't have write permission on this socket (if it's a unix socket)
-        # TODO: Set sockopts here
         return socket
 
+    def _get_pool(self, app: Flask) -> LifoQueue:
+        pid = os.getpid()
+        pool_pid, pool = app.extensions["zmq_socket_pool"]  # type: Optional[int], Optional[LifoQueue]
+        if pool_pid == pid:
+            return pool
+
+        with self._pool_lock:
+            pool_pid, pool = app.extensions["zmq_socket_pool"]
+            if pool_pid != pid:
+                # Sockets inherited from a parent process must not be used (or even closed), so just forget them
+                pool = LifoQueue(maxsize=app.config.get(f'{self.prefix}_POOL_SIZE', 1))
+                app.extensions["zmq_socket_pool"] = (pid, pool)
+
+        return pool
+
+    def _checkout(self, app: Flask) -> Socket:
+        try:
+            return self._get_pool(app).get_nowait()
+        except Empty:
+            # Every pooled socket is in use, so make another; the pool will keep it if there's room
+            return self._init_socket(app)
+
+    def _checkin(self, app: Flask, socket: Socket):
+        try:
+            self._get_pool(app).put_nowait(socket)
+        except Full:
+            socket.close()
+
+    def _ping(self, app: Flask, socket: Socket) -> bool:
+        try:
+            pong = JSONRPCClient(socket).call("ping", timeout=app.config.get(f'{self.prefix}_PING_TIMEOUT', 1000))
+        except TimeoutError:
+            return False
+
+        return pong.get("result") == "pong"
+
+    def warm(self, app: Flask):
+        """Fill this process's pool with connected sockets, keeping only those that answer a JSON-RPC ping."""
+        pool = self._get_pool(app)
+        while not pool.full():
+            socket = self._init_socket(app)
+            if not self._ping(app, socket):
+                app.logger.warning(
+                    "%s at %s didn't answer a ping, leaving the socket pool with %d of %d sockets",
+                    self.prefix, app.config[f'{self.prefix}_CONNECT_ADDR'], pool.qsize(), pool.maxsize
+                )
+                socket.close(linger=0)
+                return
+
+            pool.put_nowait(socket)
+
+        app.logger.info("Warmed %s socket pool with %d sockets", self.prefix, pool.qsize())
+
+    def async_client(self, app: Flask) -> AsyncJSONRPCClient:
+        """Make a client over a new, configured ``zmq.asyncio`` DEALER socket, for use on the current event loop.
+
+        The socket isn't pooled; one is enough for a whole process, so close the client when the loop shuts down.
+        """
+        context = zmq.asyncio.Context.shadow(self.context.underlying)
+        # Shadow the synchronous context so that inproc endpoints are shared between the two
+
+        return AsyncJSONRPCClient(self._init_socket(app, context, zmq.DEALER))
+
+    def discard(self):
+        """Close this app context's socket instead of returning it to the pool.
+
+        Call this when the socket may be in a bad state, e.g. a REQ socket whose request timed out.
+        """
+        ctx = _app_ctx_stack.top
+
+        if ctx is not None and hasattr(ctx, "zmq_socket"):
+            ctx.zmq_socket.close(linger=0)
+            del ctx.zmq_socket
+
     def teardown(self, exception):
         ctx = _app_ctx_stack.top
 
         if ctx is not None and hasattr(ctx, "zmq_socket"):
-            # TODO: Delete the socket once the app ends
-            ctx.zmq_socket.close()
+            self._checkin(ctx.app, ctx.zmq_socket)
+            del ctx.zmq_socket
 
     @property
     def socket(self) -> Socket:
         ctx = _app_ctx_stack.top
         if ctx is not None:
             if not hasattr(ctx, 'zmq_socket'):
-                ctx.zmq_socket = self._init_socket(current_app)
+                ctx.zmq_socket = self._checkout(current_app)
             return ctx.zmq_socket
+
+    @property
+    def client(self) -> JSONRPCClient:
+        """A JSON-RPC client using this app context's socket."""
+        socket = self.socket
+        if socket is not None:
+            return JSONRPCClient(socket)
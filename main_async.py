@@ -0,0 +1,17 @@
+# -*- coding: utf-8 -*-
+"""Create an asyncio application instance.
+
+Serve it with e.g. ``gunicorn main_async:app --worker-class aiohttp.GunicornWebWorker``.
+"""
+from flask.helpers import get_debug_flag
+
+from sockpuppet.app import create_async_app
+from sockpuppet.settings import DevConfig, ProdConfig
+
+CONFIG = DevConfig if get_debug_flag() else ProdConfig
+
+connex = create_async_app(CONFIG)
+app = connex.app
+
+if __name__ == "__main__":
+    connex.run(port=5000)
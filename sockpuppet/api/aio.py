@@ -0,0 +1,730 @@
+# -*- coding: utf-8 -*-
+"""Native asyncio versions of the v1 API's request handlers.
+
+Scraping goes through one shared aiohttp session and inference through one shared, pipelined ZMQ socket, so a single
+process can hold hundreds of lookups open at once instead of pinning a worker per request.  The Flask app is still
+what holds the config, the logger, and the cache; cache calls are quick, so they run in the event loop's default
+executor inside a Flask app context.
+"""
+import asyncio
+import time
+from functools import partial
+from http import HTTPStatus
+from random import randint
+from typing import Any, Callable, Dict, List, Optional, Sequence, Set, Tuple, Union
+
+import aiohttp
+from aiohttp import web
+from flask import Flask
+from jsonrpc.exceptions import JSONRPCInvalidRequest, JSONRPCParseError
+from prometheus_client import CONTENT_TYPE_LATEST
+from flask_zmq import AsyncJSONRPCClient, JSONRPCClient
+from werkzeug.datastructures import MIMEAccept
+from werkzeug.http import parse_accept_header
+
+from sockpuppet.api.cache import (
+    acquire_leases,
+    get_cached_guesses,
+    get_cached_timeline,
+    get_cached_tweets,
+    normalize_name,
+    poll_leased_guesses,
+    release_leases,
+    set_cached_guesses,
+    set_cached_timeline,
+    take_polled
+)
+from sockpuppet.api.conditional import Validators, cache_headers, cache_validators, is_not_modified
+from sockpuppet.api.guesses import (
+    UNKNOWN,
+    Guess,
+    add_timing_meta,
+    batch_responses,
+    batch_users,
+    claim_refreshes,
+    count_verdicts,
+    dedupe_misses,
+    fan_out,
+    guess_response,
+    merge_timeline,
+    record_fetch_deadline,
+    record_fetch_failure,
+    request_problem,
+    scorable,
+    settle_guesses,
+    sort_cached,
+    split_late,
+    split_leased,
+    take_fresh,
+    take_shared
+)
+from sockpuppet.api.model import (
+    get_result,
+    guess_requests,
+    is_unsupported,
+    known_model_version,
+    model_round_trip,
+    record_model_version
+)
+from sockpuppet.api.sources import TIMELINE_HEADERS, TIMELINE_PARAMS, TIMELINE_URL, ParseError, parse_tweets
+from sockpuppet import metrics, serialization
+from sockpuppet.errors import ModelError
+from sockpuppet.extensions import zmq_socket
+from sockpuppet.metrics import CACHE_LOOKUPS, IN_FLIGHT, REQUEST_SECONDS, SCRAPE_SECONDS
+from sockpuppet.serialization import NO_ENVELOPE_STATUSES
+from sockpuppet.timing import ServerTiming, collect_timing, stage
+from sockpuppet.utils import MAX_JSON_INT, MIN_JSON_INT, remaining_ms
+
+
+async def _in_app_context(app: Flask, func: Callable, *args) -> Any:
+    """Call func in the default executor, inside an app context of the Flask app."""
+    def _call():
+        with app.app_context():
+            return func(*args)
+
+    return await asyncio.get_event_loop().run_in_executor(None, _call)
+
+
+async def startup(aio: web.Application):
+    """Open the process-wide Twitter session and model server socket, and bound background refreshes."""
+    app = aio["flask"]  # type: Flask
+
+    aio["twitter_session"] = aiohttp.ClientSession(
+        connector=aiohttp.TCPConnector(
+            limit=app.config["SCRAPE_CONNECTIONS"],
+            limit_per_host=app.config["SCRAPE_CONNECTIONS_PER_HOST"]
+        ),
+        timeout=aiohttp.ClientTimeout(total=app.config["SCRAPE_TIMEOUT"]),
+        headers=TIMELINE_HEADERS
+    )
+    aio["model_client"] = zmq_socket.async_client(app)
+    aio["refresh_semaphore"] = asyncio.Semaphore(app.config["REFRESH_WORKERS"])
+    aio["refreshes"] = set()  # The event loop only keeps weak references to tasks
+    aio["refreshing"] = set()  # The normalized names of the users those tasks are refreshing
+
+
+async def cleanup(aio: web.Application):
+    await aio["twitter_session"].close()
+    aio["model_client"].close()
+
+
+async def get_timeline_page(aio: web.Application, user: str, position: Optional[str]=None) -> Dict:
+    """Fetch one page of this user's timeline, starting after the tweet with the given id (or at the top).
+
+    Behaves like sockpuppet.api.sources.SessionSource.get_page.
+
+    :raises ValueError: if the user is private or doesn't exist.
+    :raises aiohttp.ClientResponseError: if Twitter answers with any other error, or with something other than JSON.
+    :raises aiohttp.ServerTimeoutError: if Twitter doesn't answer within SCRAPE_TIMEOUT.
+    """
+    app = aio["flask"]  # type: Flask
+    session = aio["twitter_session"]  # type: aiohttp.ClientSession
+    params = TIMELINE_PARAMS if position is None else dict(TIMELINE_PARAMS, max_position=position)
+
+    try:
+        async with session.get(
+            TIMELINE_URL.format(user),
+            params=params,
+            headers={"Referer": f"https://twitter.com/{user}"}
+        ) as response:
+            if response.status == HTTPStatus.NOT_FOUND:
+                raise ValueError(f"{user} does not exist or is private")
+
+            response.raise_for_status()
+            try:
+                return await response.json(content_type=None)
+            except ValueError as e:
+                # e.g. a rate-limiting page; that's no reason to think the user doesn't exist
+                raise aiohttp.ClientResponseError(
+                    response.request_info,
+                    response.history,
+                    status=response.status,
+                    message=f"Twitter didn't send JSON for {user}"
+                ) from e
+    except asyncio.TimeoutError as e:
+        raise aiohttp.ServerTimeoutError(f"Twitter didn't answer within {app.config['SCRAPE_TIMEOUT']}s") from e
+
+
+async def get_recent_tweets(aio: web.Application, user: str, limit: int) -> Sequence[str]:
+    """Return the text of up to limit of this user's most recent tweets, newest first.
+
+    Behaves like sockpuppet.api.v1.get_recent_tweets.
+
+    :raises ValueError: if the user is private or doesn't exist.
+    :raises aiohttp.ClientError: if Twitter can't be reached, answers with an error, or doesn't answer within
+        SCRAPE_TIMEOUT.
+    :raises ParseError: if Twitter's answer can't be made sense of.
+    """
+    app = aio["flask"]  # type: Flask
+    timeline = await _in_app_context(app, get_cached_timeline, user)  # type: Optional[Dict]
+
+    app.logger.info("Requesting up to %d tweets from %s", limit, user)
+    fresh = []  # type: List[Tuple[str, str]]
+    position = None  # type: Optional[str]
+    with SCRAPE_SECONDS.time(), IN_FLIGHT.labels("scrape").track_inprogress(), stage("scrape", user):
+        for _ in range(app.config["SCRAPE_MAX_PAGES"]):
+            payload = await get_timeline_page(aio, user, position)  # type: Dict
+            if "items_html" not in payload:
+                if position is None:
+                    raise ValueError(f"{user} does not exist or is private")
+
+                break
+
+            page = list(parse_tweets(payload["items_html"]))  # type: List[Dict]
+            if take_fresh(page, timeline, limit, fresh) or len(page) == 0 or not payload.get("has_more_items", True):
+                break
+
+            position = payload.get("min_position") or page[-1]["tweetId"]
+
+    timeline = merge_timeline(fresh, timeline, limit)
+    await _in_app_context(app, set_cached_timeline, user, timeline, app.config["TWEET_CACHE_TIMEOUT"])
+    app.logger.info("Got %d new tweets from %s", len(fresh), user)
+
+    return tuple(text for _, text in timeline["tweets"])
+
+
+async def fetch_tweets(aio: web.Application, user: str, refresh: bool=False) -> Optional[Sequence[str]]:
+    """Return this user's recent tweets from the cache, scraping them (which caches them too) if necessary.
+
+    Returns None if the user is private or doesn't exist.
+
+    :param refresh: If True, scrape the tweets even if they're cached.
+    """
+    app = aio["flask"]  # type: Flask
+    tweets = None if refresh else await _in_app_context(app, get_cached_tweets, user)  # type: Optional[Sequence[str]]
+    if not refresh:
+        CACHE_LOOKUPS.labels("tweets", "miss" if tweets is None else "hit").inc()
+
+    if tweets is None:
+        try:
+            tweets = await get_recent_tweets(aio, user, 20)
+        except ValueError:
+            return None
+
+    return tweets
+
+
+async def fetch_all_tweets(
+    aio: web.Application,
+    users: Sequence[str],
+    timeout: float,
+    refresh: bool=False
+) -> Tuple[Dict[int, Optional[Sequence[str]]], Dict[int, asyncio.Future]]:
+    """Fetch the tweets of each user concurrently.
+
+    Behaves like sockpuppet.api.v1.fetch_all_tweets; fetches still running when time runs out are left to finish on
+    the event loop, and their failures are logged when they do.
+    """
+    app = aio["flask"]  # type: Flask
+
+    if len(users) == 0:
+        return {}, {}
+
+    tasks = {asyncio.ensure_future(fetch_tweets(aio, u, refresh)): index for index, u in enumerate(users)}
+    done, not_done = await asyncio.wait(tasks, timeout=max(timeout, 0))
+
+    results = {}  # type: Dict[int, Optional[Sequence[str]]]
+    for task in done:
+        index = tasks[task]
+        try:
+            results[index] = task.result()
+        except (aiohttp.ClientError, ParseError) as e:
+            record_fetch_failure(app, users[index], e, aiohttp.ServerTimeoutError)
+
+    if len(not_done) > 0:
+        record_fetch_deadline(app, [users[tasks[t]] for t in not_done])
+        for task in not_done:
+            task.add_done_callback(partial(_finish_late_fetch, app, users[tasks[task]]))
+
+    return results, {tasks[t]: t for t in not_done}
+
+
+def _finish_late_fetch(app: Flask, user: str, task: asyncio.Future):
+    """Collect the outcome of a fetch that outlived its request, so that a failure is logged rather than lost."""
+    if task.cancelled():
+        return
+
+    e = task.exception()
+    if isinstance(e, (aiohttp.ClientError, ParseError)):
+        record_fetch_failure(app, user, e, aiohttp.ServerTimeoutError)
+    elif e is not None:
+        app.logger.error("Failed to fetch tweets from %s", user, exc_info=e)
+
+
+async def release_when_fetched(
+    aio: web.Application,
+    ids: Sequence[str],
+    leased: Sequence[str],
+    late: Dict[int, asyncio.Future]
+):
+    """Release the leases on these users, except that those whose fetches are still running keep theirs until they
+    finish.
+
+    Behaves like sockpuppet.api.v1.release_when_fetched.
+    """
+    app = aio["flask"]  # type: Flask
+    now, later = split_late(ids, leased, late)
+
+    def _release(name: str, task: asyncio.Future):
+        def _call():
+            with app.app_context():
+                release_leases([name])
+
+        # The executor keeps hold of its own work, unlike the event loop, so this needn't be kept track of
+        asyncio.get_event_loop().run_in_executor(None, _call)
+
+    await _in_app_context(app, release_leases, now)
+    for name, task in later:
+        task.add_done_callback(partial(_release, name))
+
+
+async def wait_for_guesses(
+    aio: web.Application,
+    names: Sequence[str],
+    model_version: Optional[str],
+    wait: int
+) -> List[Optional[Dict]]:
+    """Wait up to wait milliseconds for whoever holds these users' leases to cache guesses for them.
+
+    Behaves like sockpuppet.api.cache.wait_for_guesses, but sleeps without blocking the event loop.
+    """
+    app = aio["flask"]  # type: Flask
+    deadline = time.monotonic() + (wait / 1000)
+    guesses = [None] * len(names)  # type: List[Optional[Dict]]
+    pending = list(range(len(names)))  # type: List[int]
+
+    while True:
+        polled = await _in_app_context(app, poll_leased_guesses, [names[p] for p in pending], model_version)
+        pending = take_polled(guesses, pending, polled)
+        if len(pending) == 0 or time.monotonic() >= deadline:
+            return guesses
+
+        await asyncio.sleep(app.config["GUESS_LEASE_POLL_INTERVAL"] / 1000)
+
+
+async def query_model_many(aio: web.Application, requests: Sequence[Dict], timeout: Optional[int]=None) -> List[Dict]:
+    """Send several JSON-RPC requests to the model server at once and return their responses, in the same order.
+
+    :param timeout: How long to wait, in milliseconds; defaults to SOCK_TIMEOUT.
+    :raises TimeoutError: if the model server doesn't answer all of them in time.
+    """
+    app = aio["flask"]  # type: Flask
+    client = aio["model_client"]  # type: AsyncJSONRPCClient
+    if timeout is None:
+        timeout = app.config["SOCK_TIMEOUT"]
+
+    with model_round_trip(app, requests, timeout) as responses:
+        responses.extend(await client.call_many(requests, timeout))
+
+    return responses
+
+
+async def get_model_version(aio: web.Application, timeout: Optional[int]=None) -> Optional[str]:
+    """Return the version of the model the Sock server is running.
+
+    Behaves like sockpuppet.api.model.get_model_version, and shares what it's learned.
+    """
+    app = aio["flask"]  # type: Flask
+
+    current, version = known_model_version()
+    if current:
+        return version
+
+    try:
+        response = (await query_model_many(aio, [JSONRPCClient.request("version")], timeout))[0]  # type: Optional[Dict]
+    except TimeoutError as e:
+        app.logger.error(e)
+        response = None
+
+    return record_model_version(app, response)
+
+
+async def guess_batch(
+    aio: web.Application,
+    tweets: Sequence[Sequence[str]],
+    timeout: Optional[int]=None
+) -> List[Sequence[float]]:
+    """Score the tweets of several users with one round trip to the model server.
+
+    Behaves like sockpuppet.api.model.guess_batch.
+
+    :param timeout: How long to wait, in milliseconds; defaults to SOCK_TIMEOUT.
+    :raises TimeoutError: if the model server doesn't answer in time.
+    :raises ModelError: if the model server answers with an error.
+    """
+    app = aio["flask"]  # type: Flask
+
+    if len(tweets) == 0:
+        return []
+
+    if timeout is None:
+        timeout = app.config["SOCK_TIMEOUT"]
+
+    deadline = time.monotonic() + (timeout / 1000)
+    response = (await query_model_many(
+        aio, [JSONRPCClient.request("guess_batch", [list(t) for t in tweets])], timeout
+    ))[0]
+
+    if is_unsupported(response):
+        app.logger.warning("Sock doesn't support guess_batch, falling back to one guess per user")
+        return [get_result(r) for r in await query_model_many(aio, guess_requests(tweets), remaining_ms(deadline))]
+
+    return get_result(response)
+
+
+class JSONRPCResponse(web.Response):
+    """A response whose body is already a complete JSON-RPC envelope, so it needn't be wrapped in another."""
+
+
+def _json_response(query_response: Union[Dict, List[Dict]], status: HTTPStatus) -> JSONRPCResponse:
+    return JSONRPCResponse(body=serialization.dumps(query_response), status=status, content_type="application/json")
+
+
+def _error_response(response_id: Optional[int], code: int, message: str, status: HTTPStatus) -> JSONRPCResponse:
+    return JSONRPCResponse(
+        body=serialization.error_body(response_id, code, message), status=status, content_type="application/json"
+    )
+
+
+def check_request(request: web.Request, response_id: Optional[int]) -> Optional[web.Response]:
+    """Return an error response if this request can't be answered at all, or None if it can."""
+    app = request.app["flask"]  # type: Flask
+    accept_mimetypes = parse_accept_header(request.headers.get("Accept"), MIMEAccept)  # type: MIMEAccept
+    problem = request_problem(accept_mimetypes, str(request.url), app.config)
+
+    return None if problem is None else _error_response(response_id, *problem)
+
+
+async def lookup_users(
+    aio: web.Application,
+    ids: Sequence[str],
+    model_version: Optional[str],
+    deadline: float,
+    refresh: bool=False,
+    leased: Sequence[str]=()
+) -> List[Guess]:
+    """Scrape, score and cache each of these users by deadline, a time.monotonic() timestamp.
+
+    Behaves like sockpuppet.api.v1.lookup_users.
+    """
+    app = aio["flask"]  # type: Flask
+    late = {}  # type: Dict[int, asyncio.Future]
+
+    try:
+        # Scraping gets its share of what's left of the budget, and the model server gets the rest
+        fetched, late = await fetch_all_tweets(
+            aio, ids, remaining_ms(deadline) * app.config["SCRAPE_DEADLINE_SHARE"] / 1000, refresh
+        )  # type: Dict[int, Optional[Sequence[str]]], Dict[int, asyncio.Future]
+        available = scorable(fetched)
+
+        try:
+            scores = dict(zip(
+                (index for index, _ in available),
+                await guess_batch(
+                    aio, [tweets for _, tweets in available], min(app.config["SOCK_TIMEOUT"], remaining_ms(deadline))
+                )
+            ))  # type: Dict[int, Sequence[float]]
+        except (TimeoutError, ModelError) as e:
+            # Everyone who was scraped is reported as unknown, rather than failing the whole request
+            app.logger.error(e)
+            scores = {}
+
+        guesses, to_cache = settle_guesses(ids, fetched, scores, app.config)
+
+        # Everyone's guesses are written in one round trip
+        await _in_app_context(app, set_cached_guesses, to_cache, model_version)
+    finally:
+        await release_when_fetched(aio, ids, leased, late)
+
+    return guesses
+
+
+async def refresh_users(aio: web.Application, names: Sequence[str]):
+    """Look these users up again and re-cache their guesses, skipping any that someone else is already looking up.
+
+    At most REFRESH_WORKERS refreshes run at once in each process.
+    """
+    app = aio["flask"]  # type: Flask
+
+    async with aio["refresh_semaphore"]:
+        leased = await _in_app_context(
+            app, acquire_leases, names, app.config["GUESS_LEASE_TIMEOUT"]
+        )  # type: List[str]
+
+        if len(leased) == 0:
+            return
+
+        app.logger.info("Refreshing %s", ", ".join(leased))
+        deadline = time.monotonic() + (app.config["REQUEST_DEADLINE"] / 1000)
+        try:
+            model_version = await get_model_version(aio, min(app.config["SOCK_TIMEOUT"], remaining_ms(deadline)))
+        except Exception:
+            app.logger.exception("Failed to refresh %s", ", ".join(leased))
+            await _in_app_context(app, release_leases, leased)
+            return
+
+        try:
+            await lookup_users(aio, leased, model_version, deadline, refresh=True, leased=leased)
+        except Exception:
+            app.logger.exception("Failed to refresh %s", ", ".join(leased))
+
+
+def schedule_refresh(aio: web.Application, names: Sequence[str]):
+    """Call refresh_users on these users in the background, so that the current request needn't wait for it.
+
+    Behaves like sockpuppet.api.v1.schedule_refresh.
+    """
+    app = aio["flask"]  # type: Flask
+    refreshing = aio["refreshing"]  # type: Set[str]
+
+    claimed = claim_refreshes(names, refreshing, app.config["REFRESH_QUEUE_SIZE"])
+    if len(claimed) < len(names):
+        app.logger.info("Not refreshing %d users that are already queued, or don't fit", len(names) - len(claimed))
+
+    if len(claimed) == 0:
+        return
+
+    def _done(task: asyncio.Future):
+        aio["refreshes"].discard(task)
+        refreshing.difference_update(normalize_name(n) for n in claimed)
+
+    refresh = asyncio.ensure_future(refresh_users(aio, claimed))
+    aio["refreshes"].add(refresh)
+    refresh.add_done_callback(_done)
+
+
+async def read_guesses(
+    aio: web.Application,
+    ids: Sequence[str],
+    deadline: float
+) -> Tuple[Optional[str], List[Optional[Dict]]]:
+    """Count a lookup of each of these users, and return the current model version and their cached guesses.
+
+    Behaves like sockpuppet.api.v1.read_guesses.
+    """
+    app = aio["flask"]  # type: Flask
+
+    model_version = await get_model_version(
+        aio, min(app.config["SOCK_TIMEOUT"], remaining_ms(deadline))
+    )  # type: Optional[str]
+    with stage("cache"):
+        cached = await _in_app_context(app, get_cached_guesses, ids, model_version, True)
+
+    return model_version, cached
+
+
+async def guess_users(aio: web.Application, ids: Sequence[str]) -> List[Guess]:
+    """Guess the status of each of these users, within a REQUEST_DEADLINE budget.
+
+    Behaves like sockpuppet.api.v1.guess_users.
+    """
+    app = aio["flask"]  # type: Flask
+    deadline = time.monotonic() + (app.config["REQUEST_DEADLINE"] / 1000)
+    model_version, cached = await read_guesses(aio, ids, deadline)
+
+    return await resolve_guesses(aio, ids, model_version, cached, deadline)
+
+
+async def resolve_guesses(
+    aio: web.Application,
+    ids: Sequence[str],
+    model_version: Optional[str],
+    cached: Sequence[Optional[Dict]],
+    deadline: float
+) -> List[Guess]:
+    """Fill in the guesses of the users in ids that weren't cached, given what read_guesses returned.
+
+    Behaves like sockpuppet.api.v1.resolve_guesses.
+    """
+    app = aio["flask"]  # type: Flask
+    guesses, misses, stale = sort_cached(ids, cached)
+
+    if len(stale) > 0:
+        schedule_refresh(aio, [ids[index] for index in stale])
+
+    misses, copies = dedupe_misses(ids, misses)
+    leased, waiting = split_leased(ids, misses, await _in_app_context(
+        app, acquire_leases, [ids[m] for m in misses], app.config["GUESS_LEASE_TIMEOUT"]
+    ))
+    if len(waiting) > 0:
+        # Someone else is already looking these users up, so share their results instead of repeating their work
+        with stage("wait"):
+            shared = await wait_for_guesses(
+                aio,
+                [ids[w] for w in waiting],
+                model_version,
+                min(app.config["GUESS_LEASE_WAIT"], remaining_ms(deadline))
+            )
+        take_shared(ids, guesses, waiting, shared)
+
+        # Whatever didn't arrive in time, we'll just have to look up ourselves
+        misses = [index for index in misses if guesses[index] is None]
+
+    looked_up = await lookup_users(
+        aio, [ids[m] for m in misses], model_version, deadline, leased=[ids[index] for index in leased]
+    )  # type: List[Guess]
+    for index, guess in zip(misses, looked_up):
+        guesses[index] = guess
+
+    fan_out(ids, guesses, copies)
+    count_verdicts(guesses)
+
+    return guesses
+
+
+def timed_response(
+    request: web.Request,
+    query_response: Union[Dict, List[Dict]],
+    timing: ServerTiming
+) -> web.Response:
+    """Serialize a successful JSON-RPC response, with a Server-Timing header.
+
+    Behaves like sockpuppet.api.v1.timed_response.
+    """
+    add_timing_meta(request.app["flask"].config, query_response, timing)
+
+    with stage("serialize"):
+        response = _json_response(query_response, HTTPStatus.OK)
+
+    response.headers["Server-Timing"] = timing.as_header()
+
+    return response
+
+
+async def make_guess(
+    request: web.Request,
+    ids: Sequence[str],
+    response_id: int,
+    conditional: bool=False
+) -> web.Response:
+    """Answer a request for these users' guesses.
+
+    Behaves like sockpuppet.api.v1.make_guess.
+    """
+    aio = request.app  # type: web.Application
+    app = aio["flask"]  # type: Flask
+
+    with collect_timing() as timing:
+        with stage("validate"):
+            error = check_request(request, response_id)  # type: Optional[web.Response]
+
+        if error is not None:
+            return error
+
+        if not conditional:
+            return timed_response(request, guess_response(response_id, await guess_users(aio, ids)), timing)
+
+        deadline = time.monotonic() + (app.config["REQUEST_DEADLINE"] / 1000)
+        model_version, cached = await read_guesses(aio, ids, deadline)
+        validators = cache_validators(ids, cached, model_version)  # type: Optional[Validators]
+        guesses = await resolve_guesses(aio, ids, model_version, cached, deadline)
+
+        if is_not_modified(validators, request.headers.get("If-None-Match"), request.headers.get("If-Modified-Since")):
+            # Everyone was cached, so nothing was scraped or scored
+            response = web.Response(status=HTTPStatus.NOT_MODIFIED, headers=cache_headers(validators))
+            response.headers["Server-Timing"] = timing.as_header()
+            return response
+
+        if validators is None:
+            # Users looked up just now have only just been cached, and those we couldn't get to in time weren't
+            # re-reading everyone costs the same single round trip as re-reading just them
+            cached = await _in_app_context(app, get_cached_guesses, ids, model_version)
+            validators = cache_validators(ids, cached, model_version, uncacheable=(UNKNOWN,))
+
+        response = timed_response(request, guess_response(response_id, guesses), timing)
+        response.headers.update(cache_headers(validators))
+
+        return response
+
+
+async def make_batch_guess(request: web.Request, batch: Sequence[Dict]) -> web.Response:
+    """Answer a JSON-RPC batch of guess requests with one pass over every user any of them asks about.
+
+    Behaves like sockpuppet.api.v1.make_batch_guess.
+    """
+    with collect_timing() as timing:
+        with stage("validate"):
+            error = check_request(request, None)  # type: Optional[web.Response]
+
+        if error is not None:
+            return error
+
+        users = batch_users(batch)  # type: Dict[str, str]
+        guesses = await guess_users(request.app, list(users.values()))
+
+        return timed_response(request, batch_responses(batch, users, guesses), timing)
+
+
+async def get_user(request: web.Request, ids: Sequence[str]) -> web.Response:
+    response_id = randint(MIN_JSON_INT, MAX_JSON_INT)
+
+    app = request.app["flask"]  # type: Flask
+    app.logger.info("Received GET request for %s", ids)
+    guesses = await make_guess(request, ids, response_id, conditional=True)
+    app.logger.info("Done")
+    return guesses
+
+
+async def post_user(request: web.Request) -> web.Response:
+    try:
+        json = await request.json()  # type: Union[Dict, List[Dict]]
+    except ValueError:
+        return _error_response(None, JSONRPCParseError.CODE, JSONRPCParseError.MESSAGE, HTTPStatus.BAD_REQUEST)
+
+    if isinstance(json, list):
+        return await make_batch_guess(request, json)
+
+    if not isinstance(json, dict):
+        # The spec can't say "an object or an array", so other JSON values get past its validation
+        return _error_response(None, JSONRPCInvalidRequest.CODE, JSONRPCInvalidRequest.MESSAGE, HTTPStatus.BAD_REQUEST)
+
+    ids = json["params"]["ids"]
+    response_id = json["id"]
+
+    return await make_guess(request, ids, response_id)
+
+
+@web.middleware
+async def measure_request(request: web.Request, handler: Callable) -> web.StreamResponse:
+    """Time every request except Prometheus's own scrapes, the way sockpuppet.app.register_metrics does."""
+    if request.path == "/metrics":
+        return await handler(request)
+
+    started = time.perf_counter()
+    status = HTTPStatus.INTERNAL_SERVER_ERROR
+    try:
+        with IN_FLIGHT.labels("request").track_inprogress():
+            response = await handler(request)  # type: web.StreamResponse
+            status = response.status
+
+        return response
+    except web.HTTPException as e:
+        status = e.status
+        raise
+    finally:
+        REQUEST_SECONDS.labels(request.method, status).observe(time.perf_counter() - started)
+
+
+async def get_metrics(request: web.Request) -> web.Response:
+    return web.Response(body=metrics.collect(), headers={"Content-Type": CONTENT_TYPE_LATEST})
+
+
+@web.middleware
+async def wrap_errors(request: web.Request, handler: Callable) -> web.StreamResponse:
+    """Wrap error responses that aren't already JSON-RPC (e.g. from connexion's validation) in a JSON-RPC envelope, the
+    way sockpuppet.app.register_errorhandlers does.
+    """
+    try:
+        response = await handler(request)  # type: web.StreamResponse
+    except web.HTTPException as e:
+        response = e
+
+    if response.status in NO_ENVELOPE_STATUSES or isinstance(response, JSONRPCResponse):
+        return response
+
+    body = response.body if isinstance(response, web.Response) and isinstance(response.body, bytes) else b""
+    is_json = response.content_type == "application/json" or response.content_type.endswith("+json")
+
+    return JSONRPCResponse(
+        body=serialization.wrapped_error_body(body, is_json), status=response.status, content_type="application/json"
+    )
@@ -0,0 +1,520 @@
+# -*- coding: utf-8 -*-
+"""Caching of computed guesses and the tweets they were computed from, keyed by normalized username.
+
+Tweets and guesses are cached separately so that a newly-deployed model can re-score users from their cached tweets
+without scraping Twitter again.  Each cached guess is tagged with the version of the model that made it.
+
+Each cached guess also records when it goes stale, well before it expires.  A stale guess is still served, but its
+user is looked up again in the background; only once it has expired does a request have to wait for a new one.
+
+Every lookup of a user also counts toward their popularity, kept in a Redis sorted set, so that the most-requested
+users can be kept warm by the ``refresh`` command.
+
+Looking up a user that isn't cached takes a short-lived lease on them, so that when many requests (on any worker or
+node) ask about the same user at once, only one of them scrapes and scores that user and the rest wait for its result.
+
+Guesses are read and written for many users at once, so that a request costs one round trip to Redis however many
+users it asks about.  Each worker also keeps the guesses it used most recently in memory for a few seconds, so that
+the most-requested users don't cost a round trip at all.  Whenever a guess is cached, every worker is told to forget
+its copy.
+
+Values are stored in Redis in a compact binary encoding (see sockpuppet.api.codec) rather than pickled by
+Flask-Caching, though pickled values cached before then are still read.  Caches not backed by Redis keep values as
+they are.
+"""
+import itertools
+import math
+import os
+import pickle
+import time
+from threading import Lock, Thread
+from typing import Any, Dict, List, Optional, Sequence, Tuple, Union
+
+from flask import Flask, current_app
+from redis import Redis, RedisError
+from redis.client import Pipeline
+
+from sockpuppet.api.codec import decode, encode, parse_header
+from sockpuppet.api.lru import LRUCache
+from sockpuppet.extensions import cache
+from sockpuppet.metrics import CACHE_LOOKUPS
+
+GUESS_KEY = "guess:user:{}"
+TWEETS_KEY = "tweets:user:{}"
+LEASE_KEY = "lease:user:{}"
+POPULARITY_KEY = "popularity:users"
+INVALIDATE_CHANNEL = "invalidate:guess"
+
+_local = None  # type: Optional[LRUCache]
+_local_pid = None  # type: Optional[int]
+_local_lock = Lock()
+
+
+def normalize_name(name: str) -> str:
+    """Usernames are case-insensitive and may be prefixed with @, so strip both differences away."""
+    return name.lstrip("@").lower()
+
+
+def _redis() -> Optional[Redis]:
+    """The Redis client behind the cache, or None if the cache isn't backed by Redis."""
+    return getattr(cache.cache, "_client", None)
+
+
+def _redis_key(key: str) -> str:
+    """The key that the cache would actually use in Redis for key."""
+    return getattr(cache.cache, "key_prefix", "") + key
+
+
+def _decode(key: str, data: Optional[bytes]) -> Optional[Any]:
+    app = current_app  # type: Flask
+
+    if data is None:
+        return None
+
+    try:
+        return decode(data)
+    except ValueError as e:
+        # Treat it as a miss, so that it's overwritten with something we can read
+        app.logger.warning("Failed to decode %s from the cache: %s", key, e)
+        return None
+
+
+def _get(key: str) -> Optional[Any]:
+    return _get_many([key])[0]
+
+
+def _get_many(keys: Sequence[str], lookups: Sequence[str]=()) -> List[Optional[Any]]:
+    """Read all of these keys at once (with a single MGET, if the cache is backed by Redis).
+
+    :param lookups: Users to count a lookup of, as record_lookups does, in the same round trip.
+    """
+    app = current_app  # type: Flask
+    client = _redis()  # type: Optional[Redis]
+
+    if len(keys) == 0:
+        return []
+
+    try:
+        if client is None:
+            values = list(cache.get_many(*keys))  # type: List[Optional[Any]]
+        else:
+            pipeline = client.pipeline(transaction=False)
+            pipeline.mget([_redis_key(k) for k in keys])
+            _count_lookups(pipeline, lookups)
+            values = [_decode(k, v) for k, v in zip(keys, pipeline.execute()[0])]
+    except RedisError as e:
+        # A broken cache shouldn't take the API down with it
+        app.logger.warning("Failed to read %s from the cache: %s", ", ".join(keys), e)
+        return [None] * len(keys)
+
+    app.logger.info(
+        "Cache hits for %s, misses for %s",
+        ", ".join(k for k, v in zip(keys, values) if v is not None) or "nobody",
+        ", ".join(k for k, v in zip(keys, values) if v is None) or "nobody"
+    )
+    return values
+
+
+def _listen_for_invalidations(app: Flask, client: Redis, local: LRUCache):
+    """Forget the local copy of each guess that another worker (or node) announces it has cached anew."""
+    while True:
+        try:
+            pubsub = client.pubsub(ignore_subscribe_messages=True)
+            pubsub.subscribe(_redis_key(INVALIDATE_CHANNEL))
+            # Anything announced while we weren't listening was missed, so start over
+            local.clear()
+
+            for message in pubsub.listen():
+                local.delete_many([message["data"].decode("utf-8")])
+        except RedisError as e:
+            app.logger.warning("Lost the guess invalidation channel, resubscribing: %s", e)
+            local.clear()
+            time.sleep(1)
+
+
+def _local_guesses() -> Optional[LRUCache]:
+    """This worker's in-memory tier of recently-used guesses, or None if LOCAL_CACHE_SIZE turns it off.
+
+    Each process makes its own the first time it needs it (forked workers mustn't share their parent's), and starts
+    listening for invalidations if the cache is backed by Redis.
+    """
+    global _local, _local_pid
+
+    if _local_pid == os.getpid():
+        return _local
+
+    app = current_app._get_current_object()  # type: Flask
+    with _local_lock:
+        if _local_pid != os.getpid():
+            size = app.config["LOCAL_CACHE_SIZE"]  # type: int
+            _local = LRUCache(size, app.config["LOCAL_CACHE_TIMEOUT"]) if size > 0 else None
+            _local_pid = os.getpid()
+
+            client = _redis()  # type: Optional[Redis]
+            if _local is not None and client is not None:
+                Thread(
+                    target=_listen_for_invalidations,
+                    args=(app, client, _local),
+                    name="sockdrawer-invalidations",
+                    daemon=True
+                ).start()
+
+    return _local
+
+
+def _set(key: str, value: Any, timeout: int):
+    app = current_app  # type: Flask
+    client = _redis()  # type: Optional[Redis]
+
+    try:
+        if client is None:
+            cache.set(key, value, timeout=timeout)
+        else:
+            # Keyword arguments, because redis-py 3 swapped the order of value and time
+            client.setex(name=_redis_key(key), value=encode(value), time=timeout)
+    except RedisError as e:
+        app.logger.warning("Failed to write %s to the cache: %s", key, e)
+
+
+def _current_guess(entry: Optional[Dict], model_version: Optional[str]) -> Optional[Dict]:
+    return entry if entry is not None and entry.get("model") == model_version else None
+
+
+def get_cached_guess(name: str, model_version: Optional[str]) -> Optional[Dict]:
+    """Return the cached guess for this user, or None if there isn't one or it was made by a different model."""
+    return get_cached_guesses([name], model_version)[0]
+
+
+def get_cached_guesses(
+    names: Sequence[str],
+    model_version: Optional[str],
+    count_lookups: bool=False
+) -> List[Optional[Dict]]:
+    """Return the cached guess for each of these users, in the same order, as get_cached_guess would.
+
+    Guesses this worker has used recently are served from memory, and all the others are read in one round trip.
+
+    :param count_lookups: If True, also count a lookup of each user as record_lookups does, in that same round trip.
+    """
+    app = current_app  # type: Flask
+    local = _local_guesses()  # type: Optional[LRUCache]
+    keys = [GUESS_KEY.format(normalize_name(n)) for n in names]
+    lookups = names if count_lookups else ()  # type: Sequence[str]
+
+    if local is None:
+        return [_current_guess(e, model_version) for e in _get_many(keys, lookups)]
+
+    entries = local.get_many(keys)  # type: List[Optional[Dict]]
+    misses = [index for index, e in enumerate(entries) if e is None]  # type: List[int]
+    CACHE_LOOKUPS.labels("local_guess", "hit").inc(len(keys) - len(misses))
+    CACHE_LOOKUPS.labels("local_guess", "miss").inc(len(misses))
+
+    if len(misses) > 0:
+        fetched = _get_many([keys[m] for m in misses], lookups)  # type: List[Optional[Dict]]
+        for index, entry in zip(misses, fetched):
+            entries[index] = entry
+
+        local.set_many(
+            (keys[index], entry, app.config["LOCAL_CACHE_TIMEOUT"])
+            for index, entry in zip(misses, fetched) if entry is not None
+        )
+    elif len(lookups) > 0:
+        # Nothing to read from Redis, but popularity is still kept there
+        record_lookups(lookups)
+
+    return [_current_guess(e, model_version) for e in entries]
+
+
+def is_stale(entry: Dict, within: float=0) -> bool:
+    """Whether this cached guess is (or will be within the given number of seconds) old enough to look up again."""
+    # Entries cached before guesses could go stale don't know when they do, so they'll just expire
+    return time.time() + within >= entry.get("stale", math.inf)
+
+
+def set_cached_guess(name: str, status: str, model_version: Optional[str], timeout: int, soft_timeout: int):
+    """Cache the status of this user, as determined by the given model, for timeout seconds.
+
+    The guess goes stale after soft_timeout seconds.
+    """
+    set_cached_guesses([(name, status, timeout, soft_timeout)], model_version)
+
+
+def set_cached_guesses(guesses: Sequence[Tuple[str, str, int, int]], model_version: Optional[str]):
+    """Cache the status of each of these users, as set_cached_guess would.
+
+    Each guess is a tuple of the user's name, their status, and its timeout and soft timeout.  If the cache is backed
+    by Redis, every guess is written (each with its own expiry) in one pipelined round trip, which also tells every
+    worker to forget its old copy.
+    """
+    app = current_app  # type: Flask
+    client = _redis()  # type: Optional[Redis]
+    local = _local_guesses()  # type: Optional[LRUCache]
+    now = time.time()
+
+    if len(guesses) == 0:
+        return
+
+    entries = [
+        (GUESS_KEY.format(normalize_name(name)), {
+            "status": status,
+            "model": model_version,
+            "time": now,
+            "stale": now + soft_timeout,
+        }, timeout) for name, status, timeout, soft_timeout in guesses
+    ]  # type: List[Tuple[str, Dict, int]]
+
+    if client is None:
+        for key, entry, timeout in entries:
+            _set(key, entry, timeout)
+    else:
+        try:
+            pipeline = client.pipeline(transaction=False)
+            for key, entry, timeout in entries:
+                # Keyword arguments, because redis-py 3 swapped the order of value and time
+                pipeline.setex(name=_redis_key(key), value=encode(entry), time=timeout)
+                pipeline.publish(_redis_key(INVALIDATE_CHANNEL), key)
+            pipeline.execute()
+        except RedisError as e:
+            app.logger.warning("Failed to write %s to the cache: %s", ", ".join(k for k, _, _ in entries), e)
+
+    if local is not None:
+        # Other workers hear about it from the channel, but this one shouldn't have to wait to
+        local.delete_many(k for k, _, _ in entries)
+
+
+def get_cached_tweets(name: str) -> Optional[Sequence[str]]:
+    """Return the text of this user's cached tweets, newest first, or None if there aren't any."""
+    entry = _get(TWEETS_KEY.format(normalize_name(name)))  # type: Union[Dict, Sequence[str], None]
+
+    if isinstance(entry, dict):
+        return tuple(text for _, text in entry["tweets"])
+
+    # Tweets cached before timelines were kept are just their text
+    return entry
+
+
+def get_cached_timeline(name: str) -> Optional[Dict]:
+    """Return this user's cached timeline, or None if there isn't one.
+
+    A timeline is a dict of the id of the newest tweet ever seen from the user (``newest``, their high-water mark) and
+    their most recent tweets as [id, text] pairs, newest first (``tweets``).  Tweets cached before timelines were kept
+    don't have ids, so they don't count.
+    """
+    entry = _get(TWEETS_KEY.format(normalize_name(name)))  # type: Union[Dict, Sequence[str], None]
+
+    return entry if isinstance(entry, dict) else None
+
+
+def set_cached_timeline(name: str, timeline: Dict, timeout: int):
+    """Cache the timeline of this user for timeout seconds."""
+    _set(TWEETS_KEY.format(normalize_name(name)), timeline, timeout)
+
+
+def acquire_lease(name: str, timeout: int) -> bool:
+    """Try to take the lease on looking up this user, which lapses after timeout seconds if it isn't released.
+
+    Returns False if someone else already holds it.  If the cache can't be reached, nobody can coordinate anyway, so
+    the lease is assumed to be ours.
+    """
+    return len(acquire_leases([name], timeout)) > 0
+
+
+def acquire_leases(names: Sequence[str], timeout: int) -> List[str]:
+    """Try to take the lease on looking up each of these users, as acquire_lease does, and return those we got in the
+    same order.
+
+    All of them are tried in one round trip.
+    """
+    app = current_app  # type: Flask
+    client = _redis()  # type: Optional[Redis]
+    keys = [LEASE_KEY.format(normalize_name(n)) for n in names]
+
+    if len(names) == 0:
+        return []
+
+    try:
+        if client is None:
+            return [n for n, k in zip(names, keys) if cache.add(k, True, timeout=timeout)]
+
+        pipeline = client.pipeline(transaction=False)
+        for key in keys:
+            pipeline.set(_redis_key(key), encode(True), ex=timeout, nx=True)
+
+        return [n for n, taken in zip(names, pipeline.execute()) if taken]
+    except RedisError as e:
+        app.logger.warning("Failed to take the leases on %s: %s", ", ".join(names), e)
+        return list(names)
+
+
+def release_leases(names: Sequence[str]):
+    """Give up the leases on these users, so that anyone waiting on them stops waiting."""
+    app = current_app  # type: Flask
+
+    if len(names) == 0:
+        return
+
+    try:
+        cache.delete_many(*(LEASE_KEY.format(normalize_name(n)) for n in names))
+    except RedisError as e:
+        # They'll lapse on their own soon enough
+        app.logger.warning("Failed to release the leases on %s: %s", ", ".join(names), e)
+
+
+def poll_leased_guesses(names: Sequence[str], model_version: Optional[str]) -> List[Tuple[Optional[Dict], bool]]:
+    """Check once on users whose leases are held by someone else.
+
+    Returns, for each user, their cached guess (or None if it hasn't arrived) and whether it's still worth waiting for.
+    It isn't once the guess arrives or once the lease is given up without one, e.g. because the lookup failed.
+    """
+    # Every guess and lease is checked in one round trip; a lease that can't be read is treated as given up
+    values = _get_many(
+        [GUESS_KEY.format(normalize_name(n)) for n in names] + [LEASE_KEY.format(normalize_name(n)) for n in names]
+    )  # type: List[Optional[Any]]
+    guesses = [_current_guess(v, model_version) for v in values[:len(names)]]  # type: List[Optional[Dict]]
+    leases = values[len(names):]  # type: List[Optional[bool]]
+
+    return [(guess, guess is None and lease is not None) for guess, lease in zip(guesses, leases)]
+
+
+def wait_for_guesses(
+    names: Sequence[str],
+    model_version: Optional[str],
+    wait: int,
+    interval: int
+) -> List[Optional[Dict]]:
+    """Wait up to wait milliseconds for whoever holds these users' leases to cache guesses for them.
+
+    Checks every interval milliseconds.  Returns each user's guess, or None for those that didn't arrive in time.
+    """
+    deadline = time.monotonic() + (wait / 1000)
+    guesses = [None] * len(names)  # type: List[Optional[Dict]]
+    pending = list(range(len(names)))  # type: List[int]
+
+    while True:
+        pending = take_polled(guesses, pending, poll_leased_guesses([names[p] for p in pending], model_version))
+        if len(pending) == 0 or time.monotonic() >= deadline:
+            return guesses
+
+        time.sleep(interval / 1000)
+
+
+def take_polled(
+    guesses: List[Optional[Dict]],
+    pending: Sequence[int],
+    polled: Sequence[Tuple[Optional[Dict], bool]]
+) -> List[int]:
+    """Fill in what poll_leased_guesses found for the users at these indices of guesses, and return the indices of
+    those still worth waiting for.
+    """
+    for index, (guess, _) in zip(pending, polled):
+        guesses[index] = guess
+
+    return [index for index, (_, waiting) in zip(pending, polled) if waiting]
+
+
+def record_lookups(names: Sequence[str]):
+    """Count a lookup of each of these users toward their popularity.
+
+    Does nothing if the cache isn't backed by Redis.
+    """
+    app = current_app  # type: Flask
+    client = _redis()  # type: Optional[Redis]
+
+    if client is None or len(names) == 0:
+        return
+
+    try:
+        pipeline = client.pipeline(transaction=False)
+        _count_lookups(pipeline, names)
+        pipeline.execute()
+    except RedisError as e:
+        app.logger.warning("Failed to record lookups of %s: %s", ", ".join(names), e)
+
+
+def _count_lookups(pipeline: Pipeline, names: Sequence[str]):
+    for name in names:
+        # Keyword arguments, because redis-py 3 swapped the order of value and amount
+        pipeline.zincrby(name=_redis_key(POPULARITY_KEY), value=normalize_name(name), amount=1)
+
+
+def get_popular_users(count: int) -> List[str]:
+    """Return the normalized names of the count most popular users, most popular first."""
+    client = _redis()  # type: Optional[Redis]
+
+    if client is None:
+        return []
+
+    return [n.decode("utf-8") for n in client.zrevrange(_redis_key(POPULARITY_KEY), 0, count - 1)]
+
+
+def decay_popularity(factor: float, keep: int):
+    """Scale every user's popularity by factor, and forget all but the keep most popular users.
+
+    Decaying makes old lookups count for less than new ones, and forgetting keeps the set from growing forever.
+    """
+    client = _redis()  # type: Optional[Redis]
+
+    if client is None:
+        return
+
+    key = _redis_key(POPULARITY_KEY)
+    pipeline = client.pipeline(transaction=True)
+    pipeline.zunionstore(key, {key: factor})
+    pipeline.zremrangebyrank(key, 0, -(keep + 1))
+    pipeline.execute()
+
+
+def measure_usage(sample: int, migrate: bool=False) -> Dict[str, Dict[str, int]]:
+    """Compare how much room cached guesses and tweets take in Redis with how much they'd take if they were pickled.
+
+    Up to sample entries of each are read.  Returns, for each, how many were read, how many of those are still
+    pickled, and their total size in bytes both pickled and encoded.  Returns nothing if the cache isn't backed by
+    Redis.
+
+    :param migrate: If True, also rewrite the pickled entries that were read in the compact encoding, keeping the
+        time they have left to live.
+    """
+    client = _redis()  # type: Optional[Redis]
+    usage = {}  # type: Dict[str, Dict[str, int]]
+
+    if client is None:
+        return usage
+
+    for kind, pattern in (("guess", GUESS_KEY), ("tweets", TWEETS_KEY)):
+        keys = list(itertools.islice(client.scan_iter(match=_redis_key(pattern.format("*")), count=1000), sample))
+        stats = usage[kind] = {"entries": 0, "legacy": 0, "pickled": 0, "encoded": 0, "migrated": 0}
+        legacy = []  # type: List[Tuple[bytes, bytes]]
+
+        for key, data in zip(keys, client.mget(keys) if len(keys) > 0 else []):
+            try:
+                value = decode(data) if data is not None else None
+            except ValueError:
+                continue
+
+            if value is None:
+                continue
+
+            encoded = encode(value)
+            stats["entries"] += 1
+            # Measured the way Flask-Caching pickled them
+            stats["pickled"] += 1 + len(pickle.dumps(value, pickle.HIGHEST_PROTOCOL))
+            stats["encoded"] += len(encoded)
+            if parse_header(data)[0] is None:
+                stats["legacy"] += 1
+                legacy.append((key, encoded))
+
+        if migrate and len(legacy) > 0:
+            pipeline = client.pipeline(transaction=False)
+            for key, _ in legacy:
+                pipeline.pttl(key)
+            ttls = pipeline.execute()  # type: List[int]
+
+            pipeline = client.pipeline(transaction=False)
+            for (key, encoded), ttl in zip(legacy, ttls):
+                # Entries that have expired since (or never would) are left alone
+                if ttl is not None and ttl > 0:
+                    pipeline.set(key, encoded, px=ttl, xx=True)
+                    stats["migrated"] += 1
+            pipeline.execute()
+
+    return usage
@@ -0,0 +1,124 @@
+# -*- coding: utf-8 -*-
+"""The compact binary encoding of everything cached in Redis.
+
+Each value is packed with msgpack and, if it's big enough to be worth it, compressed with zstd (if it's installed) or
+zlib.  A four-byte header says which encoding and compression were used, so either can change without invalidating
+what's already cached.
+
+Values that Flask-Caching pickled before this encoding was introduced start with ``!``, which no header does, so they
+can still be read until they expire (or are rewritten by the ``cache-usage --migrate`` command).
+"""
+import pickle
+import zlib
+from typing import Any, Callable, Dict, Optional, Tuple
+
+import msgpack
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+MAGIC = b"\x00SD"
+VERSION = 1
+HEADER_SIZE = len(MAGIC) + 1
+LEGACY_PREFIX = b"!"  # Flask-Caching's (and werkzeug's) marker for a pickled value
+
+NONE = 0
+ZLIB = 1
+ZSTD = 2
+
+COMPRESS_MIN_SIZE = 128  # Bytes; smaller values barely shrink, and aren't worth the time
+
+COMPRESSORS = {"zlib": ZLIB}  # type: Dict[str, int]
+if zstandard is not None:
+    COMPRESSORS["zstd"] = ZSTD
+
+_compression = COMPRESSORS.get("zstd", ZLIB)  # type: int
+
+
+def _compress(compression: int) -> Callable[[bytes], bytes]:
+    if compression == ZSTD:
+        return zstandard.ZstdCompressor(level=3).compress
+
+    return lambda data: zlib.compress(data, 6)
+
+
+def _decompress(compression: int) -> Callable[[bytes], bytes]:
+    if compression == ZSTD:
+        if zstandard is None:
+            raise ValueError("Cached value is compressed with zstd, which isn't installed")
+
+        return zstandard.ZstdDecompressor().decompress
+
+    if compression == ZLIB:
+        return zlib.decompress
+
+    raise ValueError(f"Cached value is compressed with unknown method {compression}")
+
+
+def use_compression(name: str):
+    """Compress cached values with the named method from now on; "auto" picks the best one that's installed.
+
+    Values are always readable whatever they were compressed with, as long as it's installed.
+
+    :raises ValueError: if there's no such method, or it isn't installed.
+    """
+    global _compression
+
+    if name == "auto":
+        name = "zstd" if "zstd" in COMPRESSORS else "zlib"
+
+    if name not in COMPRESSORS:
+        raise ValueError(f"Cache compression {name} isn't available, choose from auto, {', '.join(COMPRESSORS)}")
+
+    _compression = COMPRESSORS[name]
+
+
+def encode(value: Any) -> bytes:
+    """Encode a value for the cache: msgpack, compressed if it's big enough, behind a header."""
+    packed = msgpack.packb(value, use_bin_type=True)
+
+    if len(packed) < COMPRESS_MIN_SIZE:
+        return MAGIC + bytes((VERSION << 4 | NONE,)) + packed
+
+    return MAGIC + bytes((VERSION << 4 | _compression,)) + _compress(_compression)(packed)
+
+
+def decode(data: bytes) -> Any:
+    """Decode a value from the cache, whether it was encoded by encode or pickled by Flask-Caching.
+
+    Sequences come back as lists, whatever they were cached as.
+
+    :raises ValueError: if the value can't be decoded.
+    """
+    version, compression = parse_header(data)
+    if version is not None and version != VERSION:
+        raise ValueError(f"Cached value has unknown encoding version {version}")
+
+    try:
+        if version is None:
+            return pickle.loads(data[len(LEGACY_PREFIX):])
+
+        packed = data[HEADER_SIZE:] if compression == NONE else _decompress(compression)(data[HEADER_SIZE:])
+
+        return msgpack.unpackb(packed, raw=False)
+    except ValueError:
+        raise
+    except Exception as e:
+        # Corrupt data can make pickle, msgpack and the decompressors raise just about anything
+        raise ValueError(f"Cached value is corrupt: {e}") from e
+
+
+def parse_header(data: bytes) -> Tuple[Optional[int], int]:
+    """Return the encoding version and compression of a cached value, or (None, NONE) if it's a legacy pickle.
+
+    :raises ValueError: if it's neither.
+    """
+    if data.startswith(MAGIC) and len(data) >= HEADER_SIZE:
+        return data[len(MAGIC)] >> 4, data[len(MAGIC)] & 0x0F
+
+    if data.startswith(LEGACY_PREFIX):
+        return None, NONE
+
+    raise ValueError("Cached value is neither encoded nor pickled")
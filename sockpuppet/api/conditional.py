@@ -0,0 +1,85 @@
+# -*- coding: utf-8 -*-
+"""HTTP validators for GET lookups, so that clients and CDNs can revalidate results instead of re-downloading them.
+
+A result is identified by the model version and each user's cached status, so its ETag stays the same for as long as
+all of those do.  It's a weak ETag, because every GET response gets a fresh JSON-RPC id.
+"""
+import calendar
+import hashlib
+import time
+from collections import namedtuple
+from typing import Dict, Optional, Sequence
+
+from werkzeug.http import http_date, parse_date, parse_etags, quote_etag
+
+from sockpuppet.api.cache import normalize_name
+
+Validators = namedtuple("Validators", ["etag", "last_modified", "max_age"])
+
+
+def cache_validators(
+    ids: Sequence[str],
+    entries: Sequence[Optional[Dict]],
+    model_version: Optional[str],
+    uncacheable: Sequence[str]=()
+) -> Optional[Validators]:
+    """Derive the validators of a result from the cached guess of each user in it.
+
+    Returns None if any user has no cached guess (or has one with a status in uncacheable), since a result like that
+    might be different next time.  Last-Modified is when the newest guess was made, and the result may be reused until
+    the first of them goes stale.
+    """
+    if any(e is None or e["status"] in uncacheable for e in entries):
+        return None
+
+    digest = hashlib.sha1(str(model_version).encode())
+    for i, entry in zip(ids, entries):
+        digest.update(f"\0{normalize_name(i)}\0{entry['status']}".encode())
+
+    # Entries cached before guesses had timestamps can't say when they were made or when they go stale
+    times = [e.get("time") for e in entries]
+    stale = [e.get("stale") for e in entries]
+
+    return Validators(
+        etag=digest.hexdigest(),
+        last_modified=None if None in times else max(times),
+        max_age=0 if None in stale else max(int(min(stale) - time.time()), 0)
+    )
+
+
+def is_not_modified(
+    validators: Optional[Validators],
+    if_none_match: Optional[str],
+    if_modified_since: Optional[str]
+) -> bool:
+    """Whether a request with these precondition headers can be answered with 304 Not Modified.
+
+    As RFC 7232 says, If-Modified-Since is only considered if there's no If-None-Match.
+    """
+    if validators is None:
+        return False
+
+    if if_none_match:
+        return parse_etags(if_none_match).contains_weak(validators.etag)
+
+    if if_modified_since and validators.last_modified is not None:
+        since = parse_date(if_modified_since)
+        # HTTP dates only go down to the second
+        return since is not None and int(validators.last_modified) <= calendar.timegm(since.utctimetuple())
+
+    return False
+
+
+def cache_headers(validators: Optional[Validators]) -> Dict[str, str]:
+    """The headers that tell clients how long they may reuse a result, and how to revalidate it."""
+    if validators is None:
+        return {"Cache-Control": "no-cache"}
+
+    headers = {
+        "ETag": quote_etag(validators.etag, weak=True),
+        "Cache-Control": f"public, max-age={validators.max_age}",
+    }
+    if validators.last_modified is not None:
+        headers["Last-Modified"] = http_date(validators.last_modified)
+
+    return headers
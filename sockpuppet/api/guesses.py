@@ -0,0 +1,328 @@
+# -*- coding: utf-8 -*-
+"""The steps of answering a guess request that the sync (sockpuppet.api.v1) and asyncio (sockpuppet.api.aio) request
+handlers share.
+
+None of these scrape, touch the cache or talk to the model server; each handler module does that itself, between
+these steps, in its own way.
+"""
+import itertools
+from collections import namedtuple
+from http import HTTPStatus
+from typing import Any, Dict, Iterable, List, Optional, Sequence, Set, Tuple, Union
+
+from flask import Config, Flask
+from werkzeug.datastructures import MIMEAccept
+
+from sockpuppet.api.cache import is_stale, normalize_name
+from sockpuppet.api.sources import ParseError
+from sockpuppet.metrics import CACHE_LOOKUPS, UPSTREAM_FAILURES, VERDICTS
+from sockpuppet.timing import ServerTiming
+
+Guess = namedtuple("Guess", ["status", "type", "id", ])
+# TODO: Subclass namedtuple
+
+
+BOT = "bot"
+HUMAN = "human"
+UNKNOWN = "unknown"
+UNAVAILABLE = "unavailable"
+# TODO: Use an Enum
+
+
+def verdict(scores: Sequence[float]) -> str:
+    """A user is a bot if the model thinks their tweets are bot-like on average, and unknown if they have none."""
+    if len(scores) == 0:
+        return UNKNOWN
+
+    return BOT if (sum(scores) / len(scores)) >= 0.5 else HUMAN
+
+
+def is_seen(tweet_id: str, pinned: bool, timeline: Optional[Dict], retweet: bool=False) -> bool:
+    """Whether a tweet is no newer than the newest one in this cached timeline, so neither is anything after it.
+
+    Pinned tweets come first whatever their age, so they don't count.  Neither do retweets, which are placed by when
+    they were retweeted but carry the id of the (often much older) original.
+    """
+    if timeline is None or timeline["newest"] is None or pinned or retweet:
+        return False
+
+    return int(tweet_id) <= int(timeline["newest"])
+
+
+def merge_timeline(fresh: Sequence[Tuple[str, str]], timeline: Optional[Dict], limit: int) -> Dict:
+    """Merge newly-scraped (id, text) pairs into a cached timeline, keeping the limit most recent tweets."""
+    tweets = {}  # type: Dict[str, str]
+    for tweet_id, text in itertools.chain(fresh, timeline["tweets"] if timeline is not None else ()):
+        tweets.setdefault(tweet_id, text)
+
+    # The high-water mark never goes down, even if the tweet that set it is deleted or pushed out of the window
+    seen = [int(i) for i, _ in fresh]
+    if timeline is not None and timeline["newest"] is not None:
+        seen.append(int(timeline["newest"]))
+
+    return {
+        "newest": str(max(seen)) if len(seen) > 0 else None,
+        "tweets": [list(t) for t in sorted(tweets.items(), key=lambda t: int(t[0]), reverse=True)[:limit]]
+    }
+
+
+def take_fresh(tweets: Iterable[Dict], timeline: Optional[Dict], limit: int, fresh: List[Tuple[str, str]]) -> bool:
+    """Add the (id, text) of each of these tweets to fresh, until one's already in this cached timeline or there are
+    limit of them.
+
+    Returns True if it stopped early, in which case there's no need to read any more of the user's timeline.
+    """
+    for t in tweets:
+        if is_seen(t["tweetId"], t.get("isPinned", False), timeline, t.get("isRetweet", False)):
+            # Timelines are newest first, so everything from here on has been seen already
+            return True
+
+        fresh.append((t["tweetId"], t["text"]))
+        if len(fresh) >= limit:
+            # Don't resume the scraper, or it'll fetch the next page before finding out we're done
+            return True
+
+    return False
+
+
+def record_fetch_failure(app: Flask, user: str, e: Exception, timeout: type):
+    """Count and log a failure to fetch this user's tweets, given the type of exception a timed-out scrape raises."""
+    UPSTREAM_FAILURES.labels(
+        "twitter",
+        "timeout" if isinstance(e, timeout) else "parse" if isinstance(e, ParseError) else "error"
+    ).inc()
+    app.logger.error("Failed to fetch tweets from %s: %s", user, e)
+
+
+def record_fetch_deadline(app: Flask, users: Sequence[str]):
+    """Count and log the fetches of these users' tweets that were still running when time ran out."""
+    UPSTREAM_FAILURES.labels("twitter", "deadline").inc(len(users))
+    app.logger.warning("Ran out of time fetching tweets from %s", ", ".join(users))
+
+
+def scorable(fetched: Dict[int, Optional[Sequence[str]]]) -> List[Tuple[int, Sequence[str]]]:
+    """The (index, tweets) of each user fetch_all_tweets returned who's worth scoring.
+
+    Users who are private or don't exist are left out, and so are users with no tweets, who have nothing to score.
+    """
+    return [(index, tweets) for index, tweets in fetched.items() if tweets is not None and len(tweets) > 0]
+
+
+def settle_guesses(
+    ids: Sequence[str],
+    fetched: Dict[int, Optional[Sequence[str]]],
+    scores: Dict[int, Sequence[float]],
+    config: Config
+) -> Tuple[List[Guess], List[Tuple[str, str, int, int]]]:
+    """Turn what was found out about each of these users into their guesses, and the (name, status, timeout, soft
+    timeout) of those worth caching.
+
+    fetched and scores are keyed by index in ids, as fetch_all_tweets and lookup_users have them.
+    """
+    guesses = []  # type: List[Guess]
+    to_cache = []  # type: List[Tuple[str, str, int, int]]
+    for index, i in enumerate(ids):
+        if index in scores:
+            guess = Guess(
+                id=str(i),
+                type="user",
+                status=verdict(scores[index])
+            )
+
+            to_cache.append((
+                i,
+                guess.status,
+                config["GUESS_CACHE_TIMEOUT"],
+                config["GUESS_CACHE_SOFT_TIMEOUT"]
+            ))
+        elif index in fetched and fetched[index] is None:
+            # The user is private or doesn't exist...
+            guess = Guess(
+                id=str(i),
+                type="user",
+                status=UNAVAILABLE
+            )
+
+            # Private accounts may be made public again, so don't remember them for as long
+            to_cache.append((
+                i,
+                guess.status,
+                config["GUESS_CACHE_UNAVAILABLE_TIMEOUT"],
+                config["GUESS_CACHE_UNAVAILABLE_SOFT_TIMEOUT"]
+            ))
+        else:
+            # We couldn't get to this user in time, but that's no reason to throw away everyone else's guesses
+            guess = Guess(
+                id=str(i),
+                type="user",
+                status=UNKNOWN
+            )
+
+        guesses.append(guess)
+
+    return guesses, to_cache
+
+
+def claim_refreshes(names: Sequence[str], refreshing: Set[str], limit: int) -> List[str]:
+    """Pick out which of these users to refresh, and add their normalized names to refreshing.
+
+    Users already in refreshing are skipped, as are any beyond the first limit in it.  Nothing is lost by skipping
+    them, since whichever request next finds their guesses stale will try again.
+    """
+    claimed = []  # type: List[str]
+    for name in names:
+        key = normalize_name(name)
+        if key not in refreshing and len(refreshing) < limit:
+            refreshing.add(key)
+            claimed.append(name)
+
+    return claimed
+
+
+def sort_cached(
+    ids: Sequence[str],
+    cached: Sequence[Optional[Dict]]
+) -> Tuple[List[Optional[Guess]], List[int], List[int]]:
+    """Split what read_guesses returned into guesses (None where there's no cached one), and the indices of the misses
+    and the stale guesses, counting each kind of lookup.
+    """
+    guesses = [None] * len(ids)  # type: List[Optional[Guess]]
+    misses = []  # type: List[int]
+    stale = []  # type: List[int]
+    for index, (i, entry) in enumerate(zip(ids, cached)):
+        if entry is not None:
+            guesses[index] = Guess(id=str(i), type="user", status=entry["status"])
+            if is_stale(entry):
+                stale.append(index)
+        else:
+            misses.append(index)
+
+    CACHE_LOOKUPS.labels("guess", "hit").inc(len(ids) - len(misses) - len(stale))
+    CACHE_LOOKUPS.labels("guess", "stale").inc(len(stale))
+    CACHE_LOOKUPS.labels("guess", "miss").inc(len(misses))
+
+    return guesses, misses, stale
+
+
+def dedupe_misses(ids: Sequence[str], misses: Sequence[int]) -> Tuple[List[int], Dict[int, int]]:
+    """Split the indices of the misses into the first spelling of each user, and a map from every other spelling's index
+    to the first's.
+
+    Names are case-insensitive, so each user is only leased and looked up once however many ways it's asked for.
+    """
+    firsts = {}  # type: Dict[str, int]
+    copies = {}  # type: Dict[int, int]
+    for index in misses:
+        copies[index] = firsts.setdefault(normalize_name(ids[index]), index)
+
+    return list(firsts.values()), {index: first for index, first in copies.items() if index != first}
+
+
+def fan_out(ids: Sequence[str], guesses: List[Optional[Guess]], copies: Dict[int, int]):
+    """Give every other spelling of a user the guess of its first, under the id it was asked for, as dedupe_misses
+    mapped them.
+    """
+    for index, first in copies.items():
+        guesses[index] = guesses[first]._replace(id=str(ids[index]))
+
+
+def split_leased(ids: Sequence[str], misses: Sequence[int], leased: Iterable[str]) -> Tuple[List[int], List[int]]:
+    """Split the indices of the misses into those whose leases we took (whose names are in leased), and those whose
+    leases someone else holds.
+    """
+    leased_names = frozenset(normalize_name(n) for n in leased)
+    ours = [index for index in misses if normalize_name(ids[index]) in leased_names]  # type: List[int]
+    theirs = sorted(frozenset(misses) - frozenset(ours))  # type: List[int]
+
+    return ours, theirs
+
+
+def split_late(
+    ids: Sequence[str],
+    leased: Sequence[str],
+    late: Dict[int, Any]
+) -> Tuple[List[str], List[Tuple[str, Any]]]:
+    """Split these leases into those to release now, and (name, fetch) pairs of those to release once the fetch of
+    their user, still running and keyed by its index in ids, is done.
+    """
+    running = {normalize_name(ids[index]): fetch for index, fetch in late.items()}  # type: Dict[str, Any]
+    now = [name for name in leased if normalize_name(name) not in running]  # type: List[str]
+    later = [(name, running[normalize_name(name)]) for name in leased if normalize_name(name) in running]
+
+    return now, later
+
+
+def take_shared(
+    ids: Sequence[str],
+    guesses: List[Optional[Guess]],
+    waiting: Sequence[int],
+    shared: Sequence[Optional[Dict]]
+):
+    """Fill in the guesses that whoever held the leases of the users at these indices cached, as wait_for_guesses
+    returned them.
+    """
+    for index, entry in zip(waiting, shared):
+        if entry is not None:
+            guesses[index] = Guess(id=str(ids[index]), type="user", status=entry["status"])
+
+
+def count_verdicts(guesses: Sequence[Guess]):
+    for guess in guesses:
+        VERDICTS.labels(guess.status).inc()
+
+
+def request_problem(
+    accept_mimetypes: MIMEAccept,
+    url: str,
+    config: Config
+) -> Optional[Tuple[int, str, HTTPStatus]]:
+    """The JSON-RPC error code, message and HTTP status to answer a request with if it can't be answered at all, or
+    None if it can.
+    """
+    if len(accept_mimetypes) > 0 and not accept_mimetypes.accept_json:
+        # If there's no Accept header, assume they'll take JSON...
+        # ...but if they provide it and don't...
+        return 406, "Not Acceptable", HTTPStatus.NOT_ACCEPTABLE
+
+    if len(url) > config["MAX_URL_LENGTH"]:
+        # TODO: Move this to BEFORE the URL is actually processed
+        return 414, "Request URI Too Long", HTTPStatus.REQUEST_URI_TOO_LONG
+
+    return None
+
+
+def guess_response(response_id: int, guesses: Sequence[Guess]) -> Dict:
+    return {
+        "jsonrpc": "2.0",
+        "id": response_id,
+        "result": guesses
+    }
+
+
+def add_timing_meta(config: Config, query_response: Union[Dict, List[Dict]], timing: ServerTiming):
+    """If SERVER_TIMING_META is set, give a single (not batched) response the timing breakdown in its ``meta`` field."""
+    if config["SERVER_TIMING_META"] and isinstance(query_response, dict):
+        query_response["meta"] = {"timing": timing.as_list()}
+
+
+def batch_users(batch: Sequence[Dict]) -> Dict[str, str]:
+    """Every user any entry of a JSON-RPC batch asks about, keyed by normalized name, so each is looked up once."""
+    users = {}  # type: Dict[str, str]
+    for entry in batch:
+        for i in entry["params"]["ids"]:
+            # Names are case-insensitive, so only look up the first spelling of each
+            users.setdefault(normalize_name(i), i)
+
+    return users
+
+
+def batch_responses(batch: Sequence[Dict], users: Dict[str, str], guesses: Sequence[Guess]) -> List[Dict]:
+    """One response per entry of a JSON-RPC batch, in the same order, given the guesses of what batch_users returned."""
+    statuses = dict(zip(users.keys(), (g.status for g in guesses)))  # type: Dict[str, str]
+
+    return [
+        guess_response(
+            entry["id"],
+            [Guess(id=str(i), type="user", status=statuses[normalize_name(i)]) for i in entry["params"]["ids"]]
+        ) for entry in batch
+    ]
@@ -0,0 +1,63 @@
+# -*- coding: utf-8 -*-
+"""A small in-process cache, for keeping the hottest entries of a shared cache within a worker's reach."""
+import time
+from collections import OrderedDict
+from threading import Lock
+from typing import Any, Hashable, Iterable, List, Optional, Tuple
+
+
+class LRUCache(object):
+    """A bounded, thread-safe map whose entries expire.
+
+    Once it holds maxsize entries, adding another evicts the one that was used least recently.  Entries expire timeout
+    seconds after they're set, unless they're set with a shorter timeout of their own.
+    """
+
+    def __init__(self, maxsize: int, timeout: float):
+        self.maxsize = maxsize
+        self.timeout = timeout
+        self._entries = OrderedDict()  # type: OrderedDict
+        self._lock = Lock()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def get_many(self, keys: Iterable[Hashable]) -> List[Optional[Any]]:
+        """Return the value of each of these keys, or None for those that aren't here (or have expired)."""
+        now = time.monotonic()
+        values = []  # type: List[Optional[Any]]
+
+        with self._lock:
+            for key in keys:
+                entry = self._entries.get(key)  # type: Optional[Tuple[float, Any]]
+                if entry is None:
+                    values.append(None)
+                elif entry[0] <= now:
+                    del self._entries[key]
+                    values.append(None)
+                else:
+                    self._entries.move_to_end(key)
+                    values.append(entry[1])
+
+        return values
+
+    def set_many(self, items: Iterable[Tuple[Hashable, Any, float]]):
+        """Remember each of these values under its key for its timeout in seconds, or this cache's if that's shorter."""
+        now = time.monotonic()
+
+        with self._lock:
+            for key, value, timeout in items:
+                self._entries[key] = (now + min(timeout, self.timeout), value)
+                self._entries.move_to_end(key)
+
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def delete_many(self, keys: Iterable[Hashable]):
+        with self._lock:
+            for key in keys:
+                self._entries.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
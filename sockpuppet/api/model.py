@@ -0,0 +1,174 @@
+# -*- coding: utf-8 -*-
+"""Client side of the JSON-RPC protocol spoken by the Sock model server."""
+import time
+from contextlib import contextmanager
+from typing import Any, Dict, Iterator, List, Optional, Sequence, Tuple
+
+import zmq
+from flask import Flask, current_app
+from flask_zmq import JSONRPCClient
+
+from sockpuppet.errors import ModelError
+from sockpuppet.extensions import zmq_socket
+from sockpuppet.metrics import IN_FLIGHT, MODEL_SECONDS, UPSTREAM_FAILURES
+from sockpuppet.timing import stage
+from sockpuppet.utils import remaining_ms
+
+METHOD_NOT_FOUND = -32601
+
+_model_version = None  # type: Optional[str]
+_model_version_expires = 0.0  # type: float
+
+
+def query_model(method: str, params: Any=None, timeout: Optional[int]=None) -> Dict:
+    """Send one JSON-RPC request to the model server and return its response.
+
+    :param timeout: How long to wait, in milliseconds; defaults to SOCK_TIMEOUT.
+    :raises TimeoutError: if the model server doesn't answer in time.
+    """
+    return query_model_many([JSONRPCClient.request(method, params)], timeout)[0]
+
+
+def query_model_many(requests: Sequence[Dict], timeout: Optional[int]=None) -> List[Dict]:
+    """Send several JSON-RPC requests to the model server at once and return their responses, in the same order.
+
+    :param timeout: How long to wait, in milliseconds; defaults to SOCK_TIMEOUT.
+    :raises TimeoutError: if the model server doesn't answer all of them in time.
+    """
+    app = current_app  # type: Flask
+    if timeout is None:
+        timeout = app.config["SOCK_TIMEOUT"]
+
+    try:
+        with model_round_trip(app, requests, timeout) as responses:
+            responses.extend(zmq_socket.client.call_many(requests, timeout))
+    except TimeoutError:
+        if zmq_socket.socket.type == zmq.REQ:
+            # A REQ socket that never got its reply can't send again, so don't let it go back to the pool
+            zmq_socket.discard()
+
+        raise
+
+    return responses
+
+
+@contextmanager
+def model_round_trip(app: Flask, requests: Sequence[Dict], timeout: int) -> Iterator[List[Dict]]:
+    """Log, time and count one round trip to the model server, whose responses the caller adds to the yielded list.
+
+    :raises TimeoutError: if the round trip times out.
+    """
+    app.logger.info("Sending %s to Sock", ", ".join(r["method"] for r in requests))
+    method = requests[0]["method"]  # type: str
+    responses = []  # type: List[Dict]
+    try:
+        with MODEL_SECONDS.labels(method).time(), IN_FLIGHT.labels("model").track_inprogress(), stage("model", method):
+            yield responses
+    except TimeoutError as e:
+        UPSTREAM_FAILURES.labels("model", "timeout").inc()
+        raise TimeoutError(f"Failed to get response from model server within {timeout}ms") from e
+
+    errors = sum(1 for r in responses if "error" in r)
+    if errors > 0:
+        UPSTREAM_FAILURES.labels("model", "error").inc(errors)
+
+    app.logger.info("Got response from Sock")
+
+
+def get_result(response: Dict) -> Any:
+    """Return the result of a JSON-RPC response from the model server.
+
+    :raises ModelError: if the server answered with an error instead.
+    """
+    if "error" in response:
+        raise ModelError(response["error"])
+
+    return response["result"]
+
+
+def get_model_version(timeout: Optional[int]=None) -> Optional[str]:
+    """Return the version of the model the Sock server is running.
+
+    The answer is remembered by this worker for SOCK_MODEL_VERSION_TTL seconds, so a newly-deployed model is noticed
+    soon after a rollout without asking the server on every request.  Servers that don't implement the ``version``
+    method report None.  If the server doesn't answer in time, the last known version is returned so that cached
+    guesses can still be served, and the server isn't asked again for SOCK_MODEL_VERSION_RETRY seconds, so that while
+    it's down each request doesn't wait out its own timeout first.
+
+    :param timeout: How long to wait for the server, in milliseconds; defaults to SOCK_TIMEOUT.
+    """
+    app = current_app  # type: Flask
+
+    current, version = known_model_version()
+    if current:
+        return version
+
+    try:
+        response = query_model("version", timeout=timeout)  # type: Optional[Dict]
+    except TimeoutError as e:
+        app.logger.error(e)
+        response = None
+
+    return record_model_version(app, response)
+
+
+def known_model_version() -> Tuple[bool, Optional[str]]:
+    """Whether there's no need to ask the model server for its version yet, and the version it last reported."""
+    return time.monotonic() < _model_version_expires, _model_version
+
+
+def record_model_version(app: Flask, response: Optional[Dict]) -> Optional[str]:
+    """Remember the model server's answer to a ``version`` request, or None if it didn't answer in time, and return
+    the version to go by.
+
+    This process's sync and asyncio handlers share what it's remembered.
+    """
+    global _model_version, _model_version_expires
+
+    if response is None:
+        _model_version_expires = time.monotonic() + app.config["SOCK_MODEL_VERSION_RETRY"]
+        return _model_version
+
+    _model_version = response.get("result")
+    _model_version_expires = time.monotonic() + app.config["SOCK_MODEL_VERSION_TTL"]
+    app.logger.info("Sock reports model version %s", _model_version)
+
+    return _model_version
+
+
+def guess_batch(tweets: Sequence[Sequence[str]], timeout: Optional[int]=None) -> List[Sequence[float]]:
+    """Score the tweets of several users with one round trip to the model server.
+
+    Returns one array of per-tweet scores for each user, in the same order as tweets.  Servers that predate the
+    ``guess_batch`` method are sent one pipelined ``guess`` request per user instead.
+
+    :param timeout: How long to wait, in milliseconds; defaults to SOCK_TIMEOUT.
+    :raises TimeoutError: if the model server doesn't answer in time.
+    :raises ModelError: if the model server answers with an error.
+    """
+    app = current_app  # type: Flask
+
+    if len(tweets) == 0:
+        return []
+
+    if timeout is None:
+        timeout = app.config["SOCK_TIMEOUT"]
+
+    deadline = time.monotonic() + (timeout / 1000)
+    response = query_model("guess_batch", [list(t) for t in tweets], timeout)
+
+    if is_unsupported(response):
+        app.logger.warning("Sock doesn't support guess_batch, falling back to one guess per user")
+        return [get_result(r) for r in query_model_many(guess_requests(tweets), remaining_ms(deadline))]
+
+    return get_result(response)
+
+
+def is_unsupported(response: Dict) -> bool:
+    """Whether this response says the model server doesn't know the method it was asked to call."""
+    return "error" in response and response["error"].get("code") == METHOD_NOT_FOUND
+
+
+def guess_requests(tweets: Sequence[Sequence[str]]) -> List[Dict]:
+    """One ``guess`` request per user, for model servers that don't support ``guess_batch``."""
+    return [JSONRPCClient.request("guess", list(t)) for t in tweets]
@@ -0,0 +1,191 @@
+# -*- coding: utf-8 -*-
+"""Where scraped tweets come from.
+
+Each source yields a user's tweets newest first, as dicts with at least ``tweetId``, ``isPinned``, ``isRetweet`` and
+``text`` (the same keys twitter_scraper uses).  TWEET_SOURCE picks one:
+
+- ``session`` (the default) reads Twitter's timeline endpoint itself, through one pooled keep-alive session per worker,
+  so that scrapes reuse connections instead of paying for new TCP and TLS handshakes every time.
+- ``twitter_scraper`` goes through twitter_scraper, as the app used to.
+
+Both raise ValueError if the user is private or doesn't exist, requests.RequestException (e.g. ConnectTimeout or
+ConnectionError) if Twitter can't be reached, and ParseError if what Twitter sends can't be made sense of.
+"""
+import os
+import re
+from abc import ABC, abstractmethod
+from threading import BoundedSemaphore, Lock
+from typing import Callable, Dict, Iterator, Optional
+
+import requests
+from flask import Config, Flask, current_app
+from requests.adapters import HTTPAdapter
+
+# The same endpoint that twitter_scraper.get_tweets reads
+TIMELINE_URL = "https://twitter.com/i/profile/{}/timeline/tweets"
+TIMELINE_PARAMS = {
+    "include_available_features": "1",
+    "include_entities": "1",
+    "include_new_items_bar": "true",
+}
+TIMELINE_HEADERS = {
+    "Accept": "application/json, text/javascript, */*; q=0.01",
+    "X-Twitter-Active-User": "yes",
+    "X-Requested-With": "XMLHttpRequest",
+}
+
+_source = None  # type: Optional[TweetSource]
+_source_pid = None  # type: Optional[int]
+_source_lock = Lock()
+
+
+class ParseError(Exception):
+    """Twitter sent something that doesn't look like a timeline, e.g. because its markup changed."""
+
+
+def parse_tweets(items_html: str) -> Iterator[Dict]:
+    """Parse the tweets out of one page of a timeline, newest first, keeping only what the model needs.
+
+    :raises ParseError: if a tweet is missing its id.
+    """
+    # requests_html pulls in a headless-browser toolkit, which takes a while to import, so that's put off until the
+    # first scrape rather than slowing down every worker's startup
+    from requests_html import HTML
+
+    for item in HTML(html=items_html, url="bunk", default_encoding="utf-8").find(".stream-item"):
+        text = item.find(".tweet-text", first=True)
+        if text is None:
+            # Not every stream item is a tweet
+            continue
+
+        if "data-item-id" not in item.attrs:
+            raise ParseError("Found a tweet without an id")
+
+        tweet = item.find(".js-stream-tweet", first=True)
+        yield {
+            "tweetId": item.attrs["data-item-id"],
+            "isPinned": item.find("div.pinned", first=True) is not None,
+            "isRetweet": tweet is not None and tweet.attrs.get("data-retweet-id") is not None,
+            # Space out links the same way twitter_scraper does, so the model sees the same text either way
+            "text": re.sub("http", " http", text.full_text, 1),
+        }
+
+
+class TweetSource(ABC):
+    """Somewhere to get tweets from."""
+
+    @abstractmethod
+    def get_tweets(self, user: str, pages: int) -> Iterator[Dict]:
+        """Yield this user's tweets, newest first, reading at most the given number of pages of their timeline.
+
+        Nothing should be fetched until the first tweet is asked for, nor any page until a tweet on it is.
+        """
+
+
+class ScraperSource(TweetSource):
+    """Tweets scraped by twitter_scraper, with its own connections."""
+
+    def get_tweets(self, user: str, pages: int) -> Iterator[Dict]:
+        # Put off for the same reason as requests_html
+        from twitter_scraper import get_tweets as scrape_tweets
+
+        try:
+            yield from scrape_tweets(user, pages=pages)
+        except (AttributeError, IndexError, KeyError, TypeError) as e:
+            # twitter_scraper assumes a lot about Twitter's markup, and just falls over when it's wrong
+            raise ParseError(f"Couldn't parse {user}'s timeline: {e!r}") from e
+
+
+class SessionSource(TweetSource):
+    """Tweets read from Twitter's timeline endpoint through a pooled keep-alive session.
+
+    At most connections requests are in flight at once, and at most connections_per_host to any one host; scrapes
+    beyond those wait for a connection to be free rather than opening another.  Connections are kept open to at most
+    host_pools hosts at once.
+    """
+
+    def __init__(self, connections: int, connections_per_host: int, timeout: float, host_pools: int=4):
+        self.timeout = timeout
+        self._slots = BoundedSemaphore(connections)
+        self._session = requests.Session()
+        self._session.headers.update(TIMELINE_HEADERS)
+
+        adapter = HTTPAdapter(pool_connections=host_pools, pool_maxsize=connections_per_host, pool_block=True)
+        self._session.mount("https://", adapter)
+        self._session.mount("http://", adapter)
+
+    def get_page(self, user: str, position: Optional[str]=None) -> Dict:
+        """Fetch one page of this user's timeline, starting after the tweet with the given id (or at the top)."""
+        params = TIMELINE_PARAMS if position is None else dict(TIMELINE_PARAMS, max_position=position)
+
+        with self._slots:
+            response = self._session.get(
+                TIMELINE_URL.format(user),
+                params=params,
+                headers={"Referer": f"https://twitter.com/{user}"},
+                timeout=self.timeout
+            )
+
+        if response.status_code == requests.codes.not_found:
+            raise ValueError(f"{user} does not exist or is private")
+
+        response.raise_for_status()
+        try:
+            return response.json()
+        except ValueError as e:
+            # e.g. a rate-limiting page; that's no reason to think the user doesn't exist
+            raise requests.RequestException(f"Twitter didn't send JSON for {user}", response=response) from e
+
+    def get_tweets(self, user: str, pages: int) -> Iterator[Dict]:
+        position = None  # type: Optional[str]
+
+        for _ in range(pages):
+            payload = self.get_page(user, position)
+            if not isinstance(payload, dict):
+                raise ParseError(f"Twitter sent a {type(payload).__name__} for {user}'s timeline")
+
+            if "items_html" not in payload:
+                if position is None:
+                    raise ValueError(f"{user} does not exist or is private")
+
+                return
+
+            tweet = None  # type: Optional[Dict]
+            for tweet in parse_tweets(payload["items_html"]):
+                yield tweet
+
+            if tweet is None or not payload.get("has_more_items", True):
+                return
+
+            position = payload.get("min_position") or tweet["tweetId"]
+
+
+SOURCES = {
+    "session": lambda config: SessionSource(
+        config["SCRAPE_CONNECTIONS"],
+        config["SCRAPE_CONNECTIONS_PER_HOST"],
+        config["SCRAPE_TIMEOUT"],
+        config["SCRAPE_HOST_POOLS"]
+    ),
+    "twitter_scraper": lambda config: ScraperSource(),
+}  # type: Dict[str, Callable[[Config], TweetSource]]
+
+
+def tweet_source() -> TweetSource:
+    """This worker's source of tweets, as chosen by TWEET_SOURCE.
+
+    Each process makes its own the first time it needs it, so that forked workers don't share their parent's
+    connections.
+    """
+    global _source, _source_pid
+
+    if _source_pid == os.getpid():
+        return _source
+
+    app = current_app  # type: Flask
+    with _source_lock:
+        if _source_pid != os.getpid():
+            _source = SOURCES[app.config["TWEET_SOURCE"]](app.config)
+            _source_pid = os.getpid()
+
+    return _source
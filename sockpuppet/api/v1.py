@@ -1,33 +1,75 @@
-from collections import namedtuple
+import os
+import time
+from concurrent.futures import Future, ThreadPoolExecutor, wait
+from contextlib import closing
+from contextvars import copy_context
+from functools import partial
 from enum import Enum
 from http import HTTPStatus
 from json import JSONEncoder
 from random import randint
-from typing import Sequence, Union
+from threading import Lock
+from typing import Dict, Iterator, List, Optional, Sequence, Set, Tuple, Union
 
 import connexion
 import flask
 import zmq
 from connexion.exceptions import ProblemException
-from flask import Blueprint, Flask, Request, Response, current_app, jsonify
-from jsonrpc.exceptions import JSONRPCInternalError, JSONRPCInvalidParams
-from twitter_scraper import get_tweets
+from flask import Blueprint, Flask, Request, Response, current_app
+from jsonrpc.exceptions import JSONRPCInternalError, JSONRPCInvalidParams, JSONRPCInvalidRequest
 from werkzeug.datastructures import MIMEAccept
 from werkzeug.exceptions import BadRequest, HTTPException
 import requests
-from requests import ConnectTimeout
-from sockpuppet.errors import BadCharacterError, EmptyNameError, SockPuppetError
-from sockpuppet.extensions import cache, zmq_socket
-
-Guess = namedtuple("Guess", ["status", "type", "id", ])
-# TODO: Subclass namedtuple
-
-
-BOT = "bot"
-HUMAN = "human"
-UNKNOWN = "unknown"
-UNAVAILABLE = "unavailable"
-# TODO: Use an Enum
+from sockpuppet.api.cache import (
+    acquire_leases,
+    get_cached_guesses,
+    get_cached_timeline,
+    get_cached_tweets,
+    normalize_name,
+    release_leases,
+    set_cached_guesses,
+    set_cached_timeline,
+    wait_for_guesses
+)
+from sockpuppet.api.conditional import Validators, cache_headers, cache_validators, is_not_modified
+from sockpuppet.api.guesses import (
+    UNKNOWN,
+    Guess,
+    add_timing_meta,
+    batch_responses,
+    batch_users,
+    claim_refreshes,
+    count_verdicts,
+    dedupe_misses,
+    fan_out,
+    guess_response,
+    merge_timeline,
+    record_fetch_deadline,
+    record_fetch_failure,
+    request_problem,
+    scorable,
+    settle_guesses,
+    sort_cached,
+    split_late,
+    split_leased,
+    take_fresh,
+    take_shared
+)
+from sockpuppet.api.model import get_model_version, guess_batch
+from sockpuppet.api.sources import ParseError, tweet_source
+from sockpuppet.errors import BadCharacterError, EmptyNameError, ModelError, SockPuppetError
+from sockpuppet.metrics import CACHE_LOOKUPS, IN_FLIGHT, SCRAPE_SECONDS
+from sockpuppet.serialization import error_response, json_response
+from sockpuppet.timing import ServerTiming, collect_timing, stage
+from sockpuppet.utils import remaining_ms
+
+_scraper = None  # type: Optional[ThreadPoolExecutor]
+_scraper_pid = None  # type: Optional[int]
+_scraper_lock = Lock()
+_refresher = None  # type: Optional[ThreadPoolExecutor]
+_refresher_pid = None  # type: Optional[int]
+_refreshing = set()  # type: Set[str]
+_refreshing_lock = Lock()
 
 
 def user_or_id(name: str) -> Union[str, int]:
@@ -41,16 +83,148 @@ def user_or_id(name: str) -> Union[str, int]:
         # Prefix an all-digit username with @ to treat it as a name, not an id
 
 
-def get_recent_tweets(user: str, limit: int) -> Sequence[str]:
+def get_tweets(user: str, pages: int=25) -> Iterator[Dict]:
+    """Scrape this user's timeline from this worker's tweet source (see sockpuppet.api.sources)."""
+    return tweet_source().get_tweets(user, pages)
+
 
+def scrape_tweets(user: str, limit: int, timeline: Optional[Dict]=None) -> List[Tuple[str, str]]:
+    """Scrape the (id, text) of up to limit of this user's tweets that are newer than this cached timeline (if any),
+    newest first, without touching the cache.
+
+    Tweets are streamed from the scraper, keeping only their ids and text, and it's stopped as soon as there are
+    enough of them; it reads up to SCRAPE_MAX_PAGES pages to get them.
+
+    :raises ValueError: if the user is private or doesn't exist.
+    """
     app = current_app  # type: Flask
+
     app.logger.info("Requesting up to %d tweets from %s", limit, user)
-    tweets = tuple(t for t in get_tweets(user, pages=1))
-    result = tuple(t["text"] for t in tweets)
-    app.logger.info("Got %d tweets from %s", len(result), user)
+    fresh = []  # type: List[Tuple[str, str]]
+    tweets = get_tweets(user, pages=app.config["SCRAPE_MAX_PAGES"])  # type: Iterator[Dict]
+    with closing(tweets), SCRAPE_SECONDS.time(), IN_FLIGHT.labels("scrape").track_inprogress(), stage("scrape", user):
+        take_fresh(tweets, timeline, limit, fresh)
+
+    return fresh
+
+
+def get_recent_tweets(user: str, limit: int) -> Sequence[str]:
+    """Return the text of up to limit of this user's most recent tweets, newest first.
+
+    The user's tweets are kept in a rolling window in the cache, along with the id of the newest one ever seen.  Only
+    tweets newer than that are scraped and merged in, so re-scraping a quiet account reads no more than it must.
+
+    :raises ValueError: if the user is private or doesn't exist.
+    """
+    app = current_app  # type: Flask
+    timeline = get_cached_timeline(user)  # type: Optional[Dict]
+    fresh = scrape_tweets(user, limit, timeline)
+
+    timeline = merge_timeline(fresh, timeline, limit)
+    set_cached_timeline(user, timeline, app.config["TWEET_CACHE_TIMEOUT"])
+    app.logger.info("Got %d new tweets from %s", len(fresh), user)
     # TODO: Doesn't distinguish between screen name and user id
 
-    return result
+    return tuple(text for _, text in timeline["tweets"])
+
+
+def fetch_tweets(user: str, refresh: bool=False) -> Optional[Sequence[str]]:
+    """Return this user's recent tweets from the cache, scraping them (which caches them too) if necessary.
+
+    Returns None if the user is private or doesn't exist.
+
+    :param refresh: If True, scrape the tweets even if they're cached.
+    """
+    tweets = None if refresh else get_cached_tweets(user)  # type: Optional[Sequence[str]]
+    if not refresh:
+        CACHE_LOOKUPS.labels("tweets", "miss" if tweets is None else "hit").inc()
+
+    if tweets is None:
+        try:
+            tweets = get_recent_tweets(user, 20)
+        except ValueError:
+            return None
+
+    return tweets
+
+
+def _scrape_pool(app: Flask) -> ThreadPoolExecutor:
+    """This process's pool of at most SCRAPE_WORKERS threads, which every request's scrapes share."""
+    global _scraper, _scraper_pid
+
+    pid = os.getpid()
+    with _scraper_lock:
+        if _scraper is None or _scraper_pid != pid:
+            # Threads don't survive a fork, so a pool inherited from a parent process is useless
+            _scraper = ThreadPoolExecutor(max_workers=app.config["SCRAPE_WORKERS"])
+            _scraper_pid = pid
+
+        return _scraper
+
+
+def fetch_all_tweets(
+    users: Sequence[str],
+    timeout: float,
+    refresh: bool=False
+) -> Tuple[Dict[int, Optional[Sequence[str]]], Dict[int, Future]]:
+    """Fetch the tweets of each user concurrently, in this process's pool of scraping threads.
+
+    Returns the result of each fetch that finished within timeout seconds, keyed by its index in users, and the fetches
+    still running when time ran out, keyed likewise.  Fetches that fail are logged and left out of both.  Those still
+    running are left to finish in the background, so that the tweets they get are still cached for next time; those
+    that hadn't started yet never will.
+
+    :param refresh: If True, scrape every user's tweets even if they're cached.
+    """
+    if len(users) == 0:
+        return {}, {}
+
+    app = current_app._get_current_object()  # type: Flask
+
+    def _fetch(user: str) -> Optional[Sequence[str]]:
+        with app.app_context():
+            return fetch_tweets(user, refresh)
+
+    executor = _scrape_pool(app)
+    futures = {
+        # Each in a copy of this context, so that its scrape counts toward the current request's timings
+        executor.submit(copy_context().run, _fetch, u): index for index, u in enumerate(users)
+    }  # type: Dict[Future, int]
+    done, not_done = wait(futures, timeout=max(timeout, 0))
+
+    results = {}  # type: Dict[int, Optional[Sequence[str]]]
+    for future in done:
+        index = futures[future]
+        try:
+            results[index] = future.result()
+        except (requests.RequestException, ParseError) as e:
+            record_fetch_failure(app, users[index], e, requests.Timeout)
+
+    late = {}  # type: Dict[int, Future]
+    if len(not_done) > 0:
+        record_fetch_deadline(app, [users[futures[f]] for f in not_done])
+        for future in not_done:
+            # Don't bother starting the ones that haven't been yet
+            if not future.cancel():
+                late[futures[future]] = future
+
+    return results, late
+
+
+def release_when_fetched(ids: Sequence[str], leased: Sequence[str], late: Dict[int, Future]):
+    """Release the leases on these users, except that those whose fetches are still running (as fetch_all_tweets
+    returned them) keep theirs until they finish, so that nobody else starts scraping them meanwhile.
+    """
+    app = current_app._get_current_object()  # type: Flask
+    now, later = split_late(ids, leased, late)
+
+    def _release(name: str, future: Future):
+        with app.app_context():
+            release_leases([name])
+
+    release_leases(now)
+    for name, future in later:
+        future.add_done_callback(partial(_release, name))
 
 # try getting tweets with twint first, then with twarc
 # twint uses web scraping, so no api limits but it can break
@@ -75,167 +249,296 @@ def handle_http_exception(rpcerror):
             }
         }
 
-        json_response = jsonify(response)  # type: Response
-        json_response.status_code = exception.code
-
-        return json_response
+        return json_response(response, exception.code)
 
     return _handle
 
 
-def make_guess(ids: Sequence[str], response_id: int) -> Response:
-    guesses = []
+def check_request(response_id: Optional[int]) -> Optional[Response]:
+    """Return an error response if the current request can't be answered at all, or None if it can."""
     request = connexion.request  # type: Request
-    app = current_app  # type: Flask
-    accept_mimetypes = request.accept_mimetypes
-    if len(accept_mimetypes) > 0 and not request.accept_mimetypes.accept_json:
-        # If there's no Accept header, assume they'll take JSON...
-        # ...but if they provide it and don't...
-        query_response = {
-            "jsonrpc": "2.0",
-            "id": response_id,
-            "error": {
-                "code": 406,
-                "message": "Not Acceptable"
-            }
-        }
-        response = jsonify(query_response)  # type: Response
-        response.status_code = HTTPStatus.NOT_ACCEPTABLE
-        response.content_type = "application/json"
+    problem = request_problem(request.accept_mimetypes, request.url, current_app.config)
 
-        return response
+    return None if problem is None else error_response(response_id, *problem)
 
-    if len(request.url) > app.config["MAX_URL_LENGTH"]:
-        # TODO: Move this to BEFORE the URL is actually processed
-        query_response = {
-            "jsonrpc": "2.0",
-            "id": response_id,
-            "error": {
-                "code": 414,
-                "message": "Request URI Too Long"
-            }
-        }
-        response = jsonify(query_response)  # type: Response
-        response.status_code = HTTPStatus.REQUEST_URI_TOO_LONG
-        response.content_type = "application/json"
 
-        return response
+def lookup_users(
+    ids: Sequence[str],
+    model_version: Optional[str],
+    deadline: float,
+    refresh: bool=False,
+    leased: Sequence[str]=()
+) -> List[Guess]:
+    """Scrape, score and cache each of these users by deadline, a time.monotonic() timestamp.
+
+    The caller should hold their leases.  Guesses are in the same order as ids; users who couldn't be looked up in time
+    are reported as unknown, and aren't cached.
+
+    :param refresh: If True, re-scrape users even if their tweets are cached.
+    :param leased: The leases among ids to release when done, as release_when_fetched does.
+    """
+    app = current_app  # type: Flask
+    late = {}  # type: Dict[int, Future]
+
+    try:
+        # Scraping gets its share of what's left of the budget, and the model server gets the rest
+        fetched, late = fetch_all_tweets(
+            ids,
+            remaining_ms(deadline) * app.config["SCRAPE_DEADLINE_SHARE"] / 1000,
+            refresh
+        )  # type: Dict[int, Optional[Sequence[str]]], Dict[int, Future]
+        available = scorable(fetched)
 
-    for i in ids:
-        guess = None
         try:
-            # TODO: Must clean up this part
-            tweets = get_recent_tweets(i, 20)  # type: Sequence[str]
-            sock_request = {
-                "jsonrpc": "2.0",
-                "id": randint(-((2**53) - 1), (2**53) - 1),
-                "method": "guess",
-                "params": tweets
-            }
-            app.logger.info("Sending request to Sock")
-            zmq_socket.socket.send_json(sock_request)
-            app.logger.info("Sent request to Sock, awaiting response")
+            scores = dict(zip(
+                (index for index, _ in available),
+                guess_batch(
+                    [tweets for _, tweets in available],
+                    min(app.config["SOCK_TIMEOUT"], remaining_ms(deadline))
+                )
+            ))  # type: Dict[int, Sequence[float]]
+        except (TimeoutError, ModelError) as e:
+            # Everyone who was scraped is reported as unknown, rather than failing the whole request
+            app.logger.error(e)
+            scores = {}
 
-            events = zmq_socket.socket.poll(app.config["SOCK_TIMEOUT"])
+        guesses, to_cache = settle_guesses(ids, fetched, scores, app.config)
 
-            if events == 0:
-                raise TimeoutError(f"Failed to get response from model server within {app.config['SOCK_TIMEOUT']}ms")
+        # Everyone's guesses are written in one round trip
+        set_cached_guesses(to_cache, model_version)
+    finally:
+        release_when_fetched(ids, leased, late)
 
-            results = zmq_socket.socket.recv_json()  # type: Dict
-            app.logger.info("Got response from Sock")
+    return guesses
 
-            # TODO: Check for errors
-            # TODO: Conform to the API I designed
-            result_array = results["result"]
 
-            guess = Guess(
-                id=str(i),
-                type="user",
-                status=BOT if (sum(result_array) / len(result_array)) >= 0.5 else HUMAN
-            )
-        except ValueError:
-            # The user is private or doesn't exist...
-            guess = Guess(
-                id=str(i),
-                type="user",
-                status=UNAVAILABLE
+def refresh_users(names: Sequence[str]):
+    """Look these users up again and re-cache their guesses, skipping any that someone else is already looking up."""
+    app = current_app  # type: Flask
+    leased = acquire_leases(names, app.config["GUESS_LEASE_TIMEOUT"])
+
+    if len(leased) == 0:
+        return
+
+    app.logger.info("Refreshing %s", ", ".join(leased))
+    deadline = time.monotonic() + (app.config["REQUEST_DEADLINE"] / 1000)
+    try:
+        model_version = get_model_version(min(app.config["SOCK_TIMEOUT"], remaining_ms(deadline)))
+    except Exception:
+        release_leases(leased)
+        raise
+
+    lookup_users(leased, model_version, deadline, refresh=True, leased=leased)
+
+
+def schedule_refresh(names: Sequence[str]):
+    """Call refresh_users on these users in a background thread, so that the current request needn't wait for it.
+
+    Each process keeps its own pool of at most REFRESH_WORKERS threads for this, and refreshes each user at most once
+    at a time.  At most REFRESH_QUEUE_SIZE users are queued or being refreshed at once; any more are dropped.
+    """
+    global _refresher, _refresher_pid
+    app = current_app._get_current_object()  # type: Flask
+
+    pid = os.getpid()
+    with _refreshing_lock:
+        if _refresher is None or _refresher_pid != pid:
+            # Threads don't survive a fork, so a pool inherited from a parent process is useless (as is its queue)
+            _refresher = ThreadPoolExecutor(max_workers=app.config["REFRESH_WORKERS"])
+            _refresher_pid = pid
+            _refreshing.clear()
+
+        claimed = claim_refreshes(names, _refreshing, app.config["REFRESH_QUEUE_SIZE"])
+
+    if len(claimed) < len(names):
+        app.logger.info("Not refreshing %d users that are already queued, or don't fit", len(names) - len(claimed))
+
+    if len(claimed) == 0:
+        return
+
+    def _refresh():
+        with app.app_context():
+            try:
+                refresh_users(claimed)
+            except Exception:
+                app.logger.exception("Failed to refresh %s", ", ".join(claimed))
+            finally:
+                with _refreshing_lock:
+                    _refreshing.difference_update(normalize_name(n) for n in claimed)
+
+    _refresher.submit(_refresh)
+
+
+def read_guesses(ids: Sequence[str], deadline: float) -> Tuple[Optional[str], List[Optional[Dict]]]:
+    """Count a lookup of each of these users, and return the current model version and their cached guesses.
+
+    Both the count and the read take the same round trip to the cache.
+    """
+    app = current_app  # type: Flask
+
+    model_version = get_model_version(min(app.config["SOCK_TIMEOUT"], remaining_ms(deadline)))  # type: Optional[str]
+    with stage("cache"):
+        cached = get_cached_guesses(ids, model_version, count_lookups=True)
+
+    return model_version, cached
+
+
+def guess_users(ids: Sequence[str]) -> List[Guess]:
+    """Guess the status of each of these users, within a REQUEST_DEADLINE budget.
+
+    Guesses are in the same order as ids.  Stale guesses are served as they are, and their users are refreshed in the
+    background.
+    """
+    app = current_app  # type: Flask
+    deadline = time.monotonic() + (app.config["REQUEST_DEADLINE"] / 1000)
+    model_version, cached = read_guesses(ids, deadline)
+
+    return resolve_guesses(ids, model_version, cached, deadline)
+
+
+def resolve_guesses(
+    ids: Sequence[str],
+    model_version: Optional[str],
+    cached: Sequence[Optional[Dict]],
+    deadline: float
+) -> List[Guess]:
+    """Fill in the guesses of the users in ids that weren't cached, given what read_guesses returned.
+
+    If every user was cached, this neither scrapes nor talks to the model server.
+    """
+    app = current_app  # type: Flask
+    guesses, misses, stale = sort_cached(ids, cached)
+
+    if len(stale) > 0:
+        schedule_refresh([ids[index] for index in stale])
+
+    misses, copies = dedupe_misses(ids, misses)
+    leased, waiting = split_leased(
+        ids, misses, acquire_leases([ids[m] for m in misses], app.config["GUESS_LEASE_TIMEOUT"])
+    )
+    if len(waiting) > 0:
+        # Someone else is already looking these users up, so share their results instead of repeating their work
+        with stage("wait"):
+            shared = wait_for_guesses(
+                [ids[w] for w in waiting],
+                model_version,
+                min(app.config["GUESS_LEASE_WAIT"], remaining_ms(deadline)),
+                app.config["GUESS_LEASE_POLL_INTERVAL"]
             )
-        except TimeoutError as e:
-            app.logger.error(e)
-            query_response = {
-                "jsonrpc": "2.0",
-                "id": response_id,
-                "error": {
-                    "code": 503,
-                    "message": "Failed to get response from model server"
-                }
-            }
-            response = jsonify(query_response)  # type: Response
-            response.status_code = HTTPStatus.GATEWAY_TIMEOUT
-            response.content_type = "application/json"
+        take_shared(ids, guesses, waiting, shared)
 
-            return response
-        except ConnectTimeout as e:
-            app.logger.error(e)
-            query_response = {
-                "jsonrpc": "2.0",
-                "id": response_id,
-                "error": {
-                    "code": 503,
-                    "message": "Failed to get response from Twitter in time"
-                }
-            }
-            response = jsonify(query_response)  # type: Response
-            response.status_code = HTTPStatus.GATEWAY_TIMEOUT
-            response.content_type = "application/json"
+        # Whatever didn't arrive in time, we'll just have to look up ourselves
+        misses = [index for index in misses if guesses[index] is None]
 
-            return response
-        except requests.ConnectionError as e:
-            app.logger.error(e)
-            query_response = {
-                "jsonrpc": "2.0",
-                "id": response_id,
-                "error": {
-                    "code": 504,
-                    "message": "Failed to connect to Twitter"
-                }
-            }
-            response = jsonify(query_response)  # type: Response
-            response.status_code = HTTPStatus.BAD_GATEWAY
-            response.content_type = "application/json"
+    looked_up = lookup_users(
+        [ids[m] for m in misses], model_version, deadline, leased=[ids[index] for index in leased]
+    )  # type: List[Guess]
+    for index, guess in zip(misses, looked_up):
+        guesses[index] = guess
 
-            return response
+    fan_out(ids, guesses, copies)
+    count_verdicts(guesses)
+
+    return guesses
 
-        guesses.append(guess)
 
-    query_response = {
-        "jsonrpc": "2.0",
-        "id": response_id,
-        "result": guesses
-    }
-    response = jsonify(query_response)  # type: Response
+def timed_response(query_response: Union[Dict, List[Dict]], timing: ServerTiming) -> Response:
+    """Serialize a successful JSON-RPC response, with a Server-Timing header that breaks down how long it took.
 
-    response.status_code = HTTPStatus.OK
-    response.content_type = "application/json"
+    If SERVER_TIMING_META is set, a single (not batched) response also gets the breakdown in its ``meta`` field.
+    """
+    add_timing_meta(current_app.config, query_response, timing)
+
+    with stage("serialize"):
+        response = json_response(query_response, HTTPStatus.OK)  # type: Response
+
+    response.headers["Server-Timing"] = timing.as_header()
 
     return response
 
 
+def make_guess(ids: Sequence[str], response_id: int, conditional: bool=False) -> Response:
+    """Answer a request for these users' guesses.
+
+    :param conditional: If True, give the response HTTP validators and caching headers, and answer with 304 Not
+        Modified if the request's preconditions say the client already has the same result.
+    """
+    app = current_app  # type: Flask
+
+    with collect_timing() as timing:
+        with stage("validate"):
+            error = check_request(response_id)  # type: Optional[Response]
+
+        if error is not None:
+            return error
+
+        if not conditional:
+            return timed_response(guess_response(response_id, guess_users(ids)), timing)
+
+        deadline = time.monotonic() + (app.config["REQUEST_DEADLINE"] / 1000)
+        model_version, cached = read_guesses(ids, deadline)
+        validators = cache_validators(ids, cached, model_version)  # type: Optional[Validators]
+        guesses = resolve_guesses(ids, model_version, cached, deadline)
+
+        request = connexion.request  # type: Request
+        if is_not_modified(validators, request.headers.get("If-None-Match"), request.headers.get("If-Modified-Since")):
+            # Everyone was cached, so nothing was scraped or scored
+            response = Response(status=HTTPStatus.NOT_MODIFIED, headers=cache_headers(validators))
+            response.headers["Server-Timing"] = timing.as_header()
+            return response
+
+        if validators is None:
+            # Users looked up just now have only just been cached, and those we couldn't get to in time weren't;
+            # re-reading everyone costs the same single round trip as re-reading just them
+            cached = get_cached_guesses(ids, model_version)
+            validators = cache_validators(ids, cached, model_version, uncacheable=(UNKNOWN,))
+
+        response = timed_response(guess_response(response_id, guesses), timing)
+        response.headers.extend(cache_headers(validators))
+
+        return response
+
+
+def make_batch_guess(batch: Sequence[Dict]) -> Response:
+    """Answer a JSON-RPC batch of guess requests with one pass over every user any of them asks about.
+
+    Each user is looked up once, however many entries ask about them, and the responses are in the same order as the
+    entries.
+    """
+    with collect_timing() as timing:
+        with stage("validate"):
+            error = check_request(None)  # type: Optional[Response]
+
+        if error is not None:
+            return error
+
+        users = batch_users(batch)  # type: Dict[str, str]
+        guesses = guess_users(list(users.values()))
+
+        return timed_response(batch_responses(batch, users, guesses), timing)
+
+
 def get_user(ids: Sequence[str]) -> Response:
     response_id = randint(-((2**53) - 1), (2**53) - 1)
 
     app = current_app  # type: Flask
     app.logger.info("Received GET request for %s", ids)
-    guesses = make_guess(ids, response_id)
+    guesses = make_guess(ids, response_id, conditional=True)
     app.logger.info("Done")
     return guesses
 
 
 def post_user() -> Response:
     content_type = connexion.request.headers["Content-Type"]  # type: str
-    json = connexion.request.json  # type: Dict
+    json = connexion.request.json  # type: Union[Dict, List[Dict]]
     # TODO: Convert to JSONRPC request
-    # TODO: Handle errors
+
+    if isinstance(json, list):
+        return make_batch_guess(json)
+
+    if not isinstance(json, dict):
+        # The spec can't say "an object or an array", so other JSON values get past its validation
+        return error_response(None, JSONRPCInvalidRequest.CODE, JSONRPCInvalidRequest.MESSAGE, HTTPStatus.BAD_REQUEST)
 
     ids = json["params"]["ids"]
     response_id = json["id"]
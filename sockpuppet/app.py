@@ -1,28 +1,43 @@
 # -*- coding: utf-8 -*-
 """The app module, containing the app factory function."""
+import atexit
 import getpass
+import hashlib
+import json
 import logging
 import os
 import platform
 import socket
-from http import HTTPStatus
-from typing import Tuple
+import stat
+import time
+from threading import Thread
+from typing import Dict, Tuple, Union
 
+import yaml
 import zmq
 from connexion import FlaskApi, FlaskApp, ProblemException
-from flask import Flask, Response, jsonify
+from connexion.resolver import Resolver
+from flask import Flask, Response, g, request
 from jsonrpc.exceptions import JSONRPCInvalidRequest
+from prometheus_client import CONTENT_TYPE_LATEST
+from prometheus_client.multiprocess import mark_process_dead
 from simplejson import JSONDecoder, JSONEncoder
 from werkzeug.exceptions import BadRequest, HTTPException
 
-from sockpuppet import commands
+from sockpuppet import commands, metrics
 from sockpuppet.api import v1
+from sockpuppet.api.codec import use_compression
+from sockpuppet.api.sources import SOURCES
 from sockpuppet.errors import BadCharacterError, EmptyNameError
 from sockpuppet.extensions import cache, zmq_socket
+from sockpuppet.serialization import NO_ENVELOPE_STATUSES, JSONRPCResponse, use_serializer, wrap_error
 from sockpuppet.settings import Config, ProdConfig
+from sockpuppet.timing import collect_timing, stage
 
 ZMQ_CAPABILITIES = ("ipc", "pgm", "tipc", "norm", "curve", "gssapi", "draft")
 
+_sysinfo_logged = False
+
 
 def create_app(config_object: Config=ProdConfig) -> FlaskApp:
     """An application factory, as explained here: http://flask.pocoo.org/docs/patterns/appfactories/.
@@ -31,31 +46,161 @@ def create_app(config_object: Config=ProdConfig) -> FlaskApp:
     """
 
     # TODO: Validate config, abort the app if it's not valid
-    connex = FlaskApp(
+    with collect_timing() as timing:
+        with stage("connexion"):
+            connex = FlaskApp(
+                __name__.split('.')[0],
+                specification_dir=config_object.SPECIFICATION_DIR,
+                debug=config_object.DEBUG
+            )
+
+        with stage("spec"):
+            api = connex.add_api(
+                load_spec(config_object),
+                validate_responses=config_object.VALIDATE_RESPONSES,
+                resolver_error=BadRequest
+            )  # type: FlaskApi
+
+        app = connex.app  # type: Flask
+        app.logger.setLevel(config_object.LOG_LEVEL)
+
+        with stage("sysinfo"):
+            if config_object.FAST_START:
+                log_sysinfo_once(app, config_object)
+            else:
+                log_sysinfo(app, config_object)
+
+        with stage("config"):
+            register_config(app, connex, config_object)
+
+        with stage("extensions"):
+            register_extensions(app, config_object)
+
+        with stage("handlers"):
+            register_errorhandlers(app, connex)
+            register_metrics(app)
+            register_shellcontext(connex)
+            register_commands(app)
+
+    app.extensions["startup_timing"] = timing
+    app.logger.info("Created Flask app %s in %.0fms", app.name, sum(e[1] for e in timing.entries) * 1000)
+
+    return connex
+
+
+def _is_private(st: os.stat_result) -> bool:
+    """Whether a file or directory belongs to us, and nobody else can write to it."""
+    return st.st_uid == os.getuid() and not st.st_mode & (stat.S_IWGRP | stat.S_IWOTH)
+
+
+def load_spec(config: Config) -> Union[str, Dict]:
+    """Return the API spec for connexion to load, either as a path or (in fast-start mode) as an already-parsed dict.
+
+    In fast-start mode the parsed spec is cached as JSON in SPEC_CACHE_DIR, keyed by a hash of its source, so that each
+    new worker can skip parsing the YAML.  Editing the spec changes the hash, so a stale copy is never used.  The cache
+    is only used if it (and the directory it's in) belongs to this user and nobody else can write to it; otherwise the
+    spec is just parsed every time.
+    """
+    logger = logging.getLogger(__name__)
+
+    if not config.FAST_START:
+        return config.API_SPEC
+
+    path = os.path.join(config.APP_DIR, config.SPECIFICATION_DIR, config.API_SPEC)
+    with open(path, "rb") as f:
+        source = f.read()
+
+    try:
+        os.makedirs(config.SPEC_CACHE_DIR, mode=0o700, exist_ok=True)
+        usable = _is_private(os.stat(config.SPEC_CACHE_DIR))
+    except OSError as e:
+        logger.warning("Couldn't make the API spec cache %s: %s", config.SPEC_CACHE_DIR, e)
+        usable = False
+
+    if not usable:
+        logger.warning("Not caching the API spec in %s, since others can write to it", config.SPEC_CACHE_DIR)
+        return _parse_spec(source)
+
+    cached = os.path.join(config.SPEC_CACHE_DIR, hashlib.sha1(source).hexdigest() + ".json")
+    try:
+        with open(os.open(cached, os.O_RDONLY | os.O_NOFOLLOW), "rb") as f:
+            if _is_private(os.fstat(f.fileno())):
+                return json.load(f)
+
+            logger.warning("Ignoring %s, since it doesn't belong to us or others can write to it", cached)
+    except (OSError, ValueError):
+        # Not cached yet (or someone else is halfway through writing it), so parse it ourselves
+        pass
+
+    spec = _parse_spec(source)
+    partial = f"{cached}.{os.getpid()}"
+    try:
+        with open(os.open(partial, os.O_WRONLY | os.O_CREAT | os.O_EXCL | os.O_NOFOLLOW, 0o600), "w") as f:
+            json.dump(spec, f)
+
+        os.replace(partial, cached)
+    except OSError as e:
+        logger.warning("Couldn't cache the parsed API spec in %s: %s", config.SPEC_CACHE_DIR, e)
+
+    return spec
+
+
+def _parse_spec(source: bytes) -> Dict:
+    spec = yaml.load(source, Loader=getattr(yaml, "CSafeLoader", yaml.SafeLoader))  # type: Dict
+
+    # Round-trip it through JSON, so that a freshly-parsed spec is the same as a cached one (e.g. its keys are strings)
+    return json.loads(json.dumps(spec))
+
+
+def create_async_app(config_object: Config=ProdConfig) -> "AioHttpApp":
+    """Make an asyncio version of the app, served by aiohttp, that can hold many concurrent lookups in one process.
+
+    The same API spec is served, but its operations resolve to the coroutines in sockpuppet.api.aio.  The Flask app
+    made by create_app is kept alongside for its config, logger, cache and CLI.
+
+    :param config_object: The configuration object to use.
+    """
+    from connexion import AioHttpApp
+    from sockpuppet.api import aio
+    # Imported here so that the uWSGI app doesn't have to load aiohttp
+
+    app = create_app(config_object).app  # type: Flask
+
+    connex = AioHttpApp(
         __name__.split('.')[0],
         specification_dir=config_object.SPECIFICATION_DIR,
         debug=config_object.DEBUG
     )
-    api = connex.add_api(
-        config_object.API_SPEC,
+    connex.add_api(
+        load_spec(config_object),
         validate_responses=config_object.VALIDATE_RESPONSES,
-        resolver_error=BadRequest
-    )  # type: FlaskApi
-    app = connex.app  # type: Flask
-    app.logger.setLevel(config_object.LOG_LEVEL)
-
-    log_sysinfo(app, config_object)
-    register_config(app, connex, config_object)
-    register_extensions(app, config_object)
-    register_errorhandlers(app, connex)
-    register_shellcontext(connex)
-    register_commands(app)
+        resolver=Resolver(lambda operation_id: getattr(aio, operation_id.rsplit(".", 1)[-1])),
+        pass_context_arg_name="request"
+    )
+    connex.app["flask"] = app
+    connex.app.middlewares.append(aio.measure_request)
+    connex.app.middlewares.append(aio.wrap_errors)
+    connex.app.router.add_get("/metrics", aio.get_metrics)
+    connex.app.on_startup.append(aio.startup)
+    connex.app.on_cleanup.append(aio.cleanup)
 
-    app.logger.info("Created Flask app %s", app.name)
+    app.logger.info("Created aiohttp app for %s", app.name)
 
     return connex
 
 
+def log_sysinfo_once(app: Flask, config: Config):
+    """Call log_sysinfo in the background, unless this process (or the one it was forked from) already has.
+
+    Some of what log_sysinfo looks up, like the FQDN, can block for seconds on DNS; a new worker shouldn't wait on that.
+    """
+    global _sysinfo_logged
+
+    if not _sysinfo_logged:
+        _sysinfo_logged = True
+        Thread(target=log_sysinfo, args=(app, config), name="log_sysinfo", daemon=True).start()
+
+
 def log_sysinfo(app: Flask, config: Config):
     app.logger.info("ZMQ:")
     app.logger.info("  zmq version: %s", zmq.zmq_version())
@@ -108,6 +253,37 @@ def register_config(app: Flask, connex: FlaskApp, config: Config):
     app.logger.info("  SOCK_HOST = %s", config.SOCK_HOST)
     app.logger.info("  ZMQ_CONNECT_ADDR = %s", config.ZMQ_CONNECT_ADDR)
     app.logger.info("  ZMQ_SOCKET_TYPE = %s", config.ZMQ_SOCKET_TYPE)
+    app.logger.info("  ZMQ_POOL_SIZE = %d", config.ZMQ_POOL_SIZE)
+    app.logger.info("  ZMQ_POOL_PREWARM = %s", config.ZMQ_POOL_PREWARM)
+    app.logger.info("  CACHE_TYPE = %s", config.CACHE_TYPE)
+    app.logger.info("  GUESS_CACHE_TIMEOUT = %ds", config.GUESS_CACHE_TIMEOUT)
+    app.logger.info("  GUESS_CACHE_SOFT_TIMEOUT = %ds", config.GUESS_CACHE_SOFT_TIMEOUT)
+    app.logger.info("  GUESS_CACHE_UNAVAILABLE_TIMEOUT = %ds", config.GUESS_CACHE_UNAVAILABLE_TIMEOUT)
+    app.logger.info("  GUESS_CACHE_UNAVAILABLE_SOFT_TIMEOUT = %ds", config.GUESS_CACHE_UNAVAILABLE_SOFT_TIMEOUT)
+    app.logger.info("  TWEET_CACHE_TIMEOUT = %ds", config.TWEET_CACHE_TIMEOUT)
+    app.logger.info("  LOCAL_CACHE_SIZE = %d", config.LOCAL_CACHE_SIZE)
+    app.logger.info("  LOCAL_CACHE_TIMEOUT = %ds", config.LOCAL_CACHE_TIMEOUT)
+    app.logger.info("  CACHE_COMPRESSION = %s", config.CACHE_COMPRESSION)
+    app.logger.info("  GUESS_LEASE_TIMEOUT = %ds", config.GUESS_LEASE_TIMEOUT)
+    app.logger.info("  GUESS_LEASE_WAIT = %dms", config.GUESS_LEASE_WAIT)
+    app.logger.info("  GUESS_LEASE_POLL_INTERVAL = %dms", config.GUESS_LEASE_POLL_INTERVAL)
+    app.logger.info("  SOCK_MODEL_VERSION_TTL = %ds", config.SOCK_MODEL_VERSION_TTL)
+    app.logger.info("  SOCK_MODEL_VERSION_RETRY = %ds", config.SOCK_MODEL_VERSION_RETRY)
+    app.logger.info("  REQUEST_DEADLINE = %dms", config.REQUEST_DEADLINE)
+    app.logger.info("  SCRAPE_DEADLINE_SHARE = %s", config.SCRAPE_DEADLINE_SHARE)
+    app.logger.info("  SCRAPE_WORKERS = %d", config.SCRAPE_WORKERS)
+    app.logger.info("  REFRESH_WORKERS = %d", config.REFRESH_WORKERS)
+    app.logger.info("  REFRESH_QUEUE_SIZE = %d", config.REFRESH_QUEUE_SIZE)
+    app.logger.info("  TWEET_SOURCE = %s", config.TWEET_SOURCE)
+    app.logger.info("  SCRAPE_CONNECTIONS = %d", config.SCRAPE_CONNECTIONS)
+    app.logger.info("  SCRAPE_CONNECTIONS_PER_HOST = %d", config.SCRAPE_CONNECTIONS_PER_HOST)
+    app.logger.info("  SCRAPE_HOST_POOLS = %d", config.SCRAPE_HOST_POOLS)
+    app.logger.info("  SCRAPE_TIMEOUT = %ds", config.SCRAPE_TIMEOUT)
+    app.logger.info("  SCRAPE_MAX_PAGES = %d", config.SCRAPE_MAX_PAGES)
+    app.logger.info("  SERVER_TIMING_META = %s", config.SERVER_TIMING_META)
+    app.logger.info("  FAST_START = %s", config.FAST_START)
+    app.logger.info("  JSON_SERIALIZER = %s", config.JSON_SERIALIZER)
+    app.logger.info("  SPEC_CACHE_DIR = %s", config.SPEC_CACHE_DIR)
     # TODO: Log whether or not secrets were found (but don't actually log them)
 
 
@@ -115,6 +291,10 @@ def register_extensions(app: Flask, config: Config):
     """Register Flask extensions."""
     cache.init_app(app)
     zmq_socket.init_app(app)
+    use_serializer(config.JSON_SERIALIZER)
+    use_compression(config.CACHE_COMPRESSION)
+    if config.TWEET_SOURCE not in SOURCES:
+        raise ValueError(f"Tweet source {config.TWEET_SOURCE} doesn't exist, choose from {', '.join(SOURCES)}")
     app.json_encoder = JSONEncoder
     app.json_decoder = JSONDecoder
 
@@ -126,19 +306,9 @@ def register_errorhandlers(app: Flask, connex: FlaskApp):
 
     @app.after_request
     def transform(response: Response) -> Response:
-        if response.status_code != HTTPStatus.OK:
-            jsonrpc = jsonify({
-                "jsonrpc": "2.0",
-                "id": None,
-                "error": {
-                    "code": -32602,
-                    "message": "Oops",
-                    "data": response.json
-                }
-            })
-            jsonrpc.status_code = response.status_code
-
-            return jsonrpc
+        if response.status_code not in NO_ENVELOPE_STATUSES and not isinstance(response, JSONRPCResponse):
+            # Our own errors are already JSON-RPC; anything else (e.g. from connexion) gets wrapped in an envelope
+            return wrap_error(response)
         else:
             return response
     # interesting parameters here:
@@ -147,6 +317,49 @@ def register_errorhandlers(app: Flask, connex: FlaskApp):
     # connex.auth_all_paths
 
 
+def register_metrics(app: Flask):
+    """Serve Prometheus metrics at /metrics, and time every other request."""
+
+    @app.route("/metrics")
+    def get_metrics() -> Response:
+        return Response(metrics.collect(), content_type=CONTENT_TYPE_LATEST)
+
+    @app.before_request
+    def start_timer():
+        if request.endpoint != "get_metrics":
+            # Don't let Prometheus's own scrapes skew the numbers
+            g.request_started = time.perf_counter()
+            metrics.IN_FLIGHT.labels("request").inc()
+
+    @app.after_request
+    def observe_request(response: Response) -> Response:
+        if "request_started" in g:
+            metrics.REQUEST_SECONDS.labels(request.method, response.status_code).observe(
+                time.perf_counter() - g.request_started
+            )
+
+        return response
+
+    @app.teardown_request
+    def stop_timer(exception):
+        if "request_started" in g:
+            metrics.IN_FLIGHT.labels("request").dec()
+
+    if metrics.is_multiprocess():
+        try:
+            import uwsgi
+            from uwsgidecorators import postfork
+        except ImportError:
+            atexit.register(mark_process_dead, os.getpid())
+        else:
+            if uwsgi.worker_id() > 0:
+                # With lazy-apps, each worker loads the app after it's forked, when post-fork hooks have already run
+                atexit.register(mark_process_dead, os.getpid())
+            else:
+                # Each worker has its own in-flight gauges, which shouldn't count once the worker is gone
+                postfork(lambda: atexit.register(mark_process_dead, os.getpid()))
+
+
 def register_shellcontext(connex: FlaskApp):
     """Register shell context objects."""
     def shell_context():
@@ -167,3 +380,8 @@ def register_commands(app: Flask):
     app.cli.add_command(commands.lint)
     app.cli.add_command(commands.clean)
     app.cli.add_command(commands.urls)
+    app.cli.add_command(commands.refresh)
+    app.cli.add_command(commands.cache_usage)
+    app.cli.add_command(commands.score)
+    app.cli.add_command(commands.bench)
+    app.cli.add_command(commands.startup)
@@ -0,0 +1,244 @@
+# -*- coding: utf-8 -*-
+"""Local stand-ins for the Sock model server and Twitter, and a harness that drives the app against them.
+
+Neither stand-in needs a trained model, word embeddings or a network connection, so throughput and latency can be
+measured anywhere.  Both have configurable latency and failure injection.
+"""
+import math
+import random
+import time
+from collections import Counter, defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from functools import wraps
+from threading import Event, Lock, Thread
+from typing import Callable, Dict, Iterator, List, Optional, Sequence
+
+import requests
+import zmq
+from flask import Flask
+from zmq import Context
+
+import sockpuppet.api.v1
+
+STUB_TWEET = "this is a stub tweet, there are many like it but this one is mine"
+
+
+class StubModelServer(object):
+    """A stand-in for the Sock model server, answering JSON-RPC over ZMQ with random scores.
+
+    A ROUTER socket bound to address hands requests to a number of REP workers, so that like the real server it can
+    take many requests at once but only work on a few of them at a time.
+
+    :param latency: Seconds each worker takes to answer a request.
+    :param failure_rate: Fraction of requests that hang, tying up their worker for hang seconds before they're answered,
+        as if the server had stalled.  Clients will have given up on them by then, whether they use REQ or DEALER.
+    """
+
+    def __init__(
+        self,
+        address: str,
+        latency: float=0.0,
+        failure_rate: float=0.0,
+        workers: int=4,
+        hang: float=60.0
+    ):
+        self.address = address
+        self.latency = latency
+        self.failure_rate = failure_rate
+        self.workers = workers
+        self.hang = hang
+        self._backend = f"inproc://stub-model-server-{id(self)}"
+        self._stop = Event()
+        self._threads = []  # type: List[Thread]
+
+    def _answer(self, request: Dict) -> Dict:
+        method = request.get("method")
+        params = request.get("params")
+
+        if method == "ping":
+            result = "pong"
+        elif method == "version":
+            result = "stub"
+        elif method == "guess":
+            result = [random.random() for _ in params]
+        elif method == "guess_batch":
+            result = [[random.random() for _ in tweets] for tweets in params]
+        else:
+            return {"jsonrpc": "2.0", "id": request.get("id"), "error": {"code": -32601, "message": "Method not found"}}
+
+        return {"jsonrpc": "2.0", "id": request.get("id"), "result": result}
+
+    def _work(self, ready: Event):
+        with Context.instance().socket(zmq.REP) as worker:
+            worker.connect(self._backend)
+            ready.set()
+            while not self._stop.is_set():
+                if worker.poll(50) == 0:
+                    continue
+
+                request = worker.recv_json()  # type: Dict
+                time.sleep(self.latency)
+                if random.random() < self.failure_rate and self._stop.wait(self.hang):
+                    # Stopped while hanging; nobody's waiting for the answer anymore
+                    break
+
+                worker.send_json(self._answer(request))
+
+    def _proxy(self, ready: Event):
+        context = Context.instance()
+        with context.socket(zmq.ROUTER) as frontend, context.socket(zmq.DEALER) as backend:
+            frontend.bind(self.address)
+            backend.bind(self._backend)
+            ready.set()
+
+            poller = zmq.Poller()
+            poller.register(frontend, zmq.POLLIN)
+            poller.register(backend, zmq.POLLIN)
+            while not self._stop.is_set():
+                events = dict(poller.poll(50))
+                if frontend in events:
+                    backend.send_multipart(frontend.recv_multipart())
+                if backend in events:
+                    frontend.send_multipart(backend.recv_multipart())
+
+    def start(self):
+        ready = Event()
+        proxy = Thread(target=self._proxy, args=(ready,), daemon=True)
+        proxy.start()
+        ready.wait()
+        self._threads.append(proxy)
+
+        for _ in range(self.workers):
+            ready = Event()
+            worker = Thread(target=self._work, args=(ready,), daemon=True)
+            worker.start()
+            ready.wait()
+            self._threads.append(worker)
+
+    def stop(self):
+        self._stop.set()
+        for thread in self._threads:
+            thread.join()
+
+    def __enter__(self) -> "StubModelServer":
+        self.start()
+        return self
+
+    def __exit__(self, *args):
+        self.stop()
+
+
+def stub_get_tweets(
+    latency: float=0.0,
+    failure_rate: float=0.0,
+    unavailable_rate: float=0.0,
+    count: int=20
+) -> Callable:
+    """Make a stand-in for twitter_scraper.get_tweets.
+
+    :param latency: Mean seconds each call takes; actual times are exponentially distributed, like real network waits.
+    :param failure_rate: Fraction of calls that raise requests.ConnectTimeout.
+    :param unavailable_rate: Fraction of calls that raise ValueError, as for private or nonexistent users.
+    """
+    def get_tweets(user: str, pages: int=25) -> Iterator[Dict]:
+        if latency > 0:
+            time.sleep(random.expovariate(1 / latency))
+
+        roll = random.random()
+        if roll < failure_rate:
+            raise requests.ConnectTimeout(f"Stub timed out fetching {user}")
+        elif roll < failure_rate + unavailable_rate:
+            raise ValueError(f"Oops! Either \"{user}\" does not exist or is private.")
+
+        for i in range(count):
+            # Newest first, like a real timeline
+            yield {"tweetId": str(count - i), "isPinned": False, "isRetweet": False, "text": STUB_TWEET}
+
+    return get_tweets
+
+
+class StageTimer(object):
+    """Collects how long each call to some functions takes, keyed by stage name, across threads."""
+
+    def __init__(self):
+        self.samples = defaultdict(list)  # type: Dict[str, List[float]]
+        self._lock = Lock()
+
+    def record(self, stage: str, seconds: float):
+        with self._lock:
+            self.samples[stage].append(seconds)
+
+    def wrap(self, stage: str, func: Callable) -> Callable:
+        @wraps(func)
+        def _timed(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                self.record(stage, time.perf_counter() - start)
+
+        return _timed
+
+    @contextmanager
+    def patch(self, module, stages: Dict[str, str]):
+        """Time calls to the named functions of module while inside this context; stages maps names to stage names."""
+        originals = {name: getattr(module, name) for name in stages}
+        try:
+            for name, stage in stages.items():
+                setattr(module, name, self.wrap(stage, originals[name]))
+            yield self
+        finally:
+            for name, original in originals.items():
+                setattr(module, name, original)
+
+
+def percentile(samples: Sequence[float], p: float) -> float:
+    """The nearest-rank pth percentile of samples."""
+    ordered = sorted(samples)
+    return ordered[max(math.ceil(len(ordered) * p / 100) - 1, 0)]
+
+
+def run_load(
+    app: Flask,
+    requests_total: int,
+    concurrency: int,
+    ids_per_request: int,
+    users: int,
+    get_tweets: Optional[Callable]=None
+) -> Dict:
+    """Send requests_total GET requests to app, concurrency at a time, and report how it went.
+
+    Each request asks about ids_per_request users drawn from a pool of users distinct names, so a smaller pool means
+    more cache hits.  The app's scraping goes through get_tweets (a stub by default) instead of Twitter.
+
+    Returns the total wall time, the throughput, and the latency samples of each stage.
+    """
+    names = [f"bench_user_{i}" for i in range(users)]
+    timer = StageTimer()
+    original_get_tweets = sockpuppet.api.v1.get_tweets
+
+    def _request(_) -> int:
+        ids = ",".join(random.sample(names, min(ids_per_request, users)))
+        client = app.test_client()
+        start = time.perf_counter()
+        response = client.get(f"/api/1/user?ids={ids}", headers={"Accept": "application/json"})
+        timer.record("request", time.perf_counter() - start)
+        return response.status_code
+
+    sockpuppet.api.v1.get_tweets = get_tweets or stub_get_tweets()
+    try:
+        with timer.patch(sockpuppet.api.v1, {"get_recent_tweets": "scrape", "guess_batch": "model"}):
+            start = time.perf_counter()
+            with ThreadPoolExecutor(max_workers=concurrency) as executor:
+                statuses = Counter(executor.map(_request, range(requests_total)))  # type: Dict[int, int]
+            elapsed = time.perf_counter() - start
+    finally:
+        sockpuppet.api.v1.get_tweets = original_get_tweets
+
+    return {
+        "elapsed": elapsed,
+        "throughput": requests_total / elapsed,
+        "statuses": dict(statuses),
+        "stages": dict(timer.samples),
+    }
@@ -1,17 +1,50 @@
 # -*- coding: utf-8 -*-
 """Click commands."""
+import csv
+import itertools
 import os
+import statistics
+import sys
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
 from glob import glob
-from subprocess import call
+from subprocess import PIPE, call, run
+from threading import BoundedSemaphore
+from typing import Dict, Iterator, List, Optional, Sequence, Tuple, Union
 
 import click
+import requests
+import simplejson
 from flask import current_app
 from flask.cli import with_appcontext
 from werkzeug.exceptions import MethodNotAllowed, NotFound
 
+from sockpuppet.api.cache import decay_popularity, get_cached_guesses, get_popular_users, is_stale, measure_usage
+from sockpuppet.api.guesses import UNAVAILABLE, UNKNOWN, Guess, verdict
+from sockpuppet.api.model import get_model_version, guess_batch
+from sockpuppet.api.sources import ParseError
+from sockpuppet.api.v1 import refresh_users, scrape_tweets
+from sockpuppet.bench import StubModelServer, percentile, run_load, stub_get_tweets
+from sockpuppet.errors import ModelError
+
 HERE = os.path.abspath(os.path.dirname(__file__))
 PROJECT_ROOT = os.path.join(HERE, os.pardir)
 TEST_PATH = os.path.join(PROJECT_ROOT, 'tests')
+STARTUP_PROBE = """
+import sys
+import time
+
+started = time.perf_counter()
+import sockpuppet.app
+imported = time.perf_counter() - started
+
+import simplejson
+from sockpuppet import settings
+
+app = sockpuppet.app.create_app(getattr(settings, sys.argv[1])).app
+timings = [{"name": "import", "duration": imported * 1000}] + app.extensions["startup_timing"].as_list()
+print(simplejson.dumps(timings))
+"""
 
 
 @click.command()
@@ -124,3 +157,315 @@ def urls(url, order):
 
     for row in rows:
         click.echo(str_template.format(*row[:column_length]))
+
+
+@click.command()
+@click.option('-n', '--top', default=1000,
+              help='How many of the most-requested users to keep warm')
+@click.option('-w', '--workers', default=4,
+              help='Most refreshes to run at once')
+@click.option('-r', '--rate', default=10.0,
+              help='Most users to refresh per second')
+@click.option('-b', '--batch-size', default=10,
+              help='How many users to look up with each refresh')
+@click.option('-i', '--interval', default=60,
+              help='Seconds between scans of the most-requested users')
+@click.option('--half-life', default=3600 * 24,
+              help='Seconds after which a lookup counts half as much toward popularity')
+@click.option('--once', default=False, is_flag=True,
+              help='Scan once, wait for its refreshes to finish, and exit (e.g. when run by cron)')
+@with_appcontext
+def refresh(top, workers, rate, batch_size, interval, half_life, once):
+    """Keep the most-requested users' cached guesses from going stale, until interrupted.
+
+    Every interval seconds, the top users are ranked by how often they've been looked up lately, and those whose guesses
+    are missing, were made by another model, or would go stale before this scan gets back around to them are looked up
+    again in the background.
+    """
+    app = current_app._get_current_object()
+    slots = BoundedSemaphore(workers)
+    last_decay = time.monotonic()
+
+    def _refresh(names: Sequence[str]):
+        with app.app_context():
+            try:
+                refresh_users(names)
+            except Exception:
+                app.logger.exception('Failed to refresh %s', ', '.join(names))
+            finally:
+                slots.release()
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        try:
+            while True:
+                started = time.monotonic()
+                decay_popularity(0.5 ** ((started - last_decay) / half_life), top * 10)
+                last_decay = started
+
+                model_version = get_model_version()
+                names = get_popular_users(top)
+                horizon = interval + (len(names) / rate)
+                due = [
+                    name for name, entry in zip(names, get_cached_guesses(names, model_version))
+                    if entry is None or is_stale(entry, horizon)
+                ]
+
+                click.echo('Refreshing {} of the {} most-requested users'.format(len(due), len(names)))
+
+                for start in range(0, len(due), batch_size):
+                    batch = due[start:start + batch_size]
+                    slots.acquire()
+                    executor.submit(_refresh, batch)
+                    time.sleep(len(batch) / rate)
+
+                if once:
+                    break
+
+                time.sleep(max(interval - (time.monotonic() - started), 0))
+        except KeyboardInterrupt:
+            click.echo('Waiting for refreshes in progress to finish')
+
+
+@click.command('cache-usage')
+@click.option('-n', '--sample', default=10000,
+              help='How many cached guesses and tweets to read.')
+@click.option('--migrate', default=False, is_flag=True,
+              help='Rewrite pickled entries that are read in the compact encoding.')
+@with_appcontext
+def cache_usage(sample, migrate):
+    """Report how much memory the compact encoding saves in Redis."""
+    usage = measure_usage(sample, migrate)
+    if len(usage) == 0:
+        click.echo('The cache isn\'t backed by Redis')
+        return
+
+    click.echo('{:<8}{:>10}{:>10}{:>14}{:>14}{:>10}{:>10}'.format(
+        'Kind', 'Entries', 'Legacy', 'Pickled KiB', 'Encoded KiB', 'Saved', 'Migrated'
+    ))
+    for kind, stats in usage.items():
+        saved = 1 - (stats['encoded'] / stats['pickled']) if stats['pickled'] > 0 else 0.0
+        click.echo('{:<8}{:>10}{:>10}{:>14.1f}{:>14.1f}{:>10.1%}{:>10}'.format(
+            kind,
+            stats['entries'],
+            stats['legacy'],
+            stats['pickled'] / 1024,
+            stats['encoded'] / 1024,
+            saved,
+            stats['migrated']
+        ))
+
+
+@click.command()
+@click.argument('input_path', type=click.Path(exists=True, dir_okay=False))
+@click.argument('output_path', type=click.Path(dir_okay=False))
+@click.option('-c', '--column', default='username',
+              help='CSV column or JSONL field that holds the usernames')
+@click.option('-w', '--workers', default=10,
+              help='Most users to scrape at once')
+@click.option('-b', '--batch-size', default=50,
+              help='How many users to send to the model server at once')
+@click.option('--checkpoint', default=None, type=click.Path(dir_okay=False),
+              help='Where to record progress (default: OUTPUT_PATH.checkpoint)')
+@with_appcontext
+def score(input_path, output_path, column, workers, batch_size, checkpoint):
+    """Score every user in a CSV or JSONL file, appending one JSON guess per line to OUTPUT_PATH.
+
+    The input is streamed in batches, and the next batch is scraped while the model server scores the current one, so
+    memory use doesn't grow with the size of the file.  Progress is checkpointed after every batch; running the same
+    command again after an interruption picks up where it left off, and running it without a checkpoint starts
+    OUTPUT_PATH afresh.
+
+    Tweets are scraped straight from Twitter without going through the cache, so that a sweep of many accounts doesn't
+    evict the ones live traffic needs.
+    """
+    app = current_app._get_current_object()
+    checkpoint = checkpoint or output_path + '.checkpoint'
+
+    done, offset = _read_checkpoint(checkpoint)
+    if done > 0:
+        click.echo('Resuming after {} users'.format(done))
+
+    names = itertools.islice(_read_usernames(input_path, column), done, None)
+    batches = iter(lambda: list(itertools.islice(names, batch_size)), [])
+
+    def _scrape(user: str) -> Union[Sequence[str], None, Exception]:
+        with app.app_context():
+            try:
+                return [text for _, text in scrape_tweets(user.lstrip('@'), 20)]
+            except ValueError:
+                # The user is private or doesn't exist
+                return None
+            except (requests.RequestException, ParseError) as e:
+                app.logger.error('Failed to fetch tweets from %s: %s', user, e)
+                return e
+
+    model_version = get_model_version()
+    with ThreadPoolExecutor(max_workers=workers) as executor, open(output_path, 'a') as output:
+        # Anything written after the last checkpoint belongs to a batch that'll be scored again, and without one,
+        # everything does
+        output.truncate(offset)
+        pending = None  # type: Optional[Tuple[List[str], List[Future]]]
+        for batch in itertools.chain(batches, [None]):
+            # Start scraping the next batch before scoring this one, so that the two overlap
+            scraping = None if batch is None else (batch, [executor.submit(_scrape, u) for u in batch])
+
+            if pending is not None:
+                for guess in _score_batch(*pending):
+                    output.write(simplejson.dumps(dict(guess._asdict(), model=model_version)) + '\n')
+                output.flush()
+
+                done += len(pending[0])
+                _write_checkpoint(checkpoint, done, output.tell())
+                click.echo('Scored {} users'.format(done))
+
+            pending = scraping
+
+
+def _read_usernames(path: str, column: str) -> Iterator[str]:
+    with open(path, newline='') as f:
+        if path.endswith('.jsonl') or path.endswith('.ndjson'):
+            # Each line may be a bare string or an object with the username in the given field
+            records = (simplejson.loads(line) for line in f if len(line.strip()) > 0)
+            names = (r if isinstance(r, str) else r[column] for r in records)
+        else:
+            names = (row[column] for row in csv.DictReader(f))
+
+        for name in names:
+            name = name.strip()
+            if len(name) > 0:
+                yield name
+
+
+def _read_checkpoint(path: str) -> Tuple[int, int]:
+    """Return how many users have been scored and how long the output was at the time, or zeroes to start over."""
+    try:
+        with open(path) as f:
+            checkpoint = simplejson.load(f)  # type: Dict[str, int]
+    except FileNotFoundError:
+        return 0, 0
+
+    return checkpoint['done'], checkpoint['offset']
+
+
+def _write_checkpoint(path: str, done: int, offset: int):
+    # Replace the old checkpoint in one step, so that an interruption can't leave it half-written
+    with open(path + '.tmp', 'w') as f:
+        simplejson.dump({'done': done, 'offset': offset}, f)
+
+    os.replace(path + '.tmp', path)
+
+
+def _score_batch(batch: Sequence[str], scrapes: Sequence[Future]) -> List[Guess]:
+    tweets = [f.result() for f in scrapes]
+    available = [
+        index for index, t in enumerate(tweets) if t is not None and not isinstance(t, Exception) and len(t) > 0
+    ]
+
+    try:
+        scores = dict(zip(available, guess_batch([tweets[i] for i in available])))  # type: Dict[int, Sequence[float]]
+    except (TimeoutError, ModelError) as e:
+        current_app.logger.error(e)
+        scores = {}
+
+    guesses = []  # type: List[Guess]
+    for index, name in enumerate(batch):
+        if index in scores:
+            status = verdict(scores[index])
+        elif tweets[index] is None:
+            status = UNAVAILABLE
+        else:
+            status = UNKNOWN
+
+        guesses.append(Guess(id=name, type='user', status=status))
+
+    return guesses
+
+
+@click.command()
+@click.option('-n', '--requests', 'requests_total', default=1000,
+              help='How many requests to send')
+@click.option('-c', '--concurrency', default=16,
+              help='How many requests to have in flight at once')
+@click.option('--ids', default=5,
+              help='How many users each request asks about')
+@click.option('--users', default=500,
+              help='How many distinct users to draw from; fewer means more cache hits')
+@click.option('--scrape-latency', default=0.2,
+              help='Mean seconds the stub Twitter takes to return a timeline')
+@click.option('--scrape-failure-rate', default=0.01,
+              help='Fraction of scrapes that time out')
+@click.option('--unavailable-rate', default=0.02,
+              help='Fraction of users that are private or nonexistent')
+@click.option('--model-latency', default=0.05,
+              help='Seconds the stub model server takes to answer a request')
+@click.option('--model-failure-rate', default=0.0,
+              help='Fraction of model requests that hang until clients give up on them')
+@click.option('--model-workers', default=4,
+              help='How many requests the stub model server works on at once')
+def bench(requests_total, concurrency, ids, users, scrape_latency, scrape_failure_rate, unavailable_rate,
+          model_latency, model_failure_rate, model_workers):
+    """Load-test the API against local stand-ins for Twitter and the model server, then report latencies.
+
+    Runs without Redis, the model or a network connection.  Reports throughput and the 50th, 95th and 99th percentile
+    latencies of whole requests, of each scrape, and of each round trip to the model server.
+    """
+    # Imported here because the app module imports this one
+    from sockpuppet.app import create_app
+    from sockpuppet.settings import BenchConfig
+
+    get_tweets = stub_get_tweets(scrape_latency, scrape_failure_rate, unavailable_rate)
+    with StubModelServer(BenchConfig.ZMQ_CONNECT_ADDR, model_latency, model_failure_rate, model_workers):
+        app = create_app(BenchConfig).app
+        report = run_load(app, requests_total, concurrency, ids, users, get_tweets)
+
+    click.echo('{} requests in {:.2f}s ({:.1f} requests/s)'.format(
+        requests_total, report['elapsed'], report['throughput']
+    ))
+    click.echo('Responses: ' + ', '.join('{} x {}'.format(n, s) for s, n in sorted(report['statuses'].items())))
+    click.echo('{:<10}{:>8}{:>10}{:>10}{:>10}'.format('Stage', 'Count', 'p50 ms', 'p95 ms', 'p99 ms'))
+    for stage in ('request', 'scrape', 'model'):
+        samples = report['stages'].get(stage, [])
+        if len(samples) == 0:
+            click.echo('{:<10}{:>8}'.format(stage, 0))
+            continue
+
+        click.echo('{:<10}{:>8}{:>10.1f}{:>10.1f}{:>10.1f}'.format(
+            stage, len(samples), *(percentile(samples, p) * 1000 for p in (50, 95, 99))
+        ))
+
+
+@click.command()
+@click.option('-c', '--config', 'config_name', default='ProdConfig',
+              help='Name of the configuration class in sockpuppet.settings to start the app with')
+@click.option('-n', '--runs', default=5,
+              help='How many fresh processes to time')
+@click.option('--fast/--no-fast', default=None,
+              help='Turn fast-start mode on or off (default: as SOCKDRAWER_FAST_START says)')
+def startup(config_name, runs, fast):
+    """Time how long a newly-spawned worker takes to import and create the app, phase by phase.
+
+    Each run is a fresh Python process, so nothing has been imported or cached in memory yet; this is what a uWSGI
+    worker respawn or a new container pays.  Reports the first run separately, since in fast-start mode it's the one
+    that fills the spec cache.
+    """
+    env = dict(os.environ)
+    if fast is not None:
+        env['SOCKDRAWER_FAST_START'] = '1' if fast else '0'
+
+    results = []  # type: List[List[Dict]]
+    for _ in range(runs):
+        probe = run(
+            [sys.executable, '-c', STARTUP_PROBE, config_name], cwd=PROJECT_ROOT, env=env, stdout=PIPE, stderr=PIPE
+        )
+        if probe.returncode != 0:
+            raise click.ClickException('App failed to start:\n' + probe.stderr.decode(errors='replace'))
+
+        results.append(simplejson.loads(probe.stdout.decode().splitlines()[-1]))
+
+    click.echo('{:<12}{:>12}{:>12}'.format('Phase', 'First ms', 'Median ms'))
+    for index, phase in enumerate(results[0]):
+        durations = [r[index]['duration'] for r in results]
+        click.echo('{:<12}{:>12.1f}{:>12.1f}'.format(phase['name'], durations[0], statistics.median(durations)))
+
+    totals = [sum(p['duration'] for p in r) for r in results]
+    click.echo('{:<12}{:>12.1f}{:>12.1f}'.format('total', totals[0], statistics.median(totals)))
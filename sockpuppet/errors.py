@@ -20,6 +20,16 @@ class EmptyNameError(SockPuppetError):
         SockPuppetError.__init__(self, HTTPStatus.BAD_REQUEST, "Usernames must not be empty")
 
 
+class ModelError(SockPuppetError):
+    def __init__(self, error: Dict):
+        SockPuppetError.__init__(
+            self,
+            HTTPStatus.BAD_GATEWAY,
+            f"Model server answered with error {error.get('code')}: {error.get('message')}",
+            error
+        )
+
+
 class BadCharacterError(SockPuppetError):
     def __init__(self):
         SockPuppetError.__init__(self, HTTPStatus.BAD_REQUEST, "Usernames must be made of printable characters")
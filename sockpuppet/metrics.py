@@ -0,0 +1,63 @@
+# -*- coding: utf-8 -*-
+"""Prometheus metrics for the guess pipeline, served at /metrics.
+
+uWSGI runs several worker processes, each with its own copy of these metrics.  To report them all together, set the
+prometheus_multiproc_dir environment variable to an empty directory before the app is loaded (uwsgi.ini does this);
+each worker then keeps its metrics in files there, and /metrics adds them up.
+"""
+import os
+
+from prometheus_client import REGISTRY, CollectorRegistry, Counter, Gauge, Histogram, generate_latest, multiprocess
+
+MULTIPROC_DIR_VAR = "prometheus_multiproc_dir"
+
+REQUEST_SECONDS = Histogram(
+    "sockdrawer_request_seconds",
+    "Time taken to answer each HTTP request",
+    ["method", "status"]
+)
+SCRAPE_SECONDS = Histogram(
+    "sockdrawer_scrape_seconds",
+    "Time taken to scrape one user's recent tweets from Twitter"
+)
+MODEL_SECONDS = Histogram(
+    "sockdrawer_model_seconds",
+    "Time from sending requests to the model server until every reply was received",
+    ["method"]
+)
+CACHE_LOOKUPS = Counter(
+    "sockdrawer_cache_lookups_total",
+    "Cache lookups, by what was looked up and whether it was a hit, a stale hit or a miss",
+    ["cache", "result"]
+)
+VERDICTS = Counter(
+    "sockdrawer_verdicts_total",
+    "Guesses served, by status",
+    ["status"]
+)
+UPSTREAM_FAILURES = Counter(
+    "sockdrawer_upstream_failures_total",
+    "Calls to Twitter or the model server that timed out, failed, or were cut short by the request deadline",
+    ["upstream", "reason"]
+)
+IN_FLIGHT = Gauge(
+    "sockdrawer_in_flight",
+    "Requests, scrapes and model server calls currently under way",
+    ["stage"],
+    multiprocess_mode="livesum"
+)
+
+
+def is_multiprocess() -> bool:
+    return MULTIPROC_DIR_VAR in os.environ
+
+
+def collect() -> bytes:
+    """Render every metric in the Prometheus text format, summed across worker processes if there are several."""
+    if is_multiprocess():
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+    else:
+        registry = REGISTRY
+
+    return generate_latest(registry)
@@ -0,0 +1,114 @@
+# -*- coding: utf-8 -*-
+"""Fast, single-pass JSON encoding of API responses.
+
+orjson is used if it's installed, and simplejson (which is C-accelerated too) otherwise; JSON_SERIALIZER picks one
+explicitly.  Either way each response body is encoded exactly once, straight to bytes.  Error envelopes are encoded
+ahead of time, so that answering with one only takes splicing in the id.
+"""
+from functools import lru_cache
+from http import HTTPStatus
+from typing import Any, Callable, Dict, Optional, Tuple
+
+import simplejson
+from flask import Response
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+WRAPPED_ERROR_HEAD = b'{"jsonrpc":"2.0","id":null,"error":{"code":-32602,"message":"Oops","data":'
+WRAPPED_ERROR_TAIL = b"}}"
+# Non-JSON-RPC error responses (e.g. from connexion's validation) are spliced into this envelope as they are
+NO_ENVELOPE_STATUSES = frozenset((HTTPStatus.OK, HTTPStatus.NOT_MODIFIED))  # 304s mustn't have a body
+
+_simplejson_encoder = simplejson.JSONEncoder(separators=(",", ":"), namedtuple_as_object=True)
+
+
+def _default(obj: Any) -> Any:
+    if isinstance(obj, tuple) and hasattr(obj, "_asdict"):
+        # Guesses are namedtuples, which orjson won't encode by itself
+        return obj._asdict()
+
+    raise TypeError(f"Type is not JSON serializable: {type(obj).__name__}")
+
+
+def _orjson_dumps(obj: Any) -> bytes:
+    return orjson.dumps(obj, default=_default)
+
+
+def _simplejson_dumps(obj: Any) -> bytes:
+    return _simplejson_encoder.encode(obj).encode("utf-8")
+
+
+SERIALIZERS = {"simplejson": _simplejson_dumps}  # type: Dict[str, Callable[[Any], bytes]]
+if orjson is not None:
+    SERIALIZERS["orjson"] = _orjson_dumps
+
+_dumps = SERIALIZERS.get("orjson", _simplejson_dumps)  # type: Callable[[Any], bytes]
+
+
+def use_serializer(name: str):
+    """Encode responses with the named serializer from now on; "auto" picks the fastest one that's installed.
+
+    :raises ValueError: if there's no such serializer, or it isn't installed.
+    """
+    global _dumps
+
+    if name == "auto":
+        name = "orjson" if "orjson" in SERIALIZERS else "simplejson"
+
+    if name not in SERIALIZERS:
+        raise ValueError(f"JSON serializer {name} isn't available, choose from auto, {', '.join(SERIALIZERS)}")
+
+    _dumps = SERIALIZERS[name]
+
+
+def serializer_name() -> str:
+    return next(name for name, dumps in SERIALIZERS.items() if dumps is _dumps)
+
+
+def dumps(obj: Any) -> bytes:
+    """Encode obj as compact UTF-8 JSON with the current serializer."""
+    return _dumps(obj)
+
+
+@lru_cache(maxsize=64)
+def _error_envelope(code: int, message: str) -> Tuple[bytes, bytes]:
+    # The id goes last, so the envelope can be split around it
+    head, tail = dumps({"jsonrpc": "2.0", "error": {"code": code, "message": message}, "id": None}).rsplit(b"null", 1)
+
+    return head, tail
+
+
+def error_body(response_id: Optional[int], code: int, message: str) -> bytes:
+    """A JSON-RPC error envelope with this id, built from a pre-encoded template."""
+    head, tail = _error_envelope(code, message)
+
+    return head + (b"null" if response_id is None else str(int(response_id)).encode()) + tail
+
+
+class JSONRPCResponse(Response):
+    """A response whose body is already a complete JSON-RPC envelope, so it needn't be wrapped in another."""
+
+    default_mimetype = "application/json"
+
+
+def json_response(obj: Any, status: int) -> JSONRPCResponse:
+    return JSONRPCResponse(dumps(obj), status=status)
+
+
+def error_response(response_id: Optional[int], code: int, message: str, status: int) -> JSONRPCResponse:
+    return JSONRPCResponse(error_body(response_id, code, message), status=status)
+
+
+def wrapped_error_body(body: bytes, is_json: bool) -> bytes:
+    """A JSON-RPC envelope for the body of a non-JSON-RPC error response, with the body spliced in if it's JSON."""
+    data = body if is_json and len(body.strip()) > 0 else b"null"
+
+    return WRAPPED_ERROR_HEAD + data + WRAPPED_ERROR_TAIL
+
+
+def wrap_error(response: Response) -> JSONRPCResponse:
+    """Wrap a non-JSON-RPC error response in a JSON-RPC envelope, splicing its JSON body in without re-encoding it."""
+    return JSONRPCResponse(wrapped_error_body(response.get_data(), response.is_json), status=response.status_code)
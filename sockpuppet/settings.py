@@ -2,6 +2,7 @@
 """Application configuration."""
 import os
 import os.path
+
 from simplejson import JSONEncoder
 
 
@@ -54,9 +55,31 @@ class Config(object):
     CACHE_REDIS_PORT = int(os.environ.get("SOCKDRAWER_REDIS_PORT", 6379))
     CACHE_REDIS_PASSWORD = os.environ.get("SOCKDRAWER_REDIS_PASSWORD")
     CACHE_REDIS_DB = os.environ.get("SOCKDRAWER_REDIS_DB", 0)
+    GUESS_CACHE_TIMEOUT = int(os.environ.get("SOCKDRAWER_GUESS_CACHE_TIMEOUT", CACHE_DEFAULT_TIMEOUT))
+    GUESS_CACHE_SOFT_TIMEOUT = int(os.environ.get("SOCKDRAWER_GUESS_CACHE_SOFT_TIMEOUT", 3600 * 24))
+    GUESS_CACHE_UNAVAILABLE_TIMEOUT = int(os.environ.get("SOCKDRAWER_GUESS_CACHE_UNAVAILABLE_TIMEOUT", 3600))
+    GUESS_CACHE_UNAVAILABLE_SOFT_TIMEOUT = int(os.environ.get("SOCKDRAWER_GUESS_CACHE_UNAVAILABLE_SOFT_TIMEOUT", 600))
+    TWEET_CACHE_TIMEOUT = int(os.environ.get("SOCKDRAWER_TWEET_CACHE_TIMEOUT", CACHE_DEFAULT_TIMEOUT))
+    LOCAL_CACHE_SIZE = int(os.environ.get("SOCKDRAWER_LOCAL_CACHE_SIZE", 10000))  # Guesses per worker, 0 to disable
+    LOCAL_CACHE_TIMEOUT = int(os.environ.get("SOCKDRAWER_LOCAL_CACHE_TIMEOUT", 10))  # Seconds
+    CACHE_COMPRESSION = os.environ.get("SOCKDRAWER_CACHE_COMPRESSION", "auto")  # "auto", "zstd" or "zlib"
+    GUESS_LEASE_TIMEOUT = int(os.environ.get("SOCKDRAWER_GUESS_LEASE_TIMEOUT", 30))  # Seconds
+    GUESS_LEASE_WAIT = int(os.environ.get("SOCKDRAWER_GUESS_LEASE_WAIT", 10000))  # Milliseconds
+    GUESS_LEASE_POLL_INTERVAL = int(os.environ.get("SOCKDRAWER_GUESS_LEASE_POLL_INTERVAL", 50))  # Milliseconds
     SOCK_HOST = os.environ.get("SOCKDRAWER_SOCK_HOST")
-    ZMQ_SOCKET_TYPE = os.environ.get("SOCKDRAWER_ZMQ_SOCKET_TYPE", "REQ")
+    ZMQ_SOCKET_TYPE = os.environ.get("SOCKDRAWER_ZMQ_SOCKET_TYPE", "DEALER")
+    # Was REQ, which allows one request in flight per socket and is stuck after a timeout; DEALER pipelines requests
+    # and drops late replies.  Set SOCKDRAWER_ZMQ_SOCKET_TYPE=REQ for the old behavior
     ZMQ_CONNECT_ADDR = os.environ.get("SOCKDRAWER_ZMQ_CONNECT_ADDR")
+    ZMQ_POOL_SIZE = int(os.environ.get("SOCKDRAWER_ZMQ_POOL_SIZE", 4))
+    ZMQ_POOL_PREWARM = os.environ.get("SOCKDRAWER_ZMQ_POOL_PREWARM", "1") != "0"  # In uWSGI workers only
+    ZMQ_PING_TIMEOUT = int(os.environ.get("SOCKDRAWER_ZMQ_PING_TIMEOUT", 1000))
+    ZMQ_LINGER = int(os.environ.get("SOCKDRAWER_ZMQ_LINGER", 0))
+    ZMQ_SNDHWM = int(os.environ.get("SOCKDRAWER_ZMQ_SNDHWM", 1000))
+    ZMQ_RCVHWM = int(os.environ.get("SOCKDRAWER_ZMQ_RCVHWM", 1000))
+    ZMQ_HEARTBEAT_IVL = int(os.environ.get("SOCKDRAWER_ZMQ_HEARTBEAT_IVL", 2000))
+    ZMQ_HEARTBEAT_TIMEOUT = int(os.environ.get("SOCKDRAWER_ZMQ_HEARTBEAT_TIMEOUT", 2000))
+    ZMQ_HEARTBEAT_TTL = int(os.environ.get("SOCKDRAWER_ZMQ_HEARTBEAT_TTL", 6000))
     SOCK_DIR = os.environ.get("SOCK_DIR", os.path.expanduser("~/code/Sock"))
     SOCK_MAIN_NAME = os.environ.get("SOCK_MAIN_NAME", "main.py")
     SOCK_TRAINED_MODEL_PATH = os.environ.get(
@@ -71,6 +94,26 @@ class Config(object):
     )
 
     SOCK_TIMEOUT = int(os.environ.get("SOCKDRAWER_SOCK_TIMEOUT", 5000))
+    SOCK_MODEL_VERSION_TTL = int(os.environ.get("SOCKDRAWER_SOCK_MODEL_VERSION_TTL", 60))
+    SOCK_MODEL_VERSION_RETRY = int(os.environ.get("SOCKDRAWER_SOCK_MODEL_VERSION_RETRY", 5))  # Seconds after a timeout
+    REQUEST_DEADLINE = int(os.environ.get("SOCKDRAWER_REQUEST_DEADLINE", 8000))  # Milliseconds
+    SCRAPE_DEADLINE_SHARE = float(os.environ.get("SOCKDRAWER_SCRAPE_DEADLINE_SHARE", 0.7))
+    SCRAPE_WORKERS = int(os.environ.get("SOCKDRAWER_SCRAPE_WORKERS", 10))
+    REFRESH_WORKERS = int(os.environ.get("SOCKDRAWER_REFRESH_WORKERS", 2))
+    REFRESH_QUEUE_SIZE = int(os.environ.get("SOCKDRAWER_REFRESH_QUEUE_SIZE", 100))  # Most users refreshing at once
+    TWEET_SOURCE = os.environ.get("SOCKDRAWER_TWEET_SOURCE", "session")  # "session" or "twitter_scraper"
+    SCRAPE_CONNECTIONS = int(os.environ.get("SOCKDRAWER_SCRAPE_CONNECTIONS", 100))  # Per process
+    SCRAPE_CONNECTIONS_PER_HOST = int(os.environ.get("SOCKDRAWER_SCRAPE_CONNECTIONS_PER_HOST", 20))  # Per process
+    SCRAPE_HOST_POOLS = int(os.environ.get("SOCKDRAWER_SCRAPE_HOST_POOLS", 4))  # Hosts kept connected to, per process
+    SCRAPE_TIMEOUT = int(os.environ.get("SOCKDRAWER_SCRAPE_TIMEOUT", 10))  # Seconds
+    SCRAPE_MAX_PAGES = int(os.environ.get("SOCKDRAWER_SCRAPE_MAX_PAGES", 3))  # Most pages read per scrape
+    SERVER_TIMING_META = os.environ.get("SOCKDRAWER_SERVER_TIMING_META", "0") != "0"
+    FAST_START = os.environ.get("SOCKDRAWER_FAST_START", "0") != "0"
+    JSON_SERIALIZER = os.environ.get("SOCKDRAWER_JSON_SERIALIZER", "auto")  # "auto", "orjson" or "simplejson"
+    SPEC_CACHE_DIR = os.environ.get(
+        "SOCKDRAWER_SPEC_CACHE_DIR",
+        os.path.join(os.environ.get("XDG_CACHE_HOME", os.path.expanduser("~/.cache")), "sockdrawer", "spec")
+    )  # Made private to the app's user if it doesn't exist, and ignored if it isn't
     LOG_LEVEL = os.environ.get("SOCKDRAWER_LOG_LEVEL", "INFO")
     HEALTH_CHECK_HOST = os.environ.get("SOCKDRAWER_HEALTH_CHECK_HOST", "http://localhost")
     VALIDATE_RESPONSES = False
@@ -99,5 +142,16 @@ class TestConfig(Config):
     TESTING = True
     DEBUG = True
     ZMQ_CONNECT_ADDR = "ipc:///tmp/sockdrawer-sock-test"
+    ZMQ_POOL_PREWARM = False  # The test model server isn't started until after the app is
     SOCK_HOST = "ipc:///tmp/sockdrawer-sock-test"
     VALIDATE_RESPONSES = True
+
+
+class BenchConfig(TestConfig):
+    """Configuration for the load-testing harness, which stands in for the model server and Redis in-process."""
+
+    DEBUG = False
+    CACHE_TYPE = 'simple'
+    ZMQ_CONNECT_ADDR = "inproc://sockdrawer-bench"
+    SOCK_HOST = "inproc://sockdrawer-bench"
+    VALIDATE_RESPONSES = False
@@ -0,0 +1,73 @@
+# -*- coding: utf-8 -*-
+"""Per-request breakdowns of where the time went, reported in the Server-Timing header of each API response.
+
+The timings of the request being answered are kept in a context variable, so that code deep in the pipeline can
+record a stage without being handed anything.  asyncio tasks inherit the variable on their own; threads don't, so
+work handed to a thread pool should be run with contextvars.copy_context().run.
+"""
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Dict, Iterator, List, Optional, Tuple
+
+_current = ContextVar("server_timing", default=None)  # type: ContextVar
+
+
+class ServerTiming(object):
+    """How long each stage of one request (or of the app's startup) took, in the order the stages finished."""
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.entries = []  # type: List[Tuple[str, float, Optional[str]]]
+
+    def record(self, name: str, seconds: float, description: Optional[str]=None):
+        # list.append is atomic, so scrapes in several threads can record at once
+        self.entries.append((name, seconds, description))
+
+    def as_header(self) -> str:
+        """Render these timings, plus the total so far, as the value of a Server-Timing header."""
+        entries = self.entries + [("total", time.perf_counter() - self.started, None)]
+
+        return ", ".join(
+            f"{name};dur={seconds * 1000:.1f}" if description is None else
+            f"{name};desc=\"{description}\";dur={seconds * 1000:.1f}"
+            for name, seconds, description in entries
+        )
+
+    def as_list(self) -> List[Dict]:
+        """Render these timings as JSON-friendly objects, with durations in milliseconds."""
+        return [
+            {"name": name, "description": description, "duration": round(seconds * 1000, 1)}
+            for name, seconds, description in self.entries
+        ]
+
+
+def current_timing() -> Optional[ServerTiming]:
+    """The timings of the request being answered, or None outside of one."""
+    return _current.get()
+
+
+@contextmanager
+def collect_timing() -> Iterator[ServerTiming]:
+    """Collect the timings of every stage run inside this context."""
+    timing = ServerTiming()
+    token = _current.set(timing)
+    try:
+        yield timing
+    finally:
+        _current.reset(token)
+
+
+@contextmanager
+def stage(name: str, description: Optional[str]=None) -> Iterator[None]:
+    """Record how long the body of this context takes as one stage of the current request, if there is one."""
+    timing = _current.get()  # type: Optional[ServerTiming]
+    if timing is None:
+        yield
+        return
+
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        timing.record(name, time.perf_counter() - started, description)
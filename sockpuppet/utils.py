@@ -1,6 +1,6 @@
 # -*- coding: utf-8 -*-
 """Helper utilities and decorators."""
-
+import time
 from collections import defaultdict, namedtuple
 from typing import Dict, List, Sequence, Tuple
 
@@ -8,3 +8,8 @@ NOT_BOT = 0
 BOT = 1
 MAX_JSON_INT = (2**53) - 1
 MIN_JSON_INT = -MAX_JSON_INT
+
+
+def remaining_ms(deadline: float) -> int:
+    """How many milliseconds are left until deadline, a time.monotonic() timestamp, or 0 if it's passed."""
+    return max(int((deadline - time.monotonic()) * 1000), 0)
@@ -14,12 +14,16 @@ import zmq
 from connexion import FlaskApp
 from flask import Flask
 from pytest import Item, Session
+from redis import Redis, RedisError
 from webtest import TestApp
 from zmq import Context, Socket
 
+import sockpuppet.api.cache
 import sockpuppet.utils
 from sockpuppet.app import create_app
-from sockpuppet.settings import TestConfig
+from sockpuppet.bench import StubModelServer
+from sockpuppet.extensions import cache
+from sockpuppet.settings import BenchConfig, TestConfig
 
 from .marks import *
 
@@ -52,6 +56,66 @@ def app() -> FlaskApp:
     ctx.pop()
 
 
+@pytest.fixture(scope="session")
+def stub_model_server() -> str:
+    """A stand-in for the model server, where BenchConfig expects it."""
+    with StubModelServer(BenchConfig.ZMQ_CONNECT_ADDR):
+        yield BenchConfig.ZMQ_CONNECT_ADDR
+
+
+@pytest.fixture(scope="session")
+def bench_app(stub_model_server: str) -> Flask:
+    """An application that talks to a stand-in model server and keeps its cache in memory."""
+    _app = create_app(BenchConfig).app
+    _app.testing = True
+
+    return _app
+
+
+class RedisBenchConfig(BenchConfig):
+    """BenchConfig, but with its cache in Redis (at SOCKDRAWER_REDIS_HOST), under keys of its own."""
+
+    CACHE_TYPE = 'redis'
+    CACHE_KEY_PREFIX = f"sockdrawer-test-{os.getpid()}:"
+
+
+@pytest.fixture(scope="session")
+def redis_app(stub_model_server: str) -> Flask:
+    """An application like bench_app, but with its cache in Redis; tests that use it are skipped if Redis isn't there.
+
+    Everything it cached is deleted afterward.
+    """
+    _app = create_app(RedisBenchConfig).app
+    _app.testing = True
+
+    with _app.app_context():
+        client = cache.cache._client  # type: Redis
+        try:
+            client.ping()
+        except RedisError as e:
+            pytest.skip(f"Redis isn't available at {RedisBenchConfig.CACHE_REDIS_HOST}: {e}")
+
+    yield _app
+
+    keys = list(client.scan_iter(match=RedisBenchConfig.CACHE_KEY_PREFIX + "*"))
+    if len(keys) > 0:
+        client.delete(*keys)
+
+
+@pytest.fixture
+def redis_client(redis_app: Flask, monkeypatch) -> Redis:
+    """The Redis client behind redis_app's cache.
+
+    Each test gets a fresh in-memory tier of guesses in front of it, since the tier is kept per process rather than per
+    app.
+    """
+    monkeypatch.setattr(sockpuppet.api.cache, "_local", None)
+    monkeypatch.setattr(sockpuppet.api.cache, "_local_pid", None)
+
+    with redis_app.app_context():
+        return cache.cache._client
+
+
 @pytest.fixture
 def client(app: Flask):
     test_client = app.test_client()
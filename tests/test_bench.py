@@ -0,0 +1,43 @@
+import time
+
+import pytest
+import zmq
+from zmq import Context
+
+from flask_zmq import JSONRPCClient
+from sockpuppet.bench import StubModelServer, percentile, stub_get_tweets
+
+ADDRESS = "inproc://sockdrawer-test-hanging"
+
+
+def test_stub_get_tweets_fails_on_demand():
+    with pytest.raises(ValueError):
+        list(stub_get_tweets(unavailable_rate=1.0)("nobody"))
+
+    assert len(list(stub_get_tweets(count=5)("somebody"))) == 5
+
+
+@pytest.mark.parametrize("socket_type", [zmq.REQ, zmq.DEALER], ids=["REQ", "DEALER"])
+def test_stub_model_server_hangs_on_demand(socket_type: int):
+    with StubModelServer(ADDRESS, failure_rate=1.0, workers=1) as server:
+        with Context.instance().socket(socket_type) as socket:
+            socket.linger = 0
+            socket.connect(ADDRESS)
+
+            with pytest.raises(TimeoutError):
+                JSONRPCClient(socket).call("ping", timeout=100)
+
+        started = time.monotonic()
+
+    # Stopping doesn't wait for the hang to end
+    assert time.monotonic() - started < server.hang
+
+
+def test_percentile():
+    samples = list(range(1, 101))
+
+    assert percentile(samples, 50) == 50
+    assert percentile(samples, 95) == 95
+    assert percentile(samples, 99) == 99
+    assert percentile(samples, 100) == 100
+    assert percentile([3.0], 95) == 3.0
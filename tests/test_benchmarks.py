@@ -0,0 +1,123 @@
+import time
+
+import pytest
+import simplejson
+import zmq
+from flask import Flask
+from zmq import Context
+
+from flask_zmq import JSONRPCClient
+from sockpuppet.api.cache import get_cached_guesses, is_stale, normalize_name, set_cached_guesses
+from sockpuppet.api.codec import encode
+from sockpuppet.api.guesses import BOT, HUMAN, Guess, merge_timeline, verdict
+from sockpuppet.api.lru import LRUCache
+from sockpuppet.api.sources import parse_tweets
+from sockpuppet.bench import StubModelServer
+from sockpuppet.serialization import SERIALIZERS, error_body
+
+ADDRESS = "inproc://sockdrawer-test-bench"
+
+
+@pytest.fixture(scope="module")
+def stub_server() -> str:
+    with StubModelServer(ADDRESS):
+        yield ADDRESS
+
+
+def test_normalize_name(benchmark):
+    assert benchmark(normalize_name, "@JesseTG") == "jessetg"
+
+
+def test_verdict(benchmark):
+    assert benchmark(verdict, [0.1, 0.9, 0.7] * 100) == BOT
+
+
+def test_is_stale(benchmark):
+    entry = {"status": HUMAN, "model": "stub", "time": time.time(), "stale": time.time() + 3600}
+
+    assert not benchmark(is_stale, entry, 60)
+
+
+def test_get_cached_guesses(benchmark, app: Flask):
+    names = [f"@Benched_User_{i}" for i in range(10)]
+    set_cached_guesses([(n, BOT, 60, 30) for n in names], "stub")
+
+    entries = benchmark(get_cached_guesses, names, "stub")
+
+    assert all(e["status"] == BOT for e in entries)
+
+
+def test_lru_cache_hits(benchmark):
+    local = LRUCache(100, 60)
+    local.set_many((f"guess:user:user_{i}", {"status": BOT}, 60) for i in range(100))
+
+    entries = benchmark(local.get_many, [f"guess:user:user_{i}" for i in range(10)])
+
+    assert all(e == {"status": BOT} for e in entries)
+
+
+def test_encode_cached_tweets(benchmark):
+    tweets = tuple(f"tweet number {i}, see http://t.co/{i:08}" for i in range(20))
+    encoded = benchmark(encode, tweets)
+
+    assert len(encoded) > 0
+
+
+def test_merge_timeline(benchmark):
+    timeline = {"newest": "20", "tweets": [[str(i), f"tweet {i}"] for i in range(20, 0, -1)]}
+    fresh = [(str(i), f"tweet {i}") for i in range(25, 20, -1)]
+
+    merged = benchmark(merge_timeline, fresh, timeline, 20)
+
+    assert merged["newest"] == "25"
+    assert len(merged["tweets"]) == 20
+
+
+def test_parse_tweets(benchmark):
+    page = "".join(
+        f'<li class="stream-item" data-item-id="{i}">{"<div class=pinned></div>" if i == 3 else ""}'
+        f'<p class="tweet-text">tweet {i}http://t.co/{i}</p></li>'
+        for i in range(40, 0, -1)
+    ) + '<li class="stream-item" data-item-id="0">Who to follow</li>'
+
+    tweets = benchmark(lambda: list(parse_tweets(page)))
+
+    assert len(tweets) == 40
+
+
+def test_encode_guesses(benchmark):
+    guesses = [Guess(status=BOT, type="user", id=f"user_{i}") for i in range(100)]
+    encoded = benchmark(simplejson.dumps, {"jsonrpc": "2.0", "id": 1, "result": guesses})
+
+    assert simplejson.loads(encoded)["result"][0] == {"status": BOT, "type": "user", "id": "user_0"}
+
+
+@pytest.mark.parametrize("serializer", sorted(SERIALIZERS))
+def test_serialize_guesses(benchmark, serializer: str):
+    guesses = [Guess(status=BOT, type="user", id=f"user_{i}") for i in range(100)]
+    encoded = benchmark(SERIALIZERS[serializer], {"jsonrpc": "2.0", "id": 1, "result": guesses})
+
+    assert simplejson.loads(encoded)["result"][0] == {"status": BOT, "type": "user", "id": "user_0"}
+
+
+def test_error_body(benchmark):
+    encoded = benchmark(error_body, 8422156, 406, "Not Acceptable")
+
+    assert simplejson.loads(encoded) == {
+        "jsonrpc": "2.0",
+        "id": 8422156,
+        "error": {"code": 406, "message": "Not Acceptable"}
+    }
+
+
+def test_guess_batch_round_trip(benchmark, stub_server: str):
+    tweets = [["this is a tweet"] * 20] * 10
+    with Context.instance().socket(zmq.DEALER) as socket:
+        socket.connect(stub_server)
+        client = JSONRPCClient(socket)
+
+        response = benchmark(client.call, "guess_batch", tweets, 1000)
+
+    assert len(response["result"]) == 10
+    assert all(len(scores) == 20 for scores in response["result"])
+
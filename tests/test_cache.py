@@ -0,0 +1,159 @@
+import pickle
+import time
+from typing import Callable
+
+import pytest
+from flask import Flask
+from redis import Redis
+
+from sockpuppet.api.cache import (
+    GUESS_KEY,
+    INVALIDATE_CHANNEL,
+    LEASE_KEY,
+    POPULARITY_KEY,
+    TWEETS_KEY,
+    acquire_lease,
+    acquire_leases,
+    get_cached_guesses,
+    get_cached_timeline,
+    is_stale,
+    measure_usage,
+    release_leases,
+    set_cached_guesses,
+    set_cached_timeline
+)
+from sockpuppet.api.codec import NONE, decode, encode, parse_header
+from sockpuppet.api.guesses import BOT, HUMAN
+
+
+def test_leases(bench_app: Flask):
+    """Only one lookup of a user holds its lease at a time, whatever the spelling of their name."""
+    with bench_app.app_context():
+        assert acquire_leases(["Leased_User", "other_user"], 60) == ["Leased_User", "other_user"]
+        assert acquire_leases(["@leased_user", "third_user"], 60) == ["third_user"]
+        assert not acquire_lease("other_user", 60)
+
+        release_leases(["Leased_User", "other_user", "third_user"])
+        assert acquire_lease("@LEASED_USER", 60)
+        release_leases(["leased_user"])
+
+
+def test_cached_guesses_round_trip(bench_app: Flask):
+    names = [f"@Cached_User_{i}" for i in range(10)]
+
+    with bench_app.app_context():
+        set_cached_guesses([(n, BOT, 60, 30) for n in names[:-1]], "stub")
+
+        entries = get_cached_guesses(names, "stub", count_lookups=True)
+        assert [e["status"] for e in entries[:-1]] == [BOT] * 9
+        assert entries[-1] is None
+
+        # Names are case-insensitive, and guesses made by another model don't count
+        assert get_cached_guesses(["cached_user_0"], "stub")[0]["status"] == BOT
+        assert get_cached_guesses(names[:1], "some other model") == [None]
+
+
+def test_stale_guesses():
+    entry = {"status": HUMAN, "model": "stub", "time": 0.0, "stale": 60.0}
+
+    assert is_stale(entry)
+    assert not is_stale(dict(entry, stale=float("inf")))
+    assert not is_stale({"status": HUMAN}, 3600)
+
+
+def test_redis_guesses_round_trip(redis_app: Flask, redis_client: Redis):
+    """Guesses are written with their own expiries, and read back in the same round trip that counts the lookups."""
+    prefix = redis_app.config["CACHE_KEY_PREFIX"]
+    names = ["Redis_User_0", "redis_user_1", "redis_user_2"]
+
+    with redis_app.app_context():
+        set_cached_guesses([(names[0], BOT, 60, 30), (names[1], HUMAN, 120, 30)], "stub")
+
+        entries = get_cached_guesses(["@redis_user_0", *names[1:]], "stub", count_lookups=True)
+        assert [e and e["status"] for e in entries] == [BOT, HUMAN, None]
+
+    assert 0 < redis_client.ttl(prefix + GUESS_KEY.format("redis_user_0")) <= 60
+    assert 60 < redis_client.ttl(prefix + GUESS_KEY.format("redis_user_1")) <= 120
+    assert redis_client.get(prefix + GUESS_KEY.format("redis_user_2")) is None
+    assert [redis_client.zscore(prefix + POPULARITY_KEY, f"redis_user_{i}") for i in range(3)] == [1, 1, 1]
+
+
+def test_redis_leases(redis_app: Flask, redis_client: Redis):
+    """Leases are taken with SET NX, expire on their own, and are shared by every spelling of a name."""
+    prefix = redis_app.config["CACHE_KEY_PREFIX"]
+
+    with redis_app.app_context():
+        assert acquire_leases(["Redis_Leased", "redis_other"], 60) == ["Redis_Leased", "redis_other"]
+        assert acquire_leases(["@redis_leased", "redis_third"], 60) == ["redis_third"]
+        assert 0 < redis_client.ttl(prefix + LEASE_KEY.format("redis_leased")) <= 60
+
+        release_leases(["Redis_Leased", "redis_other", "redis_third"])
+        assert redis_client.get(prefix + LEASE_KEY.format("redis_leased")) is None
+
+        assert acquire_lease("redis_expiring", 1)
+        time.sleep(1.5)
+        assert acquire_lease("REDIS_EXPIRING", 60)
+        release_leases(["redis_expiring"])
+
+
+def _wait_for(condition: Callable[[], bool], what: str):
+    for _ in range(50):
+        if condition():
+            return
+
+        time.sleep(0.1)
+
+    pytest.fail(f"Gave up waiting for {what}")
+
+
+def test_redis_invalidates_local_guesses(redis_app: Flask, redis_client: Redis):
+    """A guess that another worker caches anew replaces this worker's in-memory copy as soon as it's announced."""
+    prefix = redis_app.config["CACHE_KEY_PREFIX"]
+    key = GUESS_KEY.format("redis_invalidated")
+
+    with redis_app.app_context():
+        set_cached_guesses([("redis_invalidated", BOT, 60, 30)], "stub")
+        _wait_for(
+            lambda: redis_client.pubsub_numsub(prefix + INVALIDATE_CHANNEL)[0][1] > 0, "the invalidation listener"
+        )
+        # It forgets everything just after subscribing, which mustn't include what's read next
+        time.sleep(0.1)
+        assert get_cached_guesses(["redis_invalidated"], "stub")[0]["status"] == BOT
+
+        # Behind this worker's back, so only the announcement can tell it
+        redis_client.setex(name=prefix + key, value=encode({"status": HUMAN, "model": "stub"}), time=60)
+        assert get_cached_guesses(["redis_invalidated"], "stub")[0]["status"] == BOT
+
+        redis_client.publish(prefix + INVALIDATE_CHANNEL, key)
+        _wait_for(
+            lambda: get_cached_guesses(["redis_invalidated"], "stub")[0]["status"] == HUMAN, "the invalidation"
+        )
+
+
+def test_redis_encoded_values(redis_app: Flask, redis_client: Redis):
+    """Values are stored in the compact encoding, and those Flask-Caching pickled are still read and can be migrated."""
+    prefix = redis_app.config["CACHE_KEY_PREFIX"]
+    timeline = {"newest": "20", "tweets": [[str(i), f"tweet number {i}"] for i in range(20, 0, -1)]}
+    legacy = {"status": HUMAN, "model": "stub", "time": 1.0, "stale": 2.0}
+
+    with redis_app.app_context():
+        set_cached_timeline("redis_encoded", timeline, 60)
+        stored = redis_client.get(prefix + TWEETS_KEY.format("redis_encoded"))
+        assert parse_header(stored)[1] != NONE
+        assert decode(stored) == timeline
+        assert get_cached_timeline("redis_encoded") == timeline
+
+        # The way Flask-Caching pickled it before
+        redis_client.setex(
+            name=prefix + GUESS_KEY.format("redis_pickled"),
+            value=b"!" + pickle.dumps(legacy, pickle.HIGHEST_PROTOCOL),
+            time=60
+        )
+        assert get_cached_guesses(["redis_pickled"], "stub")[0] == legacy
+
+        assert measure_usage(1000, migrate=True)["guess"]["migrated"] >= 1
+
+    stored = redis_client.get(prefix + GUESS_KEY.format("redis_pickled"))
+    assert parse_header(stored)[0] is not None
+    assert decode(stored) == legacy
+    assert 0 < redis_client.ttl(prefix + GUESS_KEY.format("redis_pickled")) <= 60
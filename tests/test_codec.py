@@ -0,0 +1,42 @@
+import pickle
+
+import pytest
+
+from sockpuppet.api.codec import NONE, decode, encode, parse_header, use_compression
+
+
+def test_encode_round_trip():
+    tweets = tuple(f"tweet number {i}, see http://t.co/{i:08}" for i in range(20))
+    encoded = encode(tweets)
+
+    assert decode(encoded) == list(tweets)
+    assert len(encoded) < len(pickle.dumps(tweets, pickle.HIGHEST_PROTOCOL))
+
+
+def test_small_values_arent_compressed():
+    entry = {"status": "human", "model": "stub", "time": 1.0, "stale": 2.0}
+    encoded = encode(entry)
+
+    assert parse_header(encoded)[1] == NONE
+    assert decode(encoded) == entry
+
+
+def test_decode_legacy_pickle():
+    entry = {"status": "human", "model": "stub", "time": 1.0, "stale": 2.0}
+
+    assert decode(b"!" + pickle.dumps(entry, pickle.HIGHEST_PROTOCOL)) == entry
+
+    with pytest.raises(ValueError):
+        decode(b"neither")
+
+
+def test_decode_corrupt():
+    encoded = encode(["a tweet that's long enough to be compressed"] * 20)
+
+    with pytest.raises(ValueError):
+        decode(encoded[:-10])
+
+
+def test_use_unknown_compression():
+    with pytest.raises(ValueError):
+        use_compression("lz4")
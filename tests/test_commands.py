@@ -0,0 +1,116 @@
+import os
+from typing import Callable, Dict, Iterator, List
+
+import pytest
+import simplejson
+from flask import Flask
+
+import sockpuppet.api.v1
+import sockpuppet.commands
+from sockpuppet.api.cache import get_cached_guesses, get_cached_timeline, is_stale, set_cached_guesses
+from sockpuppet.api.guesses import BOT, HUMAN, UNAVAILABLE, UNKNOWN
+from sockpuppet.bench import stub_get_tweets
+from sockpuppet.commands import refresh, score
+
+USERS = ["somebody", "private_user", "down_user", "@somebody_else", "quiet_user"]
+
+
+@pytest.fixture
+def stub_twitter(monkeypatch) -> Callable:
+    """Stand in for Twitter, where private_user is private, down_user can't be reached and quiet_user has no tweets."""
+    stubs = {
+        "private_user": stub_get_tweets(unavailable_rate=1.0),
+        "down_user": stub_get_tweets(failure_rate=1.0),
+        "quiet_user": stub_get_tweets(count=0),
+    }
+    default = stub_get_tweets()
+
+    def get_tweets(user: str, pages: int=25) -> Iterator[Dict]:
+        return stubs.get(user, default)(user, pages)
+
+    monkeypatch.setattr(sockpuppet.api.v1, "get_tweets", get_tweets)
+
+    return get_tweets
+
+
+@pytest.fixture
+def users_csv(tmpdir) -> str:
+    path = tmpdir.join("users.csv")
+    path.write("username\n" + "\n".join(USERS) + "\n")
+
+    return str(path)
+
+
+def read_guesses(path: str) -> List[Dict]:
+    with open(path) as f:
+        return [simplejson.loads(line) for line in f]
+
+
+def test_score(bench_app: Flask, stub_twitter: Callable, users_csv: str, tmpdir):
+    output = str(tmpdir.join("guesses.jsonl"))
+
+    result = bench_app.test_cli_runner().invoke(score, [users_csv, output, "--batch-size", "3"])
+    assert result.exit_code == 0, result.output
+
+    guesses = read_guesses(output)
+    assert [g["id"] for g in guesses] == USERS
+    assert guesses[0]["status"] in (BOT, HUMAN)
+    assert guesses[1]["status"] == UNAVAILABLE
+    assert guesses[2]["status"] == UNKNOWN
+    assert guesses[4]["status"] == UNKNOWN
+    assert all(g["model"] == "stub" for g in guesses)
+
+    with bench_app.app_context():
+        # A sweep of many accounts shouldn't push out the ones live traffic needs
+        assert get_cached_timeline("somebody") is None
+
+
+def test_score_starts_afresh(bench_app: Flask, stub_twitter: Callable, users_csv: str, tmpdir):
+    output = tmpdir.join("guesses.jsonl")
+    output.write('{"id": "left over from some other run"}\n')
+
+    result = bench_app.test_cli_runner().invoke(score, [users_csv, str(output)])
+    assert result.exit_code == 0, result.output
+
+    assert [g["id"] for g in read_guesses(str(output))] == USERS
+
+
+def test_score_resumes(bench_app: Flask, stub_twitter: Callable, users_csv: str, tmpdir):
+    output = tmpdir.join("guesses.jsonl")
+    scored = '{"id": "somebody", "type": "user", "status": "bot", "model": "stub"}\n'
+    output.write(scored + '{"id": "private_user", "type": "user", "st')
+    tmpdir.join("guesses.jsonl.checkpoint").write(simplejson.dumps({"done": 1, "offset": len(scored)}))
+
+    result = bench_app.test_cli_runner().invoke(score, [users_csv, str(output), "--batch-size", "2"])
+    assert result.exit_code == 0, result.output
+    assert "Resuming after 1 users" in result.output
+
+    guesses = read_guesses(str(output))
+    assert [g["id"] for g in guesses] == USERS
+    assert guesses[0]["status"] == BOT
+    assert simplejson.loads(tmpdir.join("guesses.jsonl.checkpoint").read()) == {
+        "done": len(USERS),
+        "offset": os.path.getsize(str(output))
+    }
+
+
+def test_refresh_once(bench_app: Flask, stub_twitter: Callable, monkeypatch):
+    """Popular users whose guesses are missing or going stale are looked up again, and the others are left alone."""
+    popular = ["fresh_user", "stale_user", "missing_user", "private_user"]
+    monkeypatch.setattr(sockpuppet.commands, "get_popular_users", lambda count: popular[:count])
+
+    with bench_app.app_context():
+        set_cached_guesses([("fresh_user", HUMAN, 3600, 3600), ("stale_user", HUMAN, 3600, 0)], "stub")
+        before = get_cached_guesses(popular, "stub")
+
+    result = bench_app.test_cli_runner().invoke(refresh, ["--once", "--interval", "60", "--rate", "1000"])
+    assert result.exit_code == 0, result.output
+    assert "Refreshing 3 of the 4 most-requested users" in result.output
+
+    with bench_app.app_context():
+        fresh, stale, missing, private = get_cached_guesses(popular, "stub")
+
+    assert fresh == before[0]
+    assert stale["time"] > before[1]["time"] and not is_stale(stale)
+    assert missing["status"] in (BOT, HUMAN)
+    assert private["status"] == UNAVAILABLE
@@ -1,8 +1,8 @@
 # -*- coding: utf-8 -*-
 """Test configs."""
 import pytest
-from sockpuppet.app import create_app
-from sockpuppet.settings import DevConfig, ProdConfig
+from sockpuppet.app import create_app, load_spec
+from sockpuppet.settings import DevConfig, ProdConfig, TestConfig
 
 
 @pytest.mark.xfail
@@ -20,3 +20,33 @@ def test_dev_config():
     app = create_app(DevConfig)
     assert app.config['ENV'] == 'dev'
     assert app.config['DEBUG'] is True
+
+
+def test_fast_start_spec_cache(tmpdir):
+    """Fast start reuses the parsed API spec."""
+    class FastConfig(TestConfig):
+        FAST_START = True
+        SPEC_CACHE_DIR = str(tmpdir)
+
+    parsed = load_spec(FastConfig)
+    assert len(tmpdir.listdir()) == 1
+    assert load_spec(FastConfig) == parsed
+    assert load_spec(TestConfig) == TestConfig.API_SPEC
+
+
+def test_fast_start_spec_cache_must_be_private(tmpdir):
+    """The parsed API spec isn't cached where others could tamper with it."""
+    class FastConfig(TestConfig):
+        FAST_START = True
+        SPEC_CACHE_DIR = str(tmpdir)
+
+    parsed = load_spec(FastConfig)
+    cached, = tmpdir.listdir()
+    cached.write("{}")
+    cached.chmod(0o666)
+    assert load_spec(FastConfig) == parsed
+
+    tmpdir.remove()
+    tmpdir.mkdir().chmod(0o777)
+    assert load_spec(FastConfig) == parsed
+    assert not tmpdir.listdir()
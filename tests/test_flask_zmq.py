@@ -0,0 +1,137 @@
+import asyncio
+from threading import Event, Thread
+from typing import Dict
+
+import pytest
+import zmq
+import zmq.asyncio
+from flask import Flask
+from zmq import Context, Socket
+
+from flask_zmq import AsyncJSONRPCClient, JSONRPCClient, ZMQSocket
+
+ADDRESS = "inproc://flask-zmq-test"
+
+
+@pytest.fixture
+def echo_server():
+    """A REP server that answers each request with its own params."""
+    ready = Event()
+    stop = Event()
+
+    def serve():
+        with Context.instance().socket(zmq.REP) as server:
+            server.bind(ADDRESS)
+            ready.set()
+            while not stop.is_set():
+                if server.poll(50):
+                    request = server.recv_json()  # type: Dict
+                    server.send_json({"jsonrpc": "2.0", "id": request["id"], "result": request.get("params")})
+
+    thread = Thread(target=serve)
+    thread.start()
+    ready.wait()
+
+    yield ADDRESS
+
+    stop.set()
+    thread.join()
+
+
+@pytest.fixture(params=[zmq.REQ, zmq.DEALER], ids=["REQ", "DEALER"])
+def client(request, echo_server: str) -> JSONRPCClient:
+    socket = Context.instance().socket(request.param)  # type: Socket
+    socket.connect(echo_server)
+
+    yield JSONRPCClient(socket)
+
+    socket.close(linger=0)
+
+
+def test_call(client: JSONRPCClient):
+    response = client.call("echo", ["hello"], timeout=1000)
+
+    assert response["jsonrpc"] == "2.0"
+    assert response["result"] == ["hello"]
+
+
+def test_call_many_preserves_order(client: JSONRPCClient):
+    requests = [JSONRPCClient.request("echo", [i]) for i in range(10)]
+    responses = client.call_many(requests, timeout=1000)
+
+    assert [r["id"] for r in responses] == [r["id"] for r in requests]
+    assert [r["result"] for r in responses] == [[i] for i in range(10)]
+
+
+def test_dealer_drops_late_replies(echo_server: str):
+    with Context.instance().socket(zmq.DEALER) as socket:
+        socket.connect(echo_server)
+        client = JSONRPCClient(socket)
+
+        # Pretend this request was given up on; its reply will arrive first
+        client._send(JSONRPCClient.request("echo", ["stale"]))
+
+        assert client.call("echo", ["fresh"], timeout=1000)["result"] == ["fresh"]
+
+
+@pytest.mark.parametrize("socket_type", [zmq.REQ, zmq.DEALER], ids=["REQ", "DEALER"])
+def test_timeout(socket_type: int):
+    with Context.instance().socket(socket_type) as socket:
+        socket.linger = 0
+        socket.connect("inproc://flask-zmq-test-nobody-home")
+
+        with pytest.raises(TimeoutError):
+            JSONRPCClient(socket).call("echo", timeout=50)
+
+
+def test_async_call_many_preserves_order(echo_server: str):
+    context = zmq.asyncio.Context.shadow(Context.instance().underlying)
+
+    async def _concurrent_calls():
+        # zmq.asyncio sockets belong to the loop that's current when they're made
+        client = AsyncJSONRPCClient(context.socket(zmq.DEALER))
+        client.socket.connect(echo_server)
+        try:
+            return await asyncio.gather(*(client.call("echo", [i], timeout=1000) for i in range(10)))
+        finally:
+            client.close()
+
+    loop = asyncio.new_event_loop()
+    try:
+        responses = loop.run_until_complete(_concurrent_calls())
+    finally:
+        loop.close()
+
+    assert [r["result"] for r in responses] == [[i] for i in range(10)]
+
+
+def make_app(address: str, size: int=1) -> Flask:
+    app = Flask(__name__)
+    app.config.update(ZMQ_CONNECT_ADDR=address, ZMQ_SOCKET_TYPE="DEALER", ZMQ_POOL_SIZE=size, ZMQ_LINGER=0)
+
+    return app
+
+
+def test_pools_are_per_app():
+    """Apps that connect to different addresses never get each other's sockets, even from the same extension."""
+    zmq_socket = ZMQSocket()
+    first = make_app("inproc://flask-zmq-test-first")
+    second = make_app("inproc://flask-zmq-test-second")
+    zmq_socket.init_app(first)
+    zmq_socket.init_app(second)
+
+    with first.app_context():
+        socket = zmq_socket.socket
+
+    with first.app_context():
+        assert zmq_socket.socket is socket
+
+    with second.app_context():
+        assert zmq_socket.socket is not socket
+
+    assert zmq_socket._get_pool(first) is not zmq_socket._get_pool(second)
+
+
+def test_pool_size_must_be_positive():
+    with pytest.raises(ValueError):
+        ZMQSocket(make_app(ADDRESS, size=0))
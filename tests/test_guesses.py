@@ -0,0 +1,69 @@
+from sockpuppet.api.guesses import (
+    BOT,
+    HUMAN,
+    UNKNOWN,
+    Guess,
+    batch_responses,
+    batch_users,
+    claim_refreshes,
+    dedupe_misses,
+    is_seen,
+    merge_timeline,
+    split_leased,
+    verdict
+)
+
+
+def test_verdict():
+    assert verdict([0.1, 0.9, 0.7]) == BOT
+    assert verdict([0.1, 0.9, 0.2]) == HUMAN
+    assert verdict([]) == UNKNOWN
+
+
+def test_merge_timeline():
+    timeline = {"newest": "20", "tweets": [[str(i), f"tweet {i}"] for i in range(20, 0, -1)]}
+    fresh = [(str(i), f"tweet {i}") for i in range(25, 20, -1)]
+
+    merged = merge_timeline(fresh, timeline, 20)
+
+    assert merged["newest"] == "25"
+    assert [i for i, _ in merged["tweets"]] == [str(i) for i in range(25, 5, -1)]
+    assert is_seen("20", False, merged)
+    assert not is_seen("20", True, merged)
+    assert not is_seen("20", False, merged, retweet=True)
+    assert not is_seen("26", False, merged)
+
+    # The high-water mark stays put even once the tweet that set it is gone
+    assert merge_timeline([], {"newest": "30", "tweets": []}, 20)["newest"] == "30"
+
+
+def test_claim_refreshes():
+    """Each user is refreshed at most once at a time, and only so many at once."""
+    refreshing = {"busy_user"}
+
+    assert claim_refreshes(["@Busy_User", "idle_user", "IDLE_USER", "another_user"], refreshing, 2) == ["idle_user"]
+    assert refreshing == {"busy_user", "idle_user"}
+
+
+def test_batch_responses():
+    """Each spelling of a name gets the guess for the first one, under the id it was asked for."""
+    batch = [
+        {"jsonrpc": "2.0", "id": 1, "method": "guess", "params": {"ids": ["JesseT_G", "somebody"]}},
+        {"jsonrpc": "2.0", "id": 2, "method": "guess", "params": {"ids": ["@jesset_g"]}},
+    ]
+
+    users = batch_users(batch)
+    assert list(users.values()) == ["JesseT_G", "somebody"]
+
+    guesses = [Guess(id="JesseT_G", type="user", status=BOT), Guess(id="somebody", type="user", status=HUMAN)]
+    responses = batch_responses(batch, users, guesses)
+
+    assert [r["id"] for r in responses] == [1, 2]
+    assert responses[1]["result"] == [Guess(id="@jesset_g", type="user", status=BOT)]
+
+
+def test_dedupe_misses():
+    ids = ["JesseT_G", "somebody", "@jesset_g", "JESSET_G"]
+
+    assert dedupe_misses(ids, [0, 2, 3]) == ([0], {2: 0, 3: 0})
+    assert split_leased(ids, [0, 1], ["jesset_g"]) == ([0], [1])
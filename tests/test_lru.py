@@ -0,0 +1,26 @@
+from sockpuppet.api.lru import LRUCache
+
+
+def test_get_many():
+    local = LRUCache(100, 60)
+    local.set_many((f"user_{i}", i, 60) for i in range(10))
+
+    assert local.get_many(["user_0", "user_9", "user_10"]) == [0, 9, None]
+
+
+def test_evicts_and_expires():
+    local = LRUCache(2, 60)
+    local.set_many([("a", 1, 60), ("b", 2, 60)])
+    local.get_many(["a"])
+    local.set_many([("c", 3, 60), ("d", 4, 0)])
+
+    assert local.get_many(["a", "b", "c", "d"]) == [1, None, 3, None]
+
+
+def test_delete_many():
+    local = LRUCache(10, 60)
+    local.set_many([("a", 1, 60), ("b", 2, 60)])
+    local.delete_many(["a", "nobody"])
+
+    assert local.get_many(["a", "b"]) == [None, 2]
+    assert len(local) == 1
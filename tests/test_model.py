@@ -0,0 +1,41 @@
+from typing import Dict, List
+
+import pytest
+from flask import Flask
+
+import sockpuppet.api.model
+from sockpuppet.api.model import get_model_version, guess_batch
+from sockpuppet.errors import ModelError
+
+
+@pytest.fixture
+def unreachable_model(app: Flask, monkeypatch) -> List[str]:
+    """A model server that never answers; returns the methods it was asked for."""
+    calls = []  # type: List[str]
+
+    def query_model(method: str, params=None, timeout=None) -> Dict:
+        calls.append(method)
+        raise TimeoutError("Failed to get response from model server")
+
+    monkeypatch.setattr(sockpuppet.api.model, "query_model", query_model)
+    monkeypatch.setattr(sockpuppet.api.model, "_model_version", "1.0")
+    monkeypatch.setattr(sockpuppet.api.model, "_model_version_expires", 0.0)
+
+    return calls
+
+
+def test_model_version_backs_off_after_timeout(unreachable_model: List[str]):
+    """While the model server is down, its version is asked for once per retry interval, not once per request."""
+    assert get_model_version() == "1.0"
+    assert get_model_version() == "1.0"
+    assert unreachable_model == ["version"]
+
+
+def test_guess_batch_raises_model_errors(app: Flask, monkeypatch):
+    def query_model(method: str, params=None, timeout=None) -> Dict:
+        return {"jsonrpc": "2.0", "id": 1, "error": {"code": -32602, "message": "Invalid params"}}
+
+    monkeypatch.setattr(sockpuppet.api.model, "query_model", query_model)
+
+    with pytest.raises(ModelError):
+        guess_batch([["a tweet"]])
@@ -380,6 +380,22 @@ def test_error_provided(testapp: TestApp, request_response: RequestResponse):
         assert "error" not in response.json
 
 
+def test_batch_post(testapp: TestApp):
+    batch = [
+        {"jsonrpc": "2.0", "id": 689, "method": "guess", "params": {"ids": ["JesseT_G", "ElaineDiMasi"]}},
+        {"jsonrpc": "2.0", "id": 690, "method": "guess", "params": {"ids": ["@jesset_g"]}},
+    ]
+    response = testapp.post_json("/api/1/user", batch, expect_errors=True)  # type: TestResponse
+
+    assert response.status_code == HTTPStatus.OK
+    assert isinstance(response.json, list)
+    assert [r["id"] for r in response.json] == [689, 690]
+    assert [g["id"] for g in response.json[1]["result"]] == ["@jesset_g"]
+
+    # Both entries asked about the same user, so they should agree about them
+    assert response.json[0]["result"][0]["status"] == response.json[1]["result"][0]["status"]
+
+
 # @pytest.mark.skip
 # def test_error_provided(testapp: TestApp, user_request: Tuple[TestResponse, HTTPStatus]):
 #     pass
@@ -0,0 +1,37 @@
+import pytest
+
+from sockpuppet.api.sources import ParseError, TweetSource, parse_tweets
+
+
+def stream_item(tweet_id: int, pinned: bool=False, retweet: bool=False) -> str:
+    return (
+        f'<li class="stream-item" data-item-id="{tweet_id}">'
+        f'<div class="tweet js-stream-tweet"{" data-retweet-id=1" if retweet else ""}>'
+        f'{"<div class=pinned></div>" if pinned else ""}'
+        f'<p class="tweet-text">tweet {tweet_id}http://t.co/{tweet_id}</p></div></li>'
+    )
+
+
+def test_parse_tweets():
+    page = "".join(stream_item(i, pinned=i == 3, retweet=i == 5) for i in range(40, 0, -1))
+    page += '<li class="stream-item" data-item-id="0">Who to follow</li>'
+
+    tweets = list(parse_tweets(page))
+
+    assert len(tweets) == 40
+    assert tweets[0] == {"tweetId": "40", "isPinned": False, "isRetweet": False, "text": "tweet 40 http://t.co/40"}
+    assert [t["tweetId"] for t in tweets if t["isPinned"]] == ["3"]
+    assert [t["tweetId"] for t in tweets if t["isRetweet"]] == ["5"]
+
+
+def test_parse_tweets_without_ids():
+    with pytest.raises(ParseError):
+        list(parse_tweets('<li class="stream-item"><p class="tweet-text">who am I</p></li>'))
+
+
+def test_tweet_source_is_abstract():
+    class Incomplete(TweetSource):
+        pass
+
+    with pytest.raises(TypeError):
+        Incomplete()
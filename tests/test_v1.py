@@ -0,0 +1,267 @@
+import time
+from http import HTTPStatus
+from threading import Timer, active_count
+from typing import Callable, Dict, Iterator, List, Sequence
+
+import pytest
+from flask import Flask
+from jsonrpc.exceptions import JSONRPCInvalidRequest
+
+import sockpuppet.api.v1
+from sockpuppet.api.cache import acquire_lease, get_cached_guesses, release_leases, set_cached_guesses
+from sockpuppet.api.sources import ParseError
+from sockpuppet.api.guesses import BOT, HUMAN, UNAVAILABLE, UNKNOWN
+from sockpuppet.api.v1 import fetch_all_tweets, get_recent_tweets, guess_users, lookup_users
+from sockpuppet.bench import stub_get_tweets
+from sockpuppet.errors import ModelError
+
+
+@pytest.fixture
+def scraped(monkeypatch) -> List[str]:
+    """Stand in for Twitter, where private_user is private, quiet_user has no tweets and slow_user takes 3s to answer;
+    returns who's scraped.
+    """
+    users = []  # type: List[str]
+    stubs = {"private_user": stub_get_tweets(unavailable_rate=1.0), "quiet_user": stub_get_tweets(count=0)}
+    default = stub_get_tweets()
+
+    def get_tweets(user: str, pages: int=25) -> Iterator[Dict]:
+        users.append(user)
+        if user == "slow_user":
+            time.sleep(3)
+
+        return stubs.get(user, default)(user, pages)
+
+    monkeypatch.setattr(sockpuppet.api.v1, "get_tweets", get_tweets)
+
+    return users
+
+
+def stub_timeline(tweets: List[Dict], pulled: List[str]) -> Callable:
+    """A stand-in for get_tweets that serves these tweets to everyone, noting the id of each one it's asked for."""
+    def get_tweets(user: str, pages: int=25) -> Iterator[Dict]:
+        for t in tweets:
+            pulled.append(t["tweetId"])
+            yield t
+
+    return get_tweets
+
+
+def test_get_recent_tweets_streams(bench_app: Flask, monkeypatch):
+    pulled = []  # type: List[str]
+
+    def timeline(newest: int) -> List[Dict]:
+        return [{"tweetId": str(i), "isPinned": False, "text": f"tweet {i}"} for i in range(newest, 0, -1)]
+
+    with bench_app.app_context():
+        monkeypatch.setattr(sockpuppet.api.v1, "get_tweets", stub_timeline(timeline(100), pulled))
+        assert get_recent_tweets("Streaming_User", 5) == tuple(f"tweet {i}" for i in range(100, 95, -1))
+        assert pulled == ["100", "99", "98", "97", "96"]
+
+        # Next time, only what's newer than the last scrape is read (plus the one tweet that shows where to stop)
+        pulled.clear()
+        monkeypatch.setattr(sockpuppet.api.v1, "get_tweets", stub_timeline(timeline(102), pulled))
+        assert get_recent_tweets("Streaming_User", 5) == tuple(f"tweet {i}" for i in range(102, 97, -1))
+        assert pulled == ["102", "101", "100"]
+
+
+def test_get_recent_tweets_reads_past_retweets(bench_app: Flask, monkeypatch):
+    """A retweet carries the id of the original, which may be older than what was scraped last time."""
+    pulled = []  # type: List[str]
+    tweets = [{"tweetId": str(i), "isPinned": False, "isRetweet": False, "text": f"tweet {i}"} for i in (10, 9)]
+
+    with bench_app.app_context():
+        monkeypatch.setattr(sockpuppet.api.v1, "get_tweets", stub_timeline(tweets, pulled))
+        assert get_recent_tweets("Retweeting_User", 5) == ("tweet 10", "tweet 9")
+
+        retweet = {"tweetId": "3", "isPinned": False, "isRetweet": True, "text": "retweet of 3"}
+        newer = [{"tweetId": str(i), "isPinned": False, "isRetweet": False, "text": f"tweet {i}"} for i in (12, 11)]
+        timeline = [newer[0], retweet, newer[1]] + tweets
+        monkeypatch.setattr(sockpuppet.api.v1, "get_tweets", stub_timeline(timeline, pulled))
+        pulled.clear()
+
+        # The retweet doesn't stop the scrape, but the first original that's been seen before does
+        recent = get_recent_tweets("Retweeting_User", 5)
+        assert recent == ("tweet 12", "tweet 11", "tweet 10", "tweet 9", "retweet of 3")
+        assert pulled == ["12", "3", "11", "10"]
+
+
+def test_lookup_users_survives_upstream_errors(bench_app: Flask, monkeypatch):
+    """Errors from Twitter or the model server become the statuses of the users they affect, not a failed request."""
+    def get_tweets(user: str, pages: int=25) -> Iterator[Dict]:
+        if user == "garbled_user":
+            raise ParseError("Found a tweet without an id")
+
+        return stub_get_tweets(unavailable_rate=1.0 if user == "private_user" else 0.0)(user, pages)
+
+    def guess_batch(tweets: Sequence[Sequence[str]], timeout: int=None) -> List[Sequence[float]]:
+        raise ModelError({"code": -32000, "message": "Server error"})
+
+    monkeypatch.setattr(sockpuppet.api.v1, "get_tweets", get_tweets)
+    monkeypatch.setattr(sockpuppet.api.v1, "guess_batch", guess_batch)
+
+    with bench_app.app_context():
+        guesses = lookup_users(["erroring_user", "private_user", "garbled_user"], "stub", time.monotonic() + 5)
+
+    assert [g.status for g in guesses] == [UNKNOWN, UNAVAILABLE, UNKNOWN]
+
+
+def test_lookup_users_by_deadline(bench_app: Flask, scraped: List[str]):
+    """Users who can't be looked up in time are reported as unknown, without holding up everyone else."""
+    started = time.monotonic()
+    with bench_app.app_context():
+        guesses = lookup_users(["quick_user", "slow_user", "private_user"], "stub", started + 1)
+
+    assert time.monotonic() - started < 2
+    assert guesses[0].status in (BOT, HUMAN)
+    assert [g.status for g in guesses[1:]] == [UNKNOWN, UNAVAILABLE]
+
+    with bench_app.app_context():
+        # Only what was actually found out is cached
+        quick, slow, private = get_cached_guesses(["quick_user", "slow_user", "private_user"], "stub")
+
+    assert quick["status"] == guesses[0].status
+    assert slow is None
+    assert private["status"] == UNAVAILABLE
+
+
+def test_lookup_users_holds_leases_of_late_scrapes(bench_app: Flask, scraped: List[str]):
+    """A user whose scrape outlives the request keeps their lease until it's done, so nobody else starts another."""
+    with bench_app.app_context():
+        names = ["quick_user", "slow_user"]
+        assert all(acquire_lease(n, 60) for n in names)
+
+        lookup_users(names, "stub", time.monotonic() + 1, leased=names)
+
+        assert acquire_lease("quick_user", 60)
+        assert not acquire_lease("slow_user", 60)
+
+        for _ in range(50):
+            if acquire_lease("slow_user", 60):
+                break
+
+            time.sleep(0.1)
+        else:
+            pytest.fail("slow_user's lease was never released")
+
+        release_leases(names)
+
+
+def test_fetch_all_tweets_shares_a_pool(bench_app: Flask, scraped: List[str]):
+    """Every request's scrapes run in one bounded pool of threads, rather than each starting its own."""
+    with bench_app.app_context():
+        fetch_all_tweets(["somebody"], 5)
+        before = active_count()
+
+        for i in range(5):
+            fetch_all_tweets([f"user_{i}_{j}" for j in range(3)], 5)
+
+    assert active_count() - before <= bench_app.config["SCRAPE_WORKERS"]
+
+
+def test_guess_users_shares_leased_lookups(bench_app: Flask, scraped: List[str]):
+    """A user that someone else is already looking up isn't looked up again; their result is shared instead."""
+    def _finish():
+        with bench_app.app_context():
+            set_cached_guesses([("leased_user", BOT, 60, 60)], "stub")
+            release_leases(["leased_user"])
+
+    with bench_app.test_request_context():
+        assert acquire_lease("leased_user", 60)
+        finish = Timer(0.2, _finish)
+        finish.start()
+
+        guesses = guess_users(["leased_user", "unleased_user"])
+        finish.join()
+
+    assert guesses[0].status == BOT
+    assert guesses[1].status in (BOT, HUMAN)
+    assert scraped == ["unleased_user"]
+
+
+def test_guess_users_dedupes_spellings(bench_app: Flask, scraped: List[str]):
+    """A user asked for under several spellings is looked up once, rather than waiting out its own lease."""
+    with bench_app.test_request_context():
+        started = time.monotonic()
+        guesses = guess_users(["JesseT_G", "jesset_g", "@JESSET_G"])
+
+    assert time.monotonic() - started < 1
+    assert [g.id for g in guesses] == ["JesseT_G", "jesset_g", "@JESSET_G"]
+    assert len({g.status for g in guesses}) == 1
+    assert len(scraped) == 1
+
+
+def test_guess_users_serves_stale_guesses(bench_app: Flask, scraped: List[str]):
+    """A stale guess is served as it is, and looked up again in the background."""
+    with bench_app.test_request_context():
+        set_cached_guesses([("stale_user", HUMAN, 3600, 0)], "stub")
+        stale = get_cached_guesses(["stale_user"], "stub")[0]
+
+        assert guess_users(["stale_user"])[0].status == HUMAN
+
+        for _ in range(50):
+            refreshed = get_cached_guesses(["stale_user"], "stub")[0]
+            if refreshed["time"] > stale["time"]:
+                break
+
+            time.sleep(0.1)
+
+    assert refreshed["time"] > stale["time"]
+    assert refreshed["stale"] > time.time()
+    assert scraped == ["stale_user"]
+
+
+def test_lookup_users_without_tweets(bench_app: Flask, scraped: List[str]):
+    """A user with no tweets to go by is unknown, and doesn't keep everyone else from being scored."""
+    with bench_app.app_context():
+        quiet, loud = lookup_users(["quiet_user", "loud_user"], "stub", time.monotonic() + 5)
+
+    assert quiet.status == UNKNOWN
+    assert loud.status in (BOT, HUMAN)
+
+
+@pytest.mark.parametrize("body", [42, "JesseT_G", True], ids=["number", "string", "boolean"])
+def test_post_user_rejects_scalars(bench_app: Flask, body):
+    """A body that's neither a request nor a batch is an invalid request, not a crash."""
+    response = bench_app.test_client().post("/api/1/user", json=body)
+
+    assert response.status_code == HTTPStatus.BAD_REQUEST
+    assert response.get_json()["error"]["code"] == JSONRPCInvalidRequest.CODE
+
+
+def test_metrics(bench_app: Flask, scraped: List[str]):
+    client = bench_app.test_client()
+    client.get("/api/1/user?ids=jack", headers={"Accept": "application/json"})
+    response = client.get("/metrics")
+
+    assert response.status_code == HTTPStatus.OK
+    assert response.mimetype == "text/plain"
+    assert "sockdrawer_request_seconds_count" in response.get_data(as_text=True)
+    assert 'sockdrawer_verdicts_total{status="' in response.get_data(as_text=True)
+
+
+def test_server_timing(bench_app: Flask, scraped: List[str]):
+    response = bench_app.test_client().get("/api/1/user?ids=JesseT_G")
+
+    assert response.status_code == HTTPStatus.OK
+    stages = [entry.split(";")[0] for entry in response.headers["Server-Timing"].split(", ")]
+    assert stages[0] == "validate"
+    assert "cache" in stages
+    assert stages[-2:] == ["serialize", "total"]
+
+
+def test_conditional_get(bench_app: Flask, scraped: List[str]):
+    client = bench_app.test_client()
+    first = client.get("/api/1/user?ids=etag_user,other_etag_user")
+
+    assert first.status_code == HTTPStatus.OK
+    assert first.headers["ETag"].startswith('W/"')
+    assert "max-age=" in first.headers["Cache-Control"]
+
+    second = client.get("/api/1/user?ids=etag_user,other_etag_user", headers={"If-None-Match": first.headers["ETag"]})
+
+    assert second.status_code == HTTPStatus.NOT_MODIFIED
+    assert second.get_data() == b""
+    assert second.headers["ETag"] == first.headers["ETag"]
+    # Both were answered from the cache, so neither was looked up again
+    assert sorted(scraped) == ["etag_user", "other_etag_user"]